@@ -1,10 +1,11 @@
 import pygame
-import math
 import os
 import platform
 import subprocess
 import ctypes
 
+from collections import OrderedDict
+
 # COLORS
 
 AQUA = (0, 255, 255, 255)
@@ -56,6 +57,69 @@ DEFAULT_WIDTH = 16
 
 DEFAULT_FONT_SIZE = 18
 DEFAULT_TEXT_SPACING = 3
+
+# CACHES
+
+RENDER_CACHE_SIZE = 256
+
+_font_cache = {}
+_render_cache = OrderedDict()
+_image_cache = {}
+
+# ASSETS
+
+GFX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gfx")
+
+
+def load_image(path, size=None):
+	"""Process-wide image cache, each file is loaded once and each size scaled
+	and converted to the display format once. Relative paths that do not exist
+	from the working directory are looked up in GFX_DIR.
+	The surface is shared, blit it but do not draw on it."""
+	if not os.path.isabs(path) and not os.path.exists(path):
+		path = os.path.join(GFX_DIR, os.path.basename(path))
+	path = os.path.abspath(path)
+	size = tuple(int(d) for d in size) if size is not None else None
+	key = (path, size)
+	image = _image_cache.get(key)
+	if image is None:
+		if size is None:
+			image = pygame.image.load(path)
+			if pygame.display.get_surface() is not None:
+				image = image.convert_alpha() if image.get_alpha() is not None else image.convert()
+		else:
+			image = pygame.transform.scale(load_image(path), size)
+		_image_cache[key] = image
+	return image
+
+
+def get_font(font_name, size, bold=False, italic=False):
+	"""Process-wide SysFont cache, fonts are looked up and loaded once."""
+	key = (font_name, size, bold, italic)
+	font = _font_cache.get(key)
+	if font is None:
+		font = pygame.font.SysFont(font_name, size, bold, italic)
+		_font_cache[key] = font
+	return font
+
+
+def render_text(text, color=None):
+	"""Rendered surface of a Text, kept in an LRU cache of RENDER_CACHE_SIZE strings.
+	The surface is shared, blit it but do not draw on it."""
+	if color is None:
+		color = text.color
+	key = (text.value, text.font_name, text.size, text.bold, text.italic, tuple(color))
+	surface = _render_cache.get(key)
+	if surface is None:
+		surface = text.font.render(text.value, 1, color)
+		_render_cache[key] = surface
+		if len(_render_cache) > RENDER_CACHE_SIZE:
+			_render_cache.popitem(last=False)
+	else:
+		_render_cache.move_to_end(key)
+	return surface
+
+
 def get_capslock_state():
 	state = False
 	if platform.system() == "Windows":
@@ -124,7 +188,7 @@ class SysFont(Shape):
 		self.font_name = font_name
 		self.bold = bold
 		self.italic = italic
-		self.font = pygame.font.SysFont(font_name, 32, bold, italic)
+		self.font = get_font(font_name, 32, bold, italic)
 
 	def draw_text(self, surface, text):
 		surface.blit(self.font.render(text, 1, self.color, (self.w, self.h)), (self.x, self.y))
@@ -138,7 +202,7 @@ class Text:
 		self.font_name = font_name
 		self.bold = bold
 		self.italic = italic
-		self.font = pygame.font.SysFont(self.font_name, self.size, self.bold, self.italic)
+		self.font = get_font(self.font_name, self.size, self.bold, self.italic)
 
 class Grid:
 
@@ -31,14 +31,23 @@ class RectWidget(Widget):
 		self.pos = pos
 		self.dimensions = dimensions
 		self.rect = None
+		self.dirty = True
+
+	def is_dirty(self):
+		return self.dirty
+
+	def get_dirty_rect(self):
+		return pygame.Rect(self.pos[0], self.pos[1], self.dimensions[0], self.dimensions[1])
 
 	def set_color(self, rgba):
 		self.color = rgba
 		self.rect = core.Rectangle(self.color, self.pos, self.dimensions, self.width)
+		self.dirty = True
 
 	def set_width(self, width):
 		self.width = width
 		self.rect = core.Rectangle(self.color, self.pos, self.dimensions, self.width)
+		self.dirty = True
 
 	def set_solid(self, value):
 		if value:
@@ -55,18 +64,19 @@ class RectWidget(Widget):
 			self.span_h
 		]
 		self.rect = core.Rectangle(self.color, self.pos, self.dimensions, self.width)
+		self.dirty = True
 		if hasattr(self, "text"): self.set_text(self.text)
 
 	def set_image(self, path):
-		self.image = pygame.transform.scale(
-			pygame.image.load(path), 
-			(self.dimensions[0], self.dimensions[1])
-		)
+		self.image_path = path
+		self.image = core.load_image(path, (self.dimensions[0], self.dimensions[1]))
+		self.dirty = True
 
 	def set_image_dimensions(self, d):
 		if self.image:
-			self.image = pygame.transform.scale(self.image, d)
+			self.image = core.load_image(self.image_path, d)
 			self.rect = core.Rectangle(self.color, self.pos, [self.image.get_width(), self.image.get_height()], self.width)
+			self.dirty = True
 
 	def set_border(self, color, width=8):
 		if width == 0: raise Exception("Border width cannot be 0, otherwise it will eclipse the underlying rect.")
@@ -79,6 +89,7 @@ class RectWidget(Widget):
 			self.pos[1] - width
 		]
 		self.border = core.Rectangle(color, self.pos, self.dimensions, width)
+		self.dirty = True
 
 	def draw_image(self, surface):
 		surface.blit(self.image, (self.pos[0], self.pos[1]))
@@ -87,6 +98,7 @@ class RectWidget(Widget):
 		self.rect.draw(surface)
 		if hasattr(self, "image"): self.draw_image(surface)
 		if hasattr(self, "border"): self.border.draw(surface)
+		self.dirty = False
 
 def rpc(p, l=[]):
 	if p.parent:
@@ -182,30 +194,22 @@ class TextLabel(PanelSpecific):
 			if '\n' in new_text:
 				self.texts = [core.Text(s) for s in new_text.split('\n')]
 				self.text_rects = [
-					t.font.render(t.value, 1, core.WHITE) for t in self.texts
+					core.render_text(t, core.WHITE) for t in self.texts
 				]
 			else:
 				self.text = core.Text(new_text)
-				self.text_rect = self.text.font.render(
-					self.text.value, 
-					1, 
-					core.WHITE
-				)
+				self.text_rect = core.render_text(self.text, core.WHITE)
 		else:
 			if '\n' in new_text.value:
 				self.texts = [
 					core.Text(s.lstrip(' '), new_text.size, new_text.color, new_text.font_name, new_text.bold, new_text.italic) for s in new_text.value.split('\n')
 				]
 				self.text_rects = [
-					t.font.render(t.value, 1, t.color) for t in self.texts
+					core.render_text(t) for t in self.texts
 				]
 			else:
 				self.text = new_text
-				self.text_rect = self.text.font.render(
-					self.text.value, 
-					1, 
-					new_text.color
-				)
+				self.text_rect = core.render_text(self.text, new_text.color)
 		self.half_w = self.dimensions[0] / 2
 		self.half_h = self.dimensions[1] / 2
 		if not self.text_rects:
@@ -213,6 +217,7 @@ class TextLabel(PanelSpecific):
 			self.text_h = self.text_rect.get_rect().height
 			self.half_text_w = self.text_w / 2
 			self.half_text_h = self.text_h / 2
+		self.dirty = True
 
 	def set_alignment(self, alignment):
 		self.alignment = alignment
@@ -246,6 +251,7 @@ class TextLabel(PanelSpecific):
 					self.text_rects[n], 
 					(self.pos[0] + self.margin, self.pos[1] + (self.text_rects[n].get_rect().height * n), self.dimensions[0], self.dimensions[1])
 				)
+		self.dirty = False
 
 class RectButton(PanelSpecific):
 
@@ -336,11 +342,7 @@ class TextField(PanelSpecific):
 		self.half_w = self.dimensions[0] / 2
 		self.half_h = self.dimensions[1] / 2
 		self.text = core.Text(self.text_value, self.text_size)
-		self.text_rect = self.text.font.render(
-			self.text.value, 
-			1, 
-			self.text.color
-		)
+		self.text_rect = core.render_text(self.text)
 		self.half_text_w = self.text_rect.get_rect().width / 2
 		self.half_text_h = self.text_rect.get_rect().height / 2
 
@@ -437,6 +439,7 @@ class ToggleButton(RectButton):
 
 	def set_state(self, state):
 		self.state = state
+		self.dirty = True
 
 	def toggle(self, e):
 		self.on_click(e, 
@@ -459,6 +462,7 @@ class ToggleButton(RectButton):
 			self.visual_states[0].draw(surface)
 		else:
 			self.visual_states[1].draw(surface)
+		self.dirty = False
 
 class OptionChooser(Panel):
 
@@ -468,7 +472,7 @@ class OptionChooser(Panel):
 		
 		self.previous_button = RectButton(self, (0, 0))
 		self.previous_button.set_color(core.TRANSPARENT)
-		self.previous_button.set_image(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gfx/gray_arrow_0.png"))
+		self.previous_button.set_image(os.path.join(core.GFX_DIR, "gray_arrow_0.png"))
 		self.values = values
 		self.index = default_index
 		if (self.values):
@@ -485,7 +489,7 @@ class OptionChooser(Panel):
 		self.label.set_color(core.TRANSPARENT)
 		self.forward_button = RectButton(self, (5, 0))
 		self.forward_button.set_color(core.TRANSPARENT)
-		self.forward_button.set_image(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gfx/gray_arrow_1.png"))
+		self.forward_button.set_image(os.path.join(core.GFX_DIR, "gray_arrow_1.png"))
 
 	def set_images(self, paths):
 		self.previous_button.set_image(os.path.join(os.path.dirname(os.path.abspath(__file__)), paths[0]))
@@ -563,9 +567,13 @@ class OptionChooser(Panel):
 		self.previous_button.on_click(e, function, *args)
 		self.forward_button.on_click(e, function, *args)
 
+	def is_dirty(self):
+		return self.dirty or self.label.dirty or self.previous_button.dirty or self.forward_button.dirty
+
 	def draw(self, surface):
 		if hasattr(self, "image"): self.draw_image(surface)
 		if hasattr(self, "border"): self.border.draw(surface)
 		self.label.draw(surface)
 		self.previous_button.draw(surface)
 		self.forward_button.draw(surface)
+		self.dirty = False
@@ -0,0 +1,68 @@
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+
+"""
+This module provides the per-frame actor arrays used by the agents to cull
+obstacle candidates before the precise checks.
+"""
+
+import numpy as np
+
+
+class ActorBatch(object):
+    """
+    Locations, forward vectors and bounding radii of a list of actors at one
+    frame, as numpy arrays in the order of the list. Batches are built and
+    shared by the WorldState of the frame.
+    """
+
+    def __init__(self, actors, rows):
+        """
+        :param actors: list of actors
+        :param rows: per actor, (x, y, z, forward x, forward y, extent x, bounding radius)
+        """
+        self.actors = list(actors)
+        data = np.array(rows, dtype=np.float64).reshape(-1, 7)
+        self.locations = data[:, 0:3]
+        self.forward = data[:, 3:5]
+        self.extents = data[:, 5]
+        self.radii = data[:, 6]
+
+    def __len__(self):
+        return len(self.actors)
+
+    def within_distance(self, location, max_distance):
+        """
+        Mask of the actors within max_distance of location, in 3D
+        """
+        offsets = self.locations - np.array([location.x, location.y, location.z])
+        # The slack keeps actors at the limit, the precise checks decide on them
+        limit = max_distance + 1e-6
+        return np.einsum('ij,ij->i', offsets, offsets) <= limit * limit
+
+    def rear_within_cone(self, reference_transform, max_distance, angle_interval):
+        """
+        Mask of the actors whose rear is within max_distance of the reference and whose
+        angle to its forward vector lies in angle_interval. Mirrors misc.is_within_distance,
+        with some slack so that it never rejects an actor the precise check would accept.
+        """
+        reference = reference_transform.location
+        forward = reference_transform.get_forward_vector()
+        rear = self.locations[:, 0:2] - self.extents[:, None] * self.forward
+        vectors = rear - np.array([reference.x, reference.y])
+        norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosines = np.clip(vectors.dot([forward.x, forward.y]) / norms, -1., 1.)
+        angles = np.degrees(np.arccos(cosines))
+        in_angle = (angles > angle_interval[0] - 1e-6) & (angles < angle_interval[1] + 1e-6)
+        return (norms < 0.01) | ((norms <= max_distance + 1e-6) & in_angle)
+
+    def touching_bounds(self, bounds):
+        """
+        Mask of the actors whose bounding box may overlap the (min x, min y, max x, max y) bounds
+        """
+        min_x, min_y, max_x, max_y = bounds
+        x, y = self.locations[:, 0], self.locations[:, 1]
+        return (x + self.radii >= min_x) & (x - self.radii <= max_x) & \
+            (y + self.radii >= min_y) & (y - self.radii <= max_y)
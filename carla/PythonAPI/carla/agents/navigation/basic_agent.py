@@ -10,10 +10,12 @@ It can also make use of the global route planner to follow a specifed route
 """
 
 import carla
+import numpy as np
 from shapely.geometry import Polygon
 
 from agents.navigation.local_planner import LocalPlanner, RoadOption
 from agents.navigation.global_route_planner import GlobalRoutePlanner
+from agents.navigation.world_state import WorldStateCache
 from agents.tools.misc import (get_speed, is_within_distance,
                                get_trafficlight_trigger_location,
                                compute_distance)
@@ -29,7 +31,7 @@ class BasicAgent(object):
     as well as to change its parameters in case a different driving mode is desired.
     """
 
-    def __init__(self, vehicle, target_speed=20, opt_dict={}, map_inst=None, grp_inst=None):
+    def __init__(self, vehicle, target_speed=20, opt_dict={}, map_inst=None, grp_inst=None, world_state=None):
         """
         Initialization the agent paramters, the local and the global planner.
 
@@ -39,6 +41,8 @@ class BasicAgent(object):
                 This also applies to parameters related to the LocalPlanner.
             :param map_inst: carla.Map instance to avoid the expensive call of getting it.
             :param grp_inst: GlobalRoutePlanner instance to avoid the expensive call of getting it.
+            :param world_state: WorldStateCache instance to share the actors of each frame with other agents.
+                If None, the cache shared by the agents of the same world is used.
 
         """
         self._vehicle = vehicle
@@ -100,8 +104,17 @@ class BasicAgent(object):
         else:
             self._global_planner = GlobalRoutePlanner(self._map, self._sampling_resolution)
 
+        if world_state:
+            if isinstance(world_state, WorldStateCache):
+                self._world_state = world_state
+            else:
+                print("Warning: Ignoring the given world state as it is not a 'WorldStateCache'")
+                self._world_state = WorldStateCache.for_world(self._world)
+        else:
+            self._world_state = WorldStateCache.for_world(self._world)
+
         # Get the static elements of the scene
-        self._lights_list = self._world.get_actors().filter("*traffic_light*")
+        self._lights_list = self._world_state.get().traffic_lights
         self._lights_map = {}  # Dictionary mapping a traffic light to a wp corrspoing to its trigger volume location
 
     def add_emergency_stop(self, control):
@@ -199,8 +212,8 @@ class BasicAgent(object):
         """Execute one step of navigation."""
         hazard_detected = False
 
-        # Retrieve all relevant actors
-        vehicle_list = self._world.get_actors().filter("*vehicle*")
+        # Retrieve all relevant actors, fetched once per frame for all the agents
+        vehicle_list = self._world_state.get().vehicles
 
         vehicle_speed = get_speed(self._vehicle) / 3.6
 
@@ -277,7 +290,7 @@ class BasicAgent(object):
             return TrafficLightDetectionResult(False, None)
 
         if not lights_list:
-            lights_list = self._world.get_actors().filter("*traffic_light*")
+            lights_list = self._world_state.get().traffic_lights
 
         if not max_distance:
             max_distance = self._base_tlight_threshold
@@ -358,8 +371,9 @@ class BasicAgent(object):
         if self._ignore_vehicles:
             return ObstacleDetectionResult(False, None, -1)
 
+        world_state = self._world_state.get()
         if vehicle_list is None:
-            vehicle_list = self._world.get_actors().filter("*vehicle*")
+            vehicle_list = world_state.vehicles
         if len(vehicle_list) == 0:
             return ObstacleDetectionResult(False, None, -1)
 
@@ -385,7 +399,16 @@ class BasicAgent(object):
         # Get the route bounding box
         route_polygon = get_route_polygon()
 
-        for target_vehicle in vehicle_list:
+        # Cull the targets with the arrays of the frame, shared by all the agents. Only the ones
+        # close enough and either in the detection cone or near the route get the precise checks
+        batch = world_state.batch(vehicle_list)
+        reachable = batch.rear_within_cone(ego_front_transform, max_distance, [low_angle_th, up_angle_th])
+        if route_polygon:
+            reachable |= batch.touching_bounds(route_polygon.bounds)
+        candidates = np.flatnonzero(batch.within_distance(ego_location, max_distance) & reachable)
+
+        for index in candidates:
+            target_vehicle = batch.actors[index]
             if target_vehicle.id == self._vehicle.id:
                 continue
 
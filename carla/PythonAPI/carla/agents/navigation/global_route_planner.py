@@ -8,58 +8,203 @@
 This module provides GlobalRoutePlanner implementation.
 """
 
+import hashlib
+import json
 import math
+import os
+import time
+import zipfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import networkx as nx
 
 import carla
 from agents.navigation.local_planner import RoadOption
+from agents.navigation.route_graph import RouteGraph, LaneIndex
 from agents.tools.misc import vector
 
+# Bumped whenever the layout of the serialized graph changes
+GRAPH_CACHE_VERSION = 2
+
+WAYPOINT_KEYS = ('entry_waypoint', 'exit_waypoint', 'change_waypoint')
+
+VECTOR_KEYS = ('entry_vector', 'exit_vector', 'net_vector')
+
+RouteCacheInfo = namedtuple('RouteCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class RouteEndpoint(object):
+    """
+    Location localized on a lane of the graph, standing in for the carla.Waypoint
+    of a route endpoint: it has the road, section and lane ids, the transform of
+    the point on the lane and the edge of the lane. A waypoint is only picked,
+    among the sampled waypoints of the edge, if a route trace has to start with it.
+    """
+
+    def __init__(self, road_id, section_id, lane_id, offset, location, edge, waypoint=None):
+        self.road_id = road_id
+        self.section_id = section_id
+        self.lane_id = lane_id
+        self.offset = offset  # Distance along the edge, None if localized by the map
+        self.transform = carla.Transform(location)
+        self.edge = edge
+        self.waypoint = waypoint
+
+
 class GlobalRoutePlanner(object):
     """
     This class provides a very high level route plan.
     """
 
-    def __init__(self, wmap, sampling_resolution):
+    def __init__(self, wmap, sampling_resolution, cache_dir=None, route_cache_size=128, build_workers=None):
+        """
+        :param wmap: carla.Map of the world
+        :param sampling_resolution: distance between the waypoints of the graph edges
+        :param cache_dir: directory where the built graph is saved and loaded from, keyed by
+            the OpenDRIVE hash and the sampling resolution. Defaults to $CARLA_ROUTE_CACHE_DIR,
+            the graph is not cached if neither is set.
+        :param route_cache_size: number of traced routes kept to answer repeated requests, 0 disables it
+        :param build_workers: threads sampling the topology segments, defaults to the number of CPUs.
+            1 samples them sequentially.
+        """
         self._sampling_resolution = sampling_resolution
         self._wmap = wmap
         self._topology = None
         self._graph = None
         self._id_map = None
         self._road_id_to_edge = None
+        self._build_workers = build_workers if build_workers is not None else (os.cpu_count() or 1)
+        # Seconds spent in every phase of the construction, e.g. {'topology': 1.2, ...}
+        self.build_times = OrderedDict()
 
         self._intersection_end_node = -1
         self._previous_decision = RoadOption.VOID
 
-        # Build the graph
-        self._build_topology()
-        self._build_graph()
-        self._find_loose_ends()
-        self._lane_change_link()
+        # Traced routes by localized endpoints, least recently used first
+        self._route_cache = OrderedDict()
+        self._route_cache_size = route_cache_size
+        self._route_cache_version = None
+        self._route_cache_hits = 0
+        self._route_cache_misses = 0
+
+        # Client side index of the lanes, built on the first localization
+        self._lane_index = None
+        self._lane_index_version = None
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('CARLA_ROUTE_CACHE_DIR')
+        cache_path = self._graph_cache_path(cache_dir) if cache_dir else None
+
+        # Build the graph, unless a cached one exists
+        if cache_path is None or not self._timed('load', self._load_graph, cache_path):
+            self._timed('topology', self._build_topology)
+            self._timed('graph', self._build_graph)
+            self._timed('loose_ends', self._find_loose_ends)
+            self._timed('lane_change', self._lane_change_link)
+            if cache_path is not None:
+                self._timed('save', self._save_graph, cache_path)
+
+    def _timed(self, phase, function, *args):
+        """
+        Runs a construction phase, recording its duration in build_times
+        """
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.build_times[phase] = time.perf_counter() - start
 
     def trace_route(self, origin, destination):
         """
         This method returns list of (carla.Waypoint, RoadOption)
-        from origin to destination
+        from origin to destination.
+        Routes between the same lanes, with endpoints within the same
+        sampling_resolution stretch of them, are served from the route cache.
         """
-        route_trace = []
-        route = self._path_search(origin, destination)
-        current_waypoint = self._wmap.get_waypoint(origin)
-        destination_waypoint = self._wmap.get_waypoint(destination)
+        current_endpoint = self._locate(origin)
+        destination_endpoint = self._locate(destination)
+        key = (self._route_key(current_endpoint), self._route_key(destination_endpoint))
+        cached = self._get_cached_route(key)
+        if cached is not None:
+            return list(cached)
+
+        route = self._search(current_endpoint.edge, destination_endpoint.edge)
+        route_trace = self._stitch_route(route, current_endpoint, destination_endpoint, destination)
+        self._cache_route(key, route_trace)
+        return route_trace
 
+    def trace_routes(self, pairs):
+        """
+        This method returns, for every (origin, destination) pair of carla.Locations,
+        the list of (carla.Waypoint, RoadOption) from origin to destination,
+        the same as trace_route. Repeated locations are localized once and the
+        graph is compiled once for all the searches.
+        """
+        locate = self._batch_localizer()
+        route_traces = []
+        for origin, destination in pairs:
+            origin_endpoint, destination_endpoint = locate(origin), locate(destination)
+            key = (self._route_key(origin_endpoint), self._route_key(destination_endpoint))
+            cached = self._get_cached_route(key)
+            if cached is not None:
+                route_traces.append(list(cached))
+                continue
+            route = self._search(origin_endpoint.edge, destination_endpoint.edge)
+            route_trace = self._stitch_route(route, origin_endpoint, destination_endpoint, destination)
+            self._cache_route(key, route_trace)
+            route_traces.append(route_trace)
+        return route_traces
+
+    def trace_routes_from(self, origin, destinations):
+        """
+        This method returns the list of (carla.Waypoint, RoadOption) from origin
+        to every destination, searched with a single shortest path tree.
+        The routes are the shortest by edge length, which trace_route does not
+        guarantee: its A* heuristic, in meters against weights counted in
+        waypoints, favours the more direct routes.
+        """
+        locate = self._batch_localizer()
+        origin_endpoint = locate(origin)
+        start = origin_endpoint.edge
+        ends = [locate(destination).edge for destination in destinations]
+        paths = self._graph.shortest_paths(start[0], [end[0] for end in ends], weight='length')
+        route_traces = []
+        for destination, end in zip(destinations, ends):
+            route = paths[end[0]] + [end[1]]
+            route_traces.append(self._stitch_route(route, origin_endpoint, locate(destination), destination))
+        return route_traces
+
+    def _batch_localizer(self):
+        """
+        Returns a function localizing every location once, as RouteEndpoints
+        """
+        endpoints = dict()
+        def locate(location):
+            key = (location.x, location.y, location.z)
+            if key not in endpoints:
+                endpoints[key] = self._locate(location)
+            return endpoints[key]
+        return locate
+
+    def _stitch_route(self, route, current_waypoint, destination_waypoint, destination):
+        """
+        This method turns a path of graph nodes into the list of (carla.Waypoint, RoadOption)
+        starting at current_waypoint and stopping at the destination.
+        The endpoints may be RouteEndpoints, only their ids and locations are used.
+        """
+        route_trace = []
         for i in range(len(route) - 1):
             road_option = self._turn_decision(i, route)
-            edge = self._graph.edges[route[i], route[i+1]]
+            edge = self._hydrate_edge(self._graph.edge(route[i], route[i+1]))
             path = []
 
             if edge['type'] != RoadOption.LANEFOLLOW and edge['type'] != RoadOption.VOID:
-                route_trace.append((current_waypoint, road_option))
+                route_trace.append((self._endpoint_waypoint(current_waypoint), road_option))
                 exit_wp = edge['exit_waypoint']
                 n1, n2 = self._road_id_to_edge[exit_wp.road_id][exit_wp.section_id][exit_wp.lane_id]
-                next_edge = self._graph.edges[n1, n2]
+                next_edge = self._hydrate_edge(self._graph.edge(n1, n2))
                 if next_edge['path']:
-                    closest_index = self._find_closest_in_list(current_waypoint, next_edge['path'])
+                    closest_index = self._find_closest_in_array(current_waypoint, self._path_locations(next_edge)[1:-1])
                     closest_index = min(len(next_edge['path'])-1, closest_index+5)
                     current_waypoint = next_edge['path'][closest_index]
                 else:
@@ -68,19 +213,226 @@ class GlobalRoutePlanner(object):
 
             else:
                 path = path + [edge['entry_waypoint']] + edge['path'] + [edge['exit_waypoint']]
-                closest_index = self._find_closest_in_list(current_waypoint, path)
-                for waypoint in path[closest_index:]:
-                    current_waypoint = waypoint
+                locations = self._path_locations(edge)
+                closest_index = self._find_closest_in_array(current_waypoint, locations)
+                last_edge = len(route)-i <= 2
+                if last_edge:
+                    offsets = locations - (destination.x, destination.y, destination.z)
+                    near_destination = np.einsum('ij,ij->i', offsets, offsets) < (2*self._sampling_resolution)**2
+                    destination_index = None
+                for j in range(closest_index, len(path)):
+                    current_waypoint = path[j]
                     route_trace.append((current_waypoint, road_option))
-                    if len(route)-i <= 2 and waypoint.transform.location.distance(destination) < 2*self._sampling_resolution:
+                    if last_edge and near_destination[j]:
                         break
-                    elif len(route)-i <= 2 and current_waypoint.road_id == destination_waypoint.road_id and current_waypoint.section_id == destination_waypoint.section_id and current_waypoint.lane_id == destination_waypoint.lane_id:
-                        destination_index = self._find_closest_in_list(destination_waypoint, path)
+                    elif last_edge and current_waypoint.road_id == destination_waypoint.road_id and current_waypoint.section_id == destination_waypoint.section_id and current_waypoint.lane_id == destination_waypoint.lane_id:
+                        if destination_index is None:
+                            destination_index = self._find_closest_in_array(destination_waypoint, locations)
                         if closest_index > destination_index:
                             break
 
         return route_trace
 
+    def route_cache_info(self):
+        """
+        Returns the hits, misses, maximum and current size of the route cache
+        """
+        return RouteCacheInfo(self._route_cache_hits, self._route_cache_misses,
+                              self._route_cache_size, len(self._route_cache))
+
+    def clear_route_cache(self):
+        """
+        Forgets the cached routes and resets the cache counters
+        """
+        self._route_cache.clear()
+        self._route_cache_hits = 0
+        self._route_cache_misses = 0
+
+    def seed_route(self, origin, destination, route_trace):
+        """
+        Adds a route traced ahead of time, e.g. decoded with decode_route, to the
+        route cache, so trace_route(origin, destination) answers it without a search
+        """
+        key = (self._route_key(self._locate(origin)), self._route_key(self._locate(destination)))
+        self._check_route_cache_version()
+        self._cache_route(key, route_trace)
+
+    def encode_route(self, route_trace):
+        """
+        Route trace as JSON serializable lists of the OpenDRIVE identifiers, s and
+        location of every waypoint and the int value of its RoadOption
+        """
+        return [list(_encode_waypoint(waypoint)) + [int(road_option)] for waypoint, road_option in route_trace]
+
+    def decode_route(self, encoded):
+        """
+        Route trace, list of (carla.Waypoint, RoadOption), of a route encoded with encode_route
+        """
+        return [(self._decode_waypoint(*w[:7]), RoadOption(w[7])) for w in encoded]
+
+    def _route_key(self, endpoint):
+        """
+        Localized endpoint of a route: its lane and stretch of the lane, measured
+        along the edge, or by the OpenDRIVE s of the waypoint if the map localized it
+        """
+        if endpoint.offset is None:
+            return (endpoint.road_id, endpoint.section_id, endpoint.lane_id,
+                    's', int(endpoint.waypoint.s // self._sampling_resolution))
+        return (endpoint.road_id, endpoint.section_id, endpoint.lane_id,
+                'offset', int(endpoint.offset // self._sampling_resolution))
+
+    def _get_cached_route(self, key):
+        if self._route_cache_size <= 0:
+            return None
+        self._check_route_cache_version()
+        route_trace = self._route_cache.get(key)
+        if route_trace is None:
+            self._route_cache_misses += 1
+        else:
+            self._route_cache_hits += 1
+            self._route_cache.move_to_end(key)
+        return route_trace
+
+    def _check_route_cache_version(self):
+        if self._route_cache_version != self._graph.version:
+            # The graph changed since the routes were traced
+            self._route_cache.clear()
+            self._route_cache_version = self._graph.version
+
+    def _cache_route(self, key, route_trace):
+        if self._route_cache_size <= 0:
+            return
+        self._route_cache[key] = tuple(route_trace)
+        while len(self._route_cache) > self._route_cache_size:
+            self._route_cache.popitem(last=False)
+
+    def _graph_cache_path(self, cache_dir):
+        """
+        Path, without extension, of the cached graph of the map, named after the
+        map, the hash of its OpenDRIVE and the sampling resolution
+        """
+        opendrive_hash = hashlib.sha1(self._wmap.to_opendrive().encode("UTF-8")).hexdigest()
+        filename = "%s_%s_%s" % (self._wmap.name.split('/')[-1], opendrive_hash, repr(float(self._sampling_resolution)))
+        return os.path.join(cache_dir, filename)
+
+    def _save_graph(self, path):
+        """
+        Saves the graph as numpy arrays (path.npz) and a JSON sidecar with the
+        edge metadata (path.json), every waypoint replaced by its OpenDRIVE
+        identifiers and location. Neither file needs pickle to be loaded.
+        """
+        nodes = list(self._graph.nodes())
+        edges = list(self._graph.edges())
+        paths = [_encode_path(data['path']) for _, _, data in edges]
+        waypoints = np.full((len(edges), len(WAYPOINT_KEYS), 7), np.nan)
+        vectors = np.full((len(edges), len(VECTOR_KEYS), 3), np.nan)
+        metadata = []
+        for n, (n1, n2, data) in enumerate(edges):
+            for k, key in enumerate(WAYPOINT_KEYS):
+                if data.get(key) is not None:
+                    waypoints[n, k] = _encode_waypoint(data[key])
+            for k, key in enumerate(VECTOR_KEYS):
+                if data.get(key) is not None:
+                    vectors[n, k] = data[key]
+            metadata.append([int(n1), int(n2), int(data['length']), bool(data['intersection']), int(data['type'])])
+        arrays = {
+            'node_ids': np.array([node for node, _ in nodes], dtype=np.int64),
+            'node_vertices': np.array([vertex for _, vertex in nodes], dtype=np.float64).reshape(-1, 3),
+            'path_offsets': np.cumsum([0] + [len(path_s) for _, path_s, _ in paths]).astype(np.int64),
+            'path_ids': np.concatenate([ids for ids, _, _ in paths] + [np.zeros((0, 3), dtype=np.int32)]),
+            'path_s': np.concatenate([path_s for _, path_s, _ in paths] + [np.zeros(0)]),
+            'path_xyz': np.concatenate([xyz for _, _, xyz in paths] + [np.zeros((0, 3))]),
+            'waypoints': waypoints,
+            'vectors': vectors,
+        }
+        sidecar = {
+            'version': GRAPH_CACHE_VERSION,
+            'edges': metadata,
+            'id_map': [[float(x), float(y), float(z), int(node)] for (x, y, z), node in self._id_map.items()],
+            'road_id_to_edge': [[int(road_id), int(section_id), int(lane_id), int(n1), int(n2)]
+                                for road_id, sections in self._road_id_to_edge.items()
+                                for section_id, lanes in sections.items()
+                                for lane_id, (n1, n2) in lanes.items()],
+        }
+        try:
+            if not os.path.exists(os.path.dirname(path) or '.'):
+                os.makedirs(os.path.dirname(path))
+            # Written aside and moved, the sidecar last: a concurrent reader never sees half a graph
+            tmp_suffix = '.%d.tmp' % os.getpid()
+            with open(path + '.npz' + tmp_suffix, 'wb') as f:
+                np.savez(f, **arrays)
+            with open(path + '.json' + tmp_suffix, 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(path + '.npz' + tmp_suffix, path + '.npz')
+            os.replace(path + '.json' + tmp_suffix, path + '.json')
+        except (IOError, OSError) as error:
+            print("Warning: could not cache the route graph in %s: %s" % (path, error))
+
+    def _load_graph(self, path):
+        """
+        Loads a saved graph, returns False if there is no valid one.
+        The waypoints of the edges are only rehydrated when a route goes through them.
+        """
+        try:
+            with open(path + '.json', 'r') as f:
+                sidecar = json.load(f)
+            if not isinstance(sidecar, dict) or sidecar.get('version') != GRAPH_CACHE_VERSION:
+                return False
+            with np.load(path + '.npz', allow_pickle=False) as npz:
+                arrays = dict((key, npz[key]) for key in npz.files)
+            graph = RouteGraph()
+            for node, vertex in zip(arrays['node_ids'].tolist(), arrays['node_vertices'].tolist()):
+                graph.add_node(node, vertex)
+            offsets = arrays['path_offsets']
+            waypoints, vectors = arrays['waypoints'], arrays['vectors']
+            for n, (n1, n2, length, intersection, road_option) in enumerate(sidecar['edges']):
+                start, end = offsets[n], offsets[n + 1]
+                data = dict(length=length, intersection=intersection, type=RoadOption(road_option),
+                            path=(arrays['path_ids'][start:end], arrays['path_s'][start:end],
+                                  arrays['path_xyz'][start:end]),
+                            hydrated=False)
+                for k, key in enumerate(WAYPOINT_KEYS):
+                    if not np.isnan(waypoints[n, k, 0]):
+                        road_id, section_id, lane_id, s, x, y, z = waypoints[n, k].tolist()
+                        data[key] = (int(road_id), int(section_id), int(lane_id), s, x, y, z)
+                for k, key in enumerate(VECTOR_KEYS):
+                    data[key] = None if np.isnan(vectors[n, k, 0]) else vectors[n, k].copy()
+                if data['net_vector'] is not None:
+                    data['net_vector'] = data['net_vector'].tolist()
+                graph.add_edge(n1, n2, **data)
+            id_map = dict(((x, y, z), node) for x, y, z, node in sidecar['id_map'])
+            road_id_to_edge = dict()
+            for road_id, section_id, lane_id, n1, n2 in sidecar['road_id_to_edge']:
+                road_id_to_edge.setdefault(road_id, dict()).setdefault(section_id, dict())[lane_id] = (n1, n2)
+        except (IOError, OSError, ValueError, KeyError, IndexError, TypeError, zipfile.BadZipFile):
+            return False
+        self._graph = graph
+        self._id_map = id_map
+        self._road_id_to_edge = road_id_to_edge
+        return True
+
+    def _hydrate_edge(self, edge):
+        """
+        Replaces the serialized waypoints of a loaded edge by carla.Waypoints
+        """
+        if edge.get('hydrated', True):
+            return edge
+        for key in WAYPOINT_KEYS:
+            if key in edge:
+                edge[key] = self._decode_waypoint(*edge[key])
+        ids, s, xyz = edge['path']
+        edge['path'] = [self._decode_waypoint(ids[i, 0], ids[i, 1], ids[i, 2], s[i], *xyz[i])
+                        for i in range(len(s))]
+        edge['hydrated'] = True
+        return edge
+
+    def _decode_waypoint(self, road_id, section_id, lane_id, s, x, y, z):
+        waypoint = self._wmap.get_waypoint_xodr(int(road_id), int(lane_id), float(s))
+        if waypoint is None or waypoint.section_id != section_id:
+            # Falls back to the closest waypoint of the stored location
+            waypoint = self._wmap.get_waypoint(carla.Location(x=float(x), y=float(y), z=float(z)))
+        return waypoint
+
     def _build_topology(self):
         """
         This function retrieves topology from the server as a list of
@@ -92,39 +444,52 @@ class GlobalRoutePlanner(object):
         - exit (carla.Waypoint): waypoint of exit point of road segment
         - exitxyz (tuple): (x,y,z) of exit point of road segment
         - path (list of carla.Waypoint):  list of waypoints between entry to exit, separated by the resolution
+
+        The segments are independent and sampled by a pool of build_workers
+        threads, keeping the order of the map topology.
         """
-        self._topology = []
-        # Retrieving waypoints to construct a detailed topology
-        for segment in self._wmap.get_topology():
-            wp1, wp2 = segment[0], segment[1]
-            l1, l2 = wp1.transform.location, wp2.transform.location
-            # Rounding off to avoid floating point imprecision
-            x1, y1, z1, x2, y2, z2 = np.round([l1.x, l1.y, l1.z, l2.x, l2.y, l2.z], 0)
-            wp1.transform.location, wp2.transform.location = l1, l2
-            seg_dict = dict()
-            seg_dict['entry'], seg_dict['exit'] = wp1, wp2
-            seg_dict['entryxyz'], seg_dict['exitxyz'] = (x1, y1, z1), (x2, y2, z2)
-            seg_dict['path'] = []
-            endloc = wp2.transform.location
-            if wp1.transform.location.distance(endloc) > self._sampling_resolution:
-                w = wp1.next(self._sampling_resolution)[0]
-                while w.transform.location.distance(endloc) > self._sampling_resolution:
-                    seg_dict['path'].append(w)
-                    next_ws = w.next(self._sampling_resolution)
-                    if len(next_ws) == 0:
-                        break
-                    w = next_ws[0]
-            else:
-                next_wps = wp1.next(self._sampling_resolution)
-                if len(next_wps) == 0:
-                    continue
-                seg_dict['path'].append(next_wps[0])
-            self._topology.append(seg_dict)
+        segments = self._wmap.get_topology()
+        if self._build_workers > 1 and len(segments) > 1:
+            with ThreadPoolExecutor(max_workers=self._build_workers) as executor:
+                sampled = list(executor.map(self._sample_segment, segments))
+        else:
+            sampled = [self._sample_segment(segment) for segment in segments]
+        self._topology = [seg_dict for seg_dict in sampled if seg_dict is not None]
+
+    def _sample_segment(self, segment):
+        """
+        This function samples the waypoints of a topology segment into its
+        dictionary, returning None if the segment can not be followed
+        """
+        wp1, wp2 = segment[0], segment[1]
+        l1, l2 = wp1.transform.location, wp2.transform.location
+        # Rounding off to avoid floating point imprecision
+        x1, y1, z1, x2, y2, z2 = np.round([l1.x, l1.y, l1.z, l2.x, l2.y, l2.z], 0)
+        wp1.transform.location, wp2.transform.location = l1, l2
+        seg_dict = dict()
+        seg_dict['entry'], seg_dict['exit'] = wp1, wp2
+        seg_dict['entryxyz'], seg_dict['exitxyz'] = (x1, y1, z1), (x2, y2, z2)
+        seg_dict['path'] = []
+        endloc = wp2.transform.location
+        if wp1.transform.location.distance(endloc) > self._sampling_resolution:
+            w = wp1.next(self._sampling_resolution)[0]
+            while w.transform.location.distance(endloc) > self._sampling_resolution:
+                seg_dict['path'].append(w)
+                next_ws = w.next(self._sampling_resolution)
+                if len(next_ws) == 0:
+                    break
+                w = next_ws[0]
+        else:
+            next_wps = wp1.next(self._sampling_resolution)
+            if len(next_wps) == 0:
+                return None
+            seg_dict['path'].append(next_wps[0])
+        return seg_dict
 
     def _build_graph(self):
         """
-        This function builds a networkx graph representation of topology, creating several class attributes:
-        - graph (networkx.DiGraph): networkx graph representing the world map, with:
+        This function builds a graph representation of topology, creating several class attributes:
+        - graph (RouteGraph): array-backed directed graph representing the world map, with:
             Node properties:
                 vertex: (x,y,z) position in world map
             Edge properties:
@@ -136,7 +501,7 @@ class GlobalRoutePlanner(object):
         - road_id_to_edge (dictionary): map from road id to edge in the graph
         """
 
-        self._graph = nx.DiGraph()
+        self._graph = RouteGraph()
         self._id_map = dict()  # Map with structure {(x,y,z): id, ... }
         self._road_id_to_edge = dict()  # Map with structure {road_id: {lane_id: edge, ... }, ... }
 
@@ -152,7 +517,7 @@ class GlobalRoutePlanner(object):
                 if vertex not in self._id_map:
                     new_id = len(self._id_map)
                     self._id_map[vertex] = new_id
-                    self._graph.add_node(new_id, vertex=vertex)
+                    self._graph.add_node(new_id, vertex)
             n1 = self._id_map[entry_xyz]
             n2 = self._id_map[exit_xyz]
             if road_id not in self._road_id_to_edge:
@@ -212,7 +577,7 @@ class GlobalRoutePlanner(object):
                     n2_xyz = (path[-1].transform.location.x,
                               path[-1].transform.location.y,
                               path[-1].transform.location.z)
-                    self._graph.add_node(n2, vertex=n2_xyz)
+                    self._graph.add_node(n2, n2_xyz)
                     self._graph.add_edge(
                         n1, n2,
                         length=len(path) + 1, path=path,
@@ -239,7 +604,7 @@ class GlobalRoutePlanner(object):
                                 and next_waypoint.lane_type == carla.LaneType.Driving \
                                 and waypoint.road_id == next_waypoint.road_id:
                             next_road_option = RoadOption.CHANGELANERIGHT
-                            next_segment = self._localize(next_waypoint.transform.location)
+                            next_segment = self._localize_waypoint(next_waypoint)
                             if next_segment is not None:
                                 self._graph.add_edge(
                                     self._id_map[segment['entryxyz']], next_segment[0], entry_waypoint=waypoint,
@@ -252,7 +617,7 @@ class GlobalRoutePlanner(object):
                                 and next_waypoint.lane_type == carla.LaneType.Driving \
                                 and waypoint.road_id == next_waypoint.road_id:
                             next_road_option = RoadOption.CHANGELANELEFT
-                            next_segment = self._localize(next_waypoint.transform.location)
+                            next_segment = self._localize_waypoint(next_waypoint)
                             if next_segment is not None:
                                 self._graph.add_edge(
                                     self._id_map[segment['entryxyz']], next_segment[0], entry_waypoint=waypoint,
@@ -262,12 +627,80 @@ class GlobalRoutePlanner(object):
                 if left_found and right_found:
                     break
 
-    def _localize(self, location):
+    def localize(self, location):
+        """
+        This method returns the edge of the road segment closest to a
+        carla.Location, answered by the client side lane index, or None
+        """
+        return self._localize(location)
+
+    def _localize(self, location, max_distance=50.0):
         """
         This function finds the road segment that a given location
-        is part of, returning the edge it belongs to
+        is part of, returning the edge it belongs to.
+        Locations farther than max_distance from every lane are left to the map.
+        """
+        lane, _ = self._get_lane_index().nearest(location.x, location.y, location.z, max_distance)
+        if lane is None:
+            return self._localize_waypoint(self._wmap.get_waypoint(location))
+        road_id, section_id, lane_id = lane
+        try:
+            return self._road_id_to_edge[road_id][section_id][lane_id]
+        except KeyError:
+            return None
+
+    def _locate(self, location, max_distance=50.0):
         """
+        This function localizes a location on the lanes of the graph as a RouteEndpoint,
+        with the lane index. Locations farther than max_distance from every lane are left to the map.
+        """
+        lane, _, offset, point = self._get_lane_index().locate(location.x, location.y, location.z, max_distance)
+        if lane is not None:
+            road_id, section_id, lane_id = lane
+            edge = self._road_id_to_edge.get(road_id, {}).get(section_id, {}).get(lane_id)
+            if edge is not None:
+                return RouteEndpoint(road_id, section_id, lane_id, offset, carla.Location(*point), edge)
         waypoint = self._wmap.get_waypoint(location)
+        return RouteEndpoint(waypoint.road_id, waypoint.section_id, waypoint.lane_id, None,
+                             waypoint.transform.location, self._localize_waypoint(waypoint), waypoint)
+
+    def _endpoint_waypoint(self, endpoint):
+        """
+        The carla.Waypoint of a RouteEndpoint: the sampled waypoint of its edge closest
+        to it, picked the first time it is needed, without asking the map
+        """
+        if not isinstance(endpoint, RouteEndpoint):
+            return endpoint
+        if endpoint.waypoint is None:
+            edge = self._hydrate_edge(self._graph.edge(*endpoint.edge))
+            waypoints = [edge['entry_waypoint']] + edge['path'] + [edge['exit_waypoint']]
+            endpoint.waypoint = waypoints[self._find_closest_in_array(endpoint, self._path_locations(edge))]
+        return endpoint.waypoint
+
+    def _get_lane_index(self):
+        """
+        Lane index over the centre lines of the lane following edges,
+        rebuilt when the graph changes
+        """
+        if self._lane_index is None or self._lane_index_version != self._graph.version:
+            polylines = []
+            for _, _, edge in self._graph.edges():
+                if edge['type'] != RoadOption.LANEFOLLOW:
+                    continue
+                entry = edge['entry_waypoint']
+                if edge.get('hydrated', True):
+                    lane = (entry.road_id, entry.section_id, entry.lane_id)
+                else:
+                    lane = tuple(int(i) for i in entry[:3])
+                polylines.append((lane, self._path_locations(edge)))
+            self._lane_index = LaneIndex(polylines)
+            self._lane_index_version = self._graph.version
+        return self._lane_index
+
+    def _localize_waypoint(self, waypoint):
+        """
+        This function returns the edge of the road segment of a waypoint
+        """
         edge = None
         try:
             edge = self._road_id_to_edge[waypoint.road_id][waypoint.section_id][waypoint.lane_id]
@@ -275,15 +708,6 @@ class GlobalRoutePlanner(object):
             pass
         return edge
 
-    def _distance_heuristic(self, n1, n2):
-        """
-        Distance heuristic calculator for path searching
-        in self._graph
-        """
-        l1 = np.array(self._graph.nodes[n1]['vertex'])
-        l2 = np.array(self._graph.nodes[n2]['vertex'])
-        return np.linalg.norm(l1-l2)
-
     def _path_search(self, origin, destination):
         """
         This function finds the shortest path connecting origin and destination
@@ -293,11 +717,13 @@ class GlobalRoutePlanner(object):
         return      :   path as list of node ids (as int) of the graph self._graph
         connecting origin and destination
         """
-        start, end = self._localize(origin), self._localize(destination)
+        return self._search(self._localize(origin), self._localize(destination))
 
-        route = nx.astar_path(
-            self._graph, source=start[0], target=end[0],
-            heuristic=self._distance_heuristic, weight='length')
+    def _search(self, start, end):
+        """
+        This function finds the path of node ids from the start to the end edge
+        """
+        route = self._graph.astar_path(start[0], end[0], weight='length')
         route.append(end[1])
         return route
 
@@ -312,7 +738,7 @@ class GlobalRoutePlanner(object):
         last_intersection_edge = None
         last_node = None
         for node1, node2 in [(route[i], route[i+1]) for i in range(index, len(route)-1)]:
-            candidate_edge = self._graph.edges[node1, node2]
+            candidate_edge = self._graph.edge(node1, node2)
             if node1 == route[index]:
                 last_intersection_edge = candidate_edge
             if candidate_edge['type'] == RoadOption.LANEFOLLOW and candidate_edge['intersection']:
@@ -333,7 +759,7 @@ class GlobalRoutePlanner(object):
         previous_node = route[index-1]
         current_node = route[index]
         next_node = route[index+1]
-        next_edge = self._graph.edges[current_node, next_node]
+        next_edge = self._graph.edge(current_node, next_node)
         if index > 0:
             if self._previous_decision != RoadOption.VOID \
                     and self._intersection_end_node > 0 \
@@ -343,7 +769,7 @@ class GlobalRoutePlanner(object):
                 decision = self._previous_decision
             else:
                 self._intersection_end_node = -1
-                current_edge = self._graph.edges[previous_node, current_node]
+                current_edge = self._graph.edge(previous_node, current_node)
                 calculate_turn = current_edge['type'] == RoadOption.LANEFOLLOW and not current_edge[
                     'intersection'] and next_edge['type'] == RoadOption.LANEFOLLOW and next_edge['intersection']
                 if calculate_turn:
@@ -356,12 +782,12 @@ class GlobalRoutePlanner(object):
                         return next_edge['type']
                     cross_list = []
                     for neighbor in self._graph.successors(current_node):
-                        select_edge = self._graph.edges[current_node, neighbor]
+                        select_edge = self._graph.edge(current_node, neighbor)
                         if select_edge['type'] == RoadOption.LANEFOLLOW:
                             if neighbor != route[index+1]:
                                 sv = select_edge['net_vector']
-                                cross_list.append(np.cross(cv, sv)[2])
-                    next_cross = np.cross(cv, nv)[2]
+                                cross_list.append(_cross_z(cv, sv))
+                    next_cross = _cross_z(cv, nv)
                     deviation = math.acos(np.clip(
                         np.dot(cv, nv)/(np.linalg.norm(cv)*np.linalg.norm(nv)), -1.0, 1.0))
                     if not cross_list:
@@ -385,6 +811,32 @@ class GlobalRoutePlanner(object):
         self._previous_decision = decision
         return decision
 
+    def _path_locations(self, edge):
+        """
+        This method returns the locations of the entry waypoint, path and exit
+        waypoint of an edge as an (n, 3) array, computed once per edge
+        """
+        locations = edge.get('path_locations')
+        if locations is None and not edge.get('hydrated', True):
+            # Still serialized, the locations are stored next to the identifiers
+            _, _, xyz = edge['path']
+            locations = np.vstack([edge['entry_waypoint'][4:], xyz, edge['exit_waypoint'][4:]])
+            edge['path_locations'] = locations
+        elif locations is None:
+            waypoints = [edge['entry_waypoint']] + edge['path'] + [edge['exit_waypoint']]
+            locations = np.array([(l.x, l.y, l.z) for l in (w.transform.location for w in waypoints)],
+                                 dtype=np.float64)
+            edge['path_locations'] = locations
+        return locations
+
+    def _find_closest_in_array(self, current_waypoint, locations):
+        """
+        Index of the location closest to the waypoint, the first one on ties
+        """
+        location = current_waypoint.transform.location
+        offsets = locations - (location.x, location.y, location.z)
+        return int(np.argmin(np.einsum('ij,ij->i', offsets, offsets)))
+
     def _find_closest_in_list(self, current_waypoint, waypoint_list):
         min_distance = float('inf')
         closest_index = -1
@@ -396,3 +848,30 @@ class GlobalRoutePlanner(object):
                 closest_index = i
 
         return closest_index
+
+
+def _encode_waypoint(waypoint):
+    """
+    OpenDRIVE identifiers and location of a waypoint, as stored in the graph cache
+    """
+    location = waypoint.transform.location
+    return (waypoint.road_id, waypoint.section_id, waypoint.lane_id, waypoint.s,
+            location.x, location.y, location.z)
+
+
+def _encode_path(path):
+    """
+    Path of waypoints as (road, section, lane) ids, s and location arrays
+    """
+    encoded = [_encode_waypoint(waypoint) for waypoint in path]
+    ids = np.array([w[:3] for w in encoded], dtype=np.int32).reshape(-1, 3)
+    s = np.array([w[3] for w in encoded], dtype=np.float64)
+    xyz = np.array([w[4:] for w in encoded], dtype=np.float64).reshape(-1, 3)
+    return ids, s, xyz
+
+
+def _cross_z(v1, v2):
+    """
+    z component of the cross product of two vectors, without the overhead of np.cross
+    """
+    return v1[0] * v2[1] - v1[1] * v2[0]
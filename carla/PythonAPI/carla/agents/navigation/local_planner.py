@@ -7,6 +7,8 @@
 
 from enum import IntEnum
 from collections import deque
+import bisect
+import math
 import random
 
 import carla
@@ -28,6 +30,112 @@ class RoadOption(IntEnum):
     CHANGELANERIGHT = 6
 
 
+class Trajectory(object):
+    """
+    Arc-length parameterised copy of the waypoint queue of a LocalPlanner.
+
+    Keeps x, y, z and s (distance along the trajectory) of the queued waypoints,
+    a cursor at the first waypoint still in the queue and the segment the vehicle
+    was last projected on. Every step the vehicle is projected on the few segments
+    around that one only, so following the plan needs no carla.Waypoint access
+    and costs the same whatever the length of the plan. carla.Waypoint has no
+    speed limit, the speed limits are still read from the vehicle.
+
+    A window of 2 segments covers twice the sampling resolution of travel per
+    step, e.g. 4 m, 40 m/s at 10 Hz with the default 2 m. A vehicle moving
+    farther than that in one step, fast at a low tick rate, is followed by
+    extending the window for as long as the projection keeps getting closer.
+    """
+
+    def __init__(self, window=2):
+        self._x, self._y, self._z, self._s = [], [], [], []
+        self.cursor = 0
+        self.segment = 0  # Index of the first point of the segment the vehicle was last projected on
+        self.window = window  # Segments past that one the vehicle is projected on
+
+    def __len__(self):
+        return len(self._s) - self.cursor
+
+    def clear(self):
+        self._x, self._y, self._z, self._s = [], [], [], []
+        self.cursor = 0
+        self.segment = 0
+
+    def append(self, waypoint):
+        """
+        Adds a waypoint at the end of the trajectory
+        """
+        location = waypoint.transform.location
+        s = 0.0
+        if self._s:
+            s = self._s[-1] + math.sqrt((location.x - self._x[-1]) ** 2 + (location.y - self._y[-1]) ** 2 +
+                                        (location.z - self._z[-1]) ** 2)
+        self._x.append(location.x)
+        self._y.append(location.y)
+        self._z.append(location.z)
+        self._s.append(s)
+
+    def advance(self, steps=1):
+        self.cursor = min(len(self._s), self.cursor + steps)
+        # Forgets the points both the queue and the vehicle are well past
+        passed = min(self.cursor, self.segment)
+        if passed > 1024:
+            for values in (self._x, self._y, self._z, self._s):
+                del values[:passed]
+            self.cursor -= passed
+            self.segment -= passed
+
+    def project(self, x, y, z):
+        """
+        Projects (x, y, z) on the segments from the one before the last projection to `window`
+        segments past it. Returns the distance along the trajectory of the projection and the
+        distance to it, (None, None) if there is no segment to project on. Before the start
+        of the trajectory, the distance along it is negative.
+        """
+        xs, ys, zs, ss = self._x, self._y, self._z, self._s
+        best = None
+        i = max(self.segment - 1, 0)
+        end = min(self.segment + self.window + 1, len(ss) - 1)
+        while i < end:
+            dx, dy, dz = xs[i + 1] - xs[i], ys[i + 1] - ys[i], zs[i + 1] - zs[i]
+            ox, oy, oz = x - xs[i], y - ys[i], z - zs[i]
+            length = dx * dx + dy * dy + dz * dz
+            t = (ox * dx + oy * dy + oz * dz) / length if length > 0 else 0.0
+            if i > 0 or t > 0:
+                t = min(max(t, 0.0), 1.0)
+            gx, gy, gz = ox - t * dx, oy - t * dy, oz - t * dz
+            gap = gx * gx + gy * gy + gz * gz
+            if best is None or gap < best[0]:
+                best = (gap, i, ss[i] + t * (ss[i + 1] - ss[i]))
+            i += 1
+            if i == end and best[1] == end - 1 and end < len(ss) - 1:
+                # Still closing in at the end of the window, the vehicle moved past it since the last step
+                end += 1
+        if best is None:
+            return None, None
+        self.segment = best[1]
+        return best[2], math.sqrt(best[0])
+
+    def count_before(self, s):
+        """
+        Number of pending waypoints before s along the trajectory
+        """
+        return bisect.bisect_left(self._s, s, self.cursor) - self.cursor
+
+    def position(self, index):
+        """
+        Distance along the trajectory of the index-th pending waypoint
+        """
+        return self._s[self.cursor + index]
+
+    def distance(self, index, x, y, z):
+        """
+        Distance from (x, y, z) to the index-th pending waypoint
+        """
+        i = self.cursor + index
+        return math.sqrt((self._x[i] - x) ** 2 + (self._y[i] - y) ** 2 + (self._z[i] - z) ** 2)
+
+
 class LocalPlanner(object):
     """
     LocalPlanner implements the basic behavior of following a
@@ -71,6 +179,8 @@ class LocalPlanner(object):
         self.target_road_option = None
 
         self._waypoints_queue = deque(maxlen=10000)
+        # Locations of the queued waypoints, kept in sync with the queue
+        self._trajectory = Trajectory()
         self._min_waypoint_queue_length = 100
         self._stop_waypoint_creation = False
 
@@ -136,6 +246,7 @@ class LocalPlanner(object):
         current_waypoint = self._map.get_waypoint(self._vehicle.get_location())
         self.target_waypoint, self.target_road_option = (current_waypoint, RoadOption.LANEFOLLOW)
         self._waypoints_queue.append((self.target_waypoint, self.target_road_option))
+        self._trajectory.append(self.target_waypoint)
 
     def set_speed(self, speed):
         """
@@ -161,6 +272,8 @@ class LocalPlanner(object):
     def _compute_next_waypoints(self, k=1):
         """
         Add new waypoints to the trajectory queue.
+        Only used when roaming: a global plan stops the waypoint creation, so no
+        waypoint is asked to the map while following one.
 
         :param k: how many waypoints to compute
         :return:
@@ -188,6 +301,7 @@ class LocalPlanner(object):
                     road_option)]
 
             self._waypoints_queue.append((next_waypoint, road_option))
+            self._trajectory.append(next_waypoint)
 
     def set_global_plan(self, current_plan, stop_waypoint_creation=True, clean_queue=True, draw=False):
         """
@@ -202,6 +316,7 @@ class LocalPlanner(object):
         """
         if clean_queue:
             self._waypoints_queue.clear()
+            self._trajectory.clear()
 
         # Remake the waypoints queue if the new plan has a higher length than the queue
         new_plan_length = len(current_plan) + len(self._waypoints_queue)
@@ -213,6 +328,7 @@ class LocalPlanner(object):
 
         for elem in current_plan:
             self._waypoints_queue.append(elem)
+            self._trajectory.append(elem[0])
 
         if draw:
             for wp in self._waypoints_queue:
@@ -241,31 +357,50 @@ class LocalPlanner(object):
         if not self._stop_waypoint_creation and len(self._waypoints_queue) < self._min_waypoint_queue_length:
             self._compute_next_waypoints(k=self._min_waypoint_queue_length)
 
-        # Purge the queue of obsolete waypoints
+        # Purge the queue of obsolete waypoints: the first ones within min_distance of the vehicle
         veh_location = self._vehicle.get_location()
+        vx, vy, vz = veh_location.x, veh_location.y, veh_location.z
         vehicle_speed = get_speed(self._vehicle) / 3.6
         self._min_distance = self._base_min_distance + self._distance_ratio * vehicle_speed
 
         num_waypoint_removed = 0
-        for waypoint, _ in self._waypoints_queue:
-
-            if len(self._waypoints_queue) - num_waypoint_removed == 1:
-                # Don't remove the last waypoint until very close by
-                if self._offset is not None:
-                    min_distance = abs(self._offset) + 1 
-                else:
-                    min_distance = 1
-            else:
-                min_distance = self._min_distance
-
-            if veh_location.distance(waypoint.transform.location) < min_distance:
+        queue_length = len(self._waypoints_queue)
+        vehicle_s, off_plan = self._trajectory.project(vx, vy, vz)
+        # Don't remove the last waypoint until very close by
+        last = queue_length - 1
+        if vehicle_s is not None and off_plan < self._min_distance and queue_length > 0 and \
+                self._trajectory.position(0) > vehicle_s - self._min_distance:
+            # The waypoints within min_distance along the plan are about the ones within min_distance
+            # of the vehicle. The chord distance of the first one and of the ones around that count
+            # settles it: the queue is purged up to the first waypoint at min_distance or more
+            num_waypoint_removed = min(self._trajectory.count_before(vehicle_s + self._min_distance), last)
+            if num_waypoint_removed > 0 and self._trajectory.distance(0, vx, vy, vz) >= self._min_distance:
+                num_waypoint_removed = 0
+            while num_waypoint_removed > 0 and \
+                    self._trajectory.distance(num_waypoint_removed - 1, vx, vy, vz) >= self._min_distance:
+                num_waypoint_removed -= 1
+            while num_waypoint_removed < last and \
+                    self._trajectory.distance(num_waypoint_removed, vx, vy, vz) < self._min_distance:
+                num_waypoint_removed += 1
+        else:
+            # Away from the plan, e.g. before reaching its start, or the queue lags behind the vehicle:
+            # only the waypoints around the vehicle are passed
+            while num_waypoint_removed < last and \
+                    self._trajectory.distance(num_waypoint_removed, vx, vy, vz) < self._min_distance:
                 num_waypoint_removed += 1
+
+        if num_waypoint_removed == queue_length - 1 and queue_length > 0:
+            if self._offset is not None:
+                min_distance = abs(self._offset) + 1 
             else:
-                break
+                min_distance = 1
+            if self._trajectory.distance(num_waypoint_removed, vx, vy, vz) < min_distance:
+                num_waypoint_removed += 1
 
         if num_waypoint_removed > 0:
             for _ in range(num_waypoint_removed):
                 self._waypoints_queue.popleft()
+            self._trajectory.advance(num_waypoint_removed)
 
         # Get the target waypoint and move using the PID controllers. Stop if no target waypoint
         if len(self._waypoints_queue) == 0:
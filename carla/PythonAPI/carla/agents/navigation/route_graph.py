@@ -0,0 +1,336 @@
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+
+"""
+This module provides the array-backed directed graph and the lane index
+used by the GlobalRoutePlanner.
+"""
+
+import heapq
+import itertools
+import math
+import numpy as np
+
+
+class NoRouteError(Exception):
+    """
+    Raised when there is no path between two nodes of a RouteGraph
+    """
+
+
+class RouteGraph(object):
+    """
+    Directed graph of the road network.
+
+    Nodes keep their id (any hashable, e.g. the negative ids of loose ends)
+    and are indexed densely in insertion order. Edges keep a dictionary of
+    attributes, as networkx does. Searches run on a compressed sparse row
+    (CSR) copy of the adjacency: `indptr`, `indices` and `weights` arrays
+    plus the node coordinates, compiled on the first search after the graph
+    changes.
+    """
+
+    def __init__(self):
+        self._index = dict()  # Map with structure {node id: index, ... }
+        self._ids = []
+        self._vertices = []
+        self._adjacency = []  # Per node index, {successor index: edge attributes} in insertion order
+        self._compiled = None
+        self.version = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, node):
+        return node in self._index
+
+    def add_node(self, node, vertex):
+        """
+        Adds a node located at vertex (x, y, z), or moves an existing one
+        """
+        if node in self._index:
+            self._vertices[self._index[node]] = tuple(vertex)
+        else:
+            self._index[node] = len(self._ids)
+            self._ids.append(node)
+            self._vertices.append(tuple(vertex))
+            self._adjacency.append(dict())
+        self._changed()
+
+    def add_edge(self, n1, n2, **attributes):
+        """
+        Adds an edge from n1 to n2. The attributes of an existing edge are updated, as in networkx.
+        """
+        for node in (n1, n2):
+            if node not in self._index:
+                raise KeyError("node %r is not in the graph" % (node,))
+        successors = self._adjacency[self._index[n1]]
+        i2 = self._index[n2]
+        if i2 in successors:
+            successors[i2].update(attributes)
+        else:
+            successors[i2] = attributes
+        self._changed()
+
+    def vertex(self, node):
+        return self._vertices[self._index[node]]
+
+    def nodes(self):
+        """
+        Iterates over (node, vertex)
+        """
+        return zip(self._ids, self._vertices)
+
+    def edge(self, n1, n2):
+        """
+        Attributes of the edge from n1 to n2
+        """
+        try:
+            return self._adjacency[self._index[n1]][self._index[n2]]
+        except KeyError:
+            raise KeyError("edge %r -> %r is not in the graph" % (n1, n2))
+
+    def edges(self):
+        """
+        Iterates over (n1, n2, attributes)
+        """
+        for i1, successors in enumerate(self._adjacency):
+            for i2, attributes in successors.items():
+                yield self._ids[i1], self._ids[i2], attributes
+
+    def successors(self, node):
+        return [self._ids[i] for i in self._adjacency[self._index[node]]]
+
+    def _changed(self):
+        self._compiled = None
+        self.version += 1
+
+    def compile(self, weight='length'):
+        """
+        Builds the CSR arrays of the graph for the weight attribute
+        """
+        if self._compiled is not None and self._compiled['weight'] == weight:
+            return self._compiled
+        indptr = np.zeros(len(self._ids) + 1, dtype=np.int64)
+        indices = []
+        weights = []
+        for i, successors in enumerate(self._adjacency):
+            indptr[i + 1] = indptr[i] + len(successors)
+            for j, attributes in successors.items():
+                indices.append(j)
+                weights.append(attributes[weight])
+        coordinates = np.array(self._vertices, dtype=np.float64).reshape(-1, 3)
+        self._compiled = {
+            'weight': weight,
+            'indptr': indptr,
+            'indices': np.array(indices, dtype=np.int32),
+            'weights': np.array(weights, dtype=np.float64),
+            'coordinates': coordinates,
+            # Plain lists are faster than arrays for the element-wise access of the search
+            'rows': [list(zip(indices[indptr[i]:indptr[i + 1]], weights[indptr[i]:indptr[i + 1]]))
+                     for i in range(len(self._ids))],
+        }
+        return self._compiled
+
+    def astar_path(self, source, target, weight='length'):
+        """
+        Shortest path from source to target as a list of node ids, using A*
+        with the euclidean distance between the nodes as heuristic.
+        Expands the nodes in the same order as networkx.astar_path.
+        """
+        if source not in self._index or target not in self._index:
+            raise NoRouteError("either %r or %r is not in the graph" % (source, target))
+        compiled = self.compile(weight)
+        rows = compiled['rows']
+        vertices = self._vertices
+        source, target = self._index[source], self._index[target]
+        tx, ty, tz = vertices[target]
+        sqrt = math.sqrt
+
+        counter = itertools.count()
+        queue = [(0, next(counter), source, 0, None)]
+        enqueued = {}
+        explored = {}
+        while queue:
+            _, __, current, distance, parent = heapq.heappop(queue)
+            if current == target:
+                path = [current]
+                node = parent
+                while node is not None:
+                    path.append(node)
+                    node = explored[node]
+                path.reverse()
+                return [self._ids[i] for i in path]
+            if current in explored:
+                # A node reached through a cheaper path is not expanded again
+                if explored[current] is None:
+                    continue
+                queued_cost, _ = enqueued[current]
+                if queued_cost < distance:
+                    continue
+            explored[current] = parent
+            for neighbor, cost in rows[current]:
+                new_cost = distance + cost
+                if neighbor in enqueued:
+                    queued_cost, h = enqueued[neighbor]
+                    if queued_cost <= new_cost:
+                        continue
+                else:
+                    x, y, z = vertices[neighbor]
+                    h = sqrt((x - tx) * (x - tx) + (y - ty) * (y - ty) + (z - tz) * (z - tz))
+                enqueued[neighbor] = new_cost, h
+                heapq.heappush(queue, (new_cost + h, next(counter), neighbor, new_cost, current))
+        raise NoRouteError("node %r is not reachable from %r" % (self._ids[target], self._ids[source]))
+
+    def shortest_paths(self, source, targets, weight='length'):
+        """
+        Shortest paths from source to every target, as {target: list of node ids},
+        from a single Dijkstra search stopped once every target is reached
+        """
+        if source not in self._index:
+            raise NoRouteError("%r is not in the graph" % (source,))
+        for target in targets:
+            if target not in self._index:
+                raise NoRouteError("%r is not in the graph" % (target,))
+        rows = self.compile(weight)['rows']
+        source = self._index[source]
+        pending = set(self._index[target] for target in targets)
+
+        parents = {source: None}
+        settled = set()
+        distances = {source: 0}
+        queue = [(0, source)]
+        while queue and pending:
+            distance, current = heapq.heappop(queue)
+            if current in settled:
+                continue
+            settled.add(current)
+            pending.discard(current)
+            for neighbor, cost in rows[current]:
+                new_cost = distance + cost
+                if neighbor not in distances or new_cost < distances[neighbor]:
+                    distances[neighbor] = new_cost
+                    parents[neighbor] = current
+                    heapq.heappush(queue, (new_cost, neighbor))
+        if pending:
+            raise NoRouteError("%s not reachable from %r" % (
+                ', '.join(repr(self._ids[i]) for i in pending), self._ids[source]))
+
+        paths = dict()
+        for target in targets:
+            node = self._index[target]
+            path = []
+            while node is not None:
+                path.append(self._ids[node])
+                node = parents[node]
+            path.reverse()
+            paths[target] = path
+        return paths
+
+    def to_networkx(self):
+        """
+        Copy of the graph as a networkx.DiGraph, networkx is only needed here
+        """
+        import networkx as nx
+        graph = nx.DiGraph()
+        for node, vertex in self.nodes():
+            graph.add_node(node, vertex=vertex)
+        for n1, n2, attributes in self.edges():
+            graph.add_edge(n1, n2, **attributes)
+        return graph
+
+
+class LaneIndex(object):
+    """
+    Grid index of the lane polylines of a road network, to localize points
+    on the client side instead of asking the map.
+
+    Every polyline is split into its segments, kept in parallel arrays with
+    the key of their lane and the distance along the polyline at which they
+    start. The segments are bucketed in square cells, a query checks the cells
+    around the point and returns the key of the closest segment in 3D, so
+    stacked roads do not mix.
+    """
+
+    def __init__(self, polylines, cell_size=10.0):
+        """
+        :param polylines: iterable of (key, (n, 3) array of locations)
+        :param cell_size: side of the grid cells, in meters
+        """
+        self.cell_size = cell_size
+        self.keys = []
+        starts, ends, owners, offsets = [], [], [], []
+        for key, locations in polylines:
+            locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+            if len(locations) < 2:
+                continue
+            starts.append(locations[:-1])
+            ends.append(locations[1:])
+            owners.append(np.full(len(locations) - 1, len(self.keys), dtype=np.int32))
+            lengths = np.sqrt(np.einsum('ij,ij->i', locations[1:] - locations[:-1], locations[1:] - locations[:-1]))
+            offsets.append(np.concatenate([[0.0], np.cumsum(lengths)[:-1]]))
+            self.keys.append(key)
+        self.starts = np.concatenate(starts) if starts else np.zeros((0, 3))
+        self.ends = np.concatenate(ends) if ends else np.zeros((0, 3))
+        self.owners = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int32)
+        self.offsets = np.concatenate(offsets) if offsets else np.zeros(0)
+        self.directions = self.ends - self.starts
+        lengths = np.einsum('ij,ij->i', self.directions, self.directions)
+        # Degenerate segments are points, their projection is their start
+        self.inverse_lengths = np.divide(1.0, lengths, out=np.zeros_like(lengths), where=lengths > 0)
+
+        cells = dict()
+        low = np.floor(np.minimum(self.starts, self.ends)[:, :2] / cell_size).astype(np.int64)
+        high = np.floor(np.maximum(self.starts, self.ends)[:, :2] / cell_size).astype(np.int64)
+        for segment in range(len(self.starts)):
+            for i in range(low[segment, 0], high[segment, 0] + 1):
+                for j in range(low[segment, 1], high[segment, 1] + 1):
+                    cells.setdefault((i, j), []).append(segment)
+        self.cells = dict((cell, np.array(segments, dtype=np.int64)) for cell, segments in cells.items())
+
+    def nearest(self, x, y, z, max_distance=50.0):
+        """
+        Key of the closest polyline to (x, y, z) and the distance to it,
+        (None, inf) if there is none within max_distance
+        """
+        key, distance, _, _ = self.locate(x, y, z, max_distance)
+        return key, distance
+
+    def locate(self, x, y, z, max_distance=50.0):
+        """
+        Key of the closest polyline to (x, y, z), the distance to it, the distance
+        along it to the projection of the point and the projected (x, y, z).
+        (None, inf, None, None) if there is none within max_distance
+        """
+        best_segment, best_t = None, None
+        ci, cj = int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+        rings = int(math.ceil(max_distance / self.cell_size))
+        best_key, best_distance = None, float('inf')
+        for ring in range(rings + 1):
+            candidates = [self.cells[(i, j)]
+                          for i in range(ci - ring, ci + ring + 1)
+                          for j in range(cj - ring, cj + ring + 1)
+                          if max(abs(i - ci), abs(j - cj)) == ring and (i, j) in self.cells]
+            if candidates:
+                segments = np.unique(np.concatenate(candidates))
+                point = np.array((x, y, z))
+                offsets = point - self.starts[segments]
+                t = np.clip(np.einsum('ij,ij->i', offsets, self.directions[segments])
+                            * self.inverse_lengths[segments], 0.0, 1.0)
+                gaps = offsets - t[:, None] * self.directions[segments]
+                distances = np.einsum('ij,ij->i', gaps, gaps)
+                closest = int(np.argmin(distances))
+                if distances[closest] < best_distance * best_distance:
+                    best_distance = math.sqrt(distances[closest])
+                    best_segment, best_t = segments[closest], t[closest]
+                    best_key = self.keys[self.owners[best_segment]]
+            # Anything in the next ring is at least this far away
+            if best_key is not None and best_distance <= ring * self.cell_size:
+                break
+        if best_distance > max_distance:
+            return None, float('inf'), None, None
+        direction = self.directions[best_segment]
+        offset = float(self.offsets[best_segment] + best_t * math.sqrt(direction.dot(direction)))
+        point = tuple((self.starts[best_segment] + best_t * direction).tolist())
+        return best_key, best_distance, offset, point
@@ -0,0 +1,131 @@
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+
+"""
+This module provides the per-frame world state shared by the navigation
+agents, so that N agents fetch the actors of the world once per frame.
+"""
+
+import math
+import weakref
+
+from agents.navigation.actor_batch import ActorBatch
+
+
+class WorldState(object):
+    """
+    Actors of a world at one frame: the vehicle, walker and traffic light
+    lists, and the transforms and velocities of the actors, read at most
+    once. The returned transforms and velocities are shared, copy them
+    before modifying them.
+    """
+
+    def __init__(self, world, frame, bounding_boxes):
+        self.frame = frame
+        actors = world.get_actors()
+        self.vehicles = actors.filter("*vehicle*")
+        self.walkers = actors.filter("*walker.pedestrian*")
+        self.traffic_lights = actors.filter("*traffic_light*")
+        # More boxes than vehicles and walkers means some belong to destroyed actors, drop them
+        if len(bounding_boxes) > len(self.vehicles) + len(self.walkers):
+            alive = set(actor.id for actor in self.vehicles)
+            alive.update(actor.id for actor in self.walkers)
+            for actor_id in [actor_id for actor_id in bounding_boxes if actor_id not in alive]:
+                del bounding_boxes[actor_id]
+        self._bounding_boxes = bounding_boxes
+        self._transforms = dict()  # Map with structure {actor id: carla.Transform, ... }
+        self._velocities = dict()  # Map with structure {actor id: carla.Vector3D, ... }
+        self._rows = dict()  # Map with structure {actor id: ActorBatch row, ... }
+        self._batches = dict()  # Map with structure {tuple of actor ids: ActorBatch, ... }
+
+    def get_transform(self, actor):
+        transform = self._transforms.get(actor.id)
+        if transform is None:
+            transform = self._transforms[actor.id] = actor.get_transform()
+        return transform
+
+    def get_location(self, actor):
+        return self.get_transform(actor).location
+
+    def get_velocity(self, actor):
+        velocity = self._velocities.get(actor.id)
+        if velocity is None:
+            velocity = self._velocities[actor.id] = actor.get_velocity()
+        return velocity
+
+    def get_speed(self, actor):
+        """
+        Speed of the actor in Km/h, as misc.get_speed
+        """
+        vel = self.get_velocity(actor)
+        return 3.6 * math.sqrt(vel.x ** 2 + vel.y ** 2 + vel.z ** 2)
+
+    def get_bounding_box(self, actor):
+        """
+        Bounding box of the actor, kept across frames as it does not change
+        """
+        bounding_box = self._bounding_boxes.get(actor.id)
+        if bounding_box is None:
+            bounding_box = self._bounding_boxes[actor.id] = actor.bounding_box
+        return bounding_box
+
+    def batch(self, actors):
+        """
+        ActorBatch of the actors, built once per frame for every list of actors
+        """
+        actors = list(actors)
+        ids = tuple(actor.id for actor in actors)
+        batch = self._batches.get(ids)
+        if batch is None:
+            batch = self._batches[ids] = ActorBatch(actors, [self._row(actor) for actor in actors])
+        return batch
+
+    def _row(self, actor):
+        row = self._rows.get(actor.id)
+        if row is None:
+            transform = self.get_transform(actor)
+            location = transform.location
+            forward = transform.get_forward_vector()
+            bounding_box = self.get_bounding_box(actor)
+            extent, offset = bounding_box.extent, bounding_box.location
+            # Radius around the actor location of a circle holding the whole bounding box
+            radius = math.sqrt(offset.x ** 2 + offset.y ** 2 + offset.z ** 2) + \
+                math.sqrt(extent.x ** 2 + extent.y ** 2 + extent.z ** 2)
+            row = self._rows[actor.id] = (location.x, location.y, location.z, forward.x, forward.y, extent.x, radius)
+        return row
+
+
+class WorldStateCache(object):
+    """
+    Keeps the WorldState of the current frame of a world. Agents share the
+    cache of their world by default, or the one given to them. A shared cache
+    is dropped once no agent uses it, e.g. after a map reload replaced its
+    world, while the caches of worlds still in use are kept.
+    """
+
+    _shared = weakref.WeakValueDictionary()  # Map with structure {world id: WorldStateCache, ... }
+
+    def __init__(self, world):
+        self._world = world
+        self._state = None
+        self._bounding_boxes = dict()
+
+    @classmethod
+    def for_world(cls, world):
+        """
+        Cache shared by every agent of the world
+        """
+        cache = cls._shared.get(world.id)
+        if cache is None:
+            cache = cls._shared[world.id] = cls(world)
+        return cache
+
+    def get(self):
+        """
+        WorldState of the current frame, fetched from the world on the first call of the frame
+        """
+        frame = self._world.get_snapshot().frame
+        if self._state is None or self._state.frame != frame:
+            self._state = WorldState(self._world, frame, self._bounding_boxes)
+        return self._state
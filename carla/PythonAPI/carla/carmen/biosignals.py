@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# Biosignal feature extraction module for CARMEn
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+
+# ==============================================================================
+# -- imports -------------------------------------------------------------------
+# ==============================================================================
+
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed')
+
+
+# ==============================================================================
+# -- Classes -------------------------------------------------------------------
+# ==============================================================================
+
+
+class RingBuffer(object):
+    """Fixed size float buffer holding the latest samples of one channel.
+
+    The buffer is split in blocks of `block` samples whose sum, sum of
+    squares, min and max are computed once, when the block is completed, so
+    the statistics over the whole buffer only rescan the block being written."""
+
+    def __init__(self, capacity, block=None):
+        self.capacity = int(capacity)
+        self.block = min(self.capacity, max(1, int(block))) if block else self.capacity
+        n_blocks = -(-self.capacity // self.block)
+        self.data = np.zeros(self.capacity)
+        self.sums = np.zeros(n_blocks)
+        self.squares = np.zeros(n_blocks)
+        self.mins = np.full(n_blocks, np.inf)
+        self.maxs = np.full(n_blocks, -np.inf)
+        self.index = 0
+        self.total = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=float)[-self.capacity:]
+        n = len(values)
+        start = self.index
+        end = start + n
+        if end <= self.capacity:
+            self.data[start:end] = values
+            self.total += n
+            self._complete(start, end)
+        else:
+            split = self.capacity - start
+            self.data[start:] = values[:split]
+            self.data[:n - split] = values[split:]
+            self.total += n
+            self._complete(start, self.capacity)
+            self._complete(0, n - split)
+        self.index = end % self.capacity
+
+    def _complete(self, start, end):
+        """Updates the blocks whose last sample was written in [start, end)"""
+        if end <= start:
+            return
+        for k in range(start // self.block, (end - 1) // self.block + 1):
+            if min((k + 1) * self.block, self.capacity) <= end:
+                self._aggregate(k)
+
+    def _aggregate(self, k):
+        x = self._block(k)
+        self.sums[k] = x.sum()
+        self.squares[k] = np.dot(x, x)
+        self.mins[k] = x.min()
+        self.maxs[k] = x.max()
+
+    def _block(self, k):
+        """Samples received so far in block k"""
+        filled = min(self.total, self.capacity)
+        return self.data[k * self.block:min((k + 1) * self.block, filled)]
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def statistics(self):
+        """Mean, standard deviation, min and max of the buffered samples"""
+        n = len(self)
+        if n == 0:
+            return None
+        # The block being written holds new and old samples, it is the only one rescanned
+        k = self.index // self.block
+        x = self._block(k)
+        total = self.sums.sum() - self.sums[k] + x.sum()
+        squares = self.squares.sum() - self.squares[k] + np.dot(x, x)
+        mean = total / n
+        std = np.sqrt(max(0.0, squares / n - mean * mean))
+        mins = np.delete(self.mins, k)
+        maxs = np.delete(self.maxs, k)
+        if len(x):
+            mins = np.append(mins, x.min())
+            maxs = np.append(maxs, x.max())
+        return float(mean), float(std), float(mins.min()), float(maxs.max())
+
+    def latest(self, n):
+        """Returns the last n samples (or less, if not received yet) in order"""
+        n = min(int(n), self.capacity, self.total)
+        start = self.index - n
+        if start >= 0:
+            return self.data[start:self.index]
+        return np.concatenate((self.data[start:], self.data[:self.index]))
+
+
+class HeartRateDetector(object):
+    """Simplified Pan-Tompkins run on the stream: low-pass, derivative,
+    squaring, moving integration and adaptive threshold. The filters keep
+    their state between calls, so every sample is filtered once."""
+
+    def __init__(self, sampling_rate, window, block=None):
+        self.sampling_rate = float(sampling_rate)
+        self.window = int(window)
+        self.smoothing = max(1, int(0.02 * self.sampling_rate))
+        self.integration = max(1, int(0.15 * self.sampling_rate))
+        self.energy = RingBuffer(self.window, block)
+        self._raw = np.zeros(0)
+        self._smoothed = np.zeros(0)
+        self._squared = np.zeros(0)
+        self._energy = np.zeros(0)
+        # Local maxima of the energy, at most one every other sample
+        self.peak_positions = RingBuffer(self.window // 2 + 1)
+        self.peak_energies = RingBuffer(self.window // 2 + 1)
+
+    def feed(self, ecg):
+        ecg = np.asarray(ecg, dtype=float)
+        if len(ecg) == 0:
+            return
+        smoothed = self._filter(ecg, '_raw', self.smoothing)
+        derivative = np.diff(np.concatenate((self._smoothed, smoothed)))
+        self._smoothed = smoothed[-1:]
+        energy = self._filter(derivative ** 2, '_squared', self.integration)
+        if len(energy) == 0:
+            return
+        # Candidates need one sample on each side, the last two are kept for the next call
+        candidates = np.concatenate((self._energy, energy))
+        first = self.energy.total - len(self._energy)
+        peaks = np.flatnonzero((candidates[1:-1] > candidates[:-2])
+                               & (candidates[1:-1] >= candidates[2:])) + 1
+        self.peak_positions.extend(first + peaks)
+        self.peak_energies.extend(candidates[peaks])
+        self._energy = candidates[-2:]
+        self.energy.extend(energy)
+
+    def _filter(self, x, history, width):
+        """Trailing moving average of x continuing the samples kept in `history`"""
+        previous = getattr(self, history)
+        x = np.concatenate((previous, x))
+        setattr(self, history, x[max(0, len(x) - width + 1):] if width > 1 else x[:0])
+        return moving_average(x, width)[len(previous):]
+
+    def heart_rate(self):
+        """Beats per minute over the window, None until two beats are found"""
+        fs = self.sampling_rate
+        if len(self.energy) < 2 * fs:
+            return None
+        threshold = 0.5 * self.energy.statistics()[3]
+        if threshold <= 0:
+            return None
+        # Refractory period of 250 ms between beats
+        refractory = 0.25 * fs
+        positions = self.peak_positions.latest(self.peak_positions.capacity)
+        energies = self.peak_energies.latest(self.peak_energies.capacity)
+        oldest = self.energy.total - len(self.energy)
+        beats = []
+        for peak in positions[(positions >= oldest) & (energies > threshold)]:
+            if not beats or peak - beats[-1] > refractory:
+                beats.append(peak)
+        if len(beats) < 2:
+            return None
+        return float(60.0 * fs / np.median(np.diff(beats)))
+
+
+class BiosignalFeatures(object):
+    """Computes live features over the acquisition stream of a BiosignalHub.
+
+    Channels are selected as (device, column) pairs of the OpenSignals
+    "returnData" samples, device None meaning the first device of the packet.
+    Every `hop` seconds of new samples the features are updated:
+        - heart_rate: beats per minute from the ECG R-peaks of the last `window` seconds
+        - eda_tonic: slow level of the EDA, a first-order low-pass with a time
+          constant of `tonic_window` seconds
+        - eda_phasic: fast response of the EDA, the latest sample minus the tonic level
+        - <channel>_mean/_std/_min/_max: statistics of every channel over the last `window` seconds
+    Samples are filtered and aggregated as they arrive, an update only reads
+    the running state. The time spent per update is checked against
+    `latency_budget` (seconds)."""
+
+    def __init__(self, sampling_rate=1000, ecg=None, eda=None, channels=None,
+                 window=5.0, hop=0.5, tonic_window=4.0, latency_budget=0.005):
+        self.sampling_rate = float(sampling_rate)
+        self.channels = dict(channels) if channels is not None else {}
+        if ecg is not None:
+            self.channels['ecg'] = ecg
+        if eda is not None:
+            self.channels['eda'] = eda
+        self.window = int(window * self.sampling_rate)
+        self.hop = max(1, int(hop * self.sampling_rate))
+        self.tonic_decay = np.exp(-1.0 / max(1.0, tonic_window * self.sampling_rate))
+        self.latency_budget = latency_budget
+        self.buffers = dict((name, RingBuffer(self.window, self.hop)) for name in self.channels)
+        self.detector = None
+        if 'ecg' in self.channels:
+            self.detector = HeartRateDetector(self.sampling_rate, self.window, self.hop)
+        self.tonic = None
+        # New samples since the last update, by device
+        self._pending = {}
+        # Replaced as a whole on every update, readers never see a partial dict
+        self.features = {}
+        self.windows = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.over_budget = 0
+
+    def feed(self, packet):
+        """BiosignalHub subscriber, buffers the packet and updates when due"""
+        data = packet.data
+        samples = {}
+        for name, (device, column) in self.channels.items():
+            if device is None:
+                device = next(iter(data), None)
+            if device not in data or not data[device]:
+                continue
+            if device not in samples:
+                samples[device] = np.asarray(data[device], dtype=float)
+                self._pending[device] = self._pending.get(device, 0) + len(samples[device])
+            values = samples[device]
+            values = values[:, column] if values.ndim > 1 else values
+            self.buffers[name].extend(values)
+            if name == 'ecg':
+                self.detector.feed(values)
+            elif name == 'eda':
+                self.tonic = low_pass(values, self.tonic_decay, self.tonic)
+        if self._pending and max(self._pending.values()) >= self.hop:
+            self._pending = {}
+            self.update()
+
+    def update(self):
+        t_start = time.perf_counter()
+        features = {}
+        for name, buffer in self.buffers.items():
+            statistics = buffer.statistics()
+            if statistics is None:
+                continue
+            for suffix, value in zip(('_mean', '_std', '_min', '_max'), statistics):
+                features[name + suffix] = value
+        if self.detector is not None:
+            features['heart_rate'] = self.detector.heart_rate()
+        if 'eda' in self.buffers:
+            tonic, phasic = self.eda_components()
+            features['eda_tonic'] = tonic
+            features['eda_phasic'] = phasic
+        self.features = features
+        self.windows += 1
+        self.latency = time.perf_counter() - t_start
+        self.max_latency = max(self.max_latency, self.latency)
+        if self.latency > self.latency_budget:
+            self.over_budget += 1
+
+    def eda_components(self):
+        """Tonic level of the low-pass and phasic response as the residual of
+        the latest sample over it"""
+        if self.tonic is None:
+            return None, None
+        latest = self.buffers['eda'].latest(1)
+        return float(self.tonic), float(latest[-1] - self.tonic)
+
+    def get_features(self):
+        return self.features
+
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+def parse_channel(spec):
+    """Parses a channel selector 'COLUMN' or 'DEVICE:COLUMN'"""
+    device, _, column = str(spec).rpartition(':')
+    return (device if device else None, int(column))
+
+
+def moving_average(x, width):
+    """Trailing moving average in O(n), the first samples average what is available"""
+    cumsum = np.cumsum(x)
+    result = cumsum.copy()
+    result[width:] -= cumsum[:-width]
+    return result / np.minimum(np.arange(1, len(x) + 1), width)
+
+
+def low_pass(x, decay, state=None):
+    """First-order low-pass y[k] = decay * y[k-1] + (1 - decay) * x[k] of the
+    new samples x, continuing from the last output `state` (or from x[0]).
+    Returns the last output, the filter is vectorised over chunks short
+    enough for decay ** -k to stay well conditioned"""
+    x = np.asarray(x, dtype=float)
+    if len(x) == 0:
+        return state
+    if state is None:
+        state = x[0]
+    if decay <= 0:
+        return x[-1]
+    chunk = max(1, int(6.0 / -np.log(decay)))
+    for start in range(0, len(x), chunk):
+        part = x[start:start + chunk]
+        powers = decay ** np.arange(len(part))
+        y = powers * (decay * state + (1 - decay) * np.cumsum(part / powers))
+        state = y[-1]
+    return state
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# Control log module for CARMEn
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Compact binary log of a CARMEn run and its deterministic replay.
+
+A log is the magic string followed by records of
+    kind (uint8), frame (uint32), simulation time (float64), payload
+where the payload is the fixed struct of the kind followed by its
+length-prefixed UTF-8 strings.
+"""
+
+
+# ==============================================================================
+# -- imports -------------------------------------------------------------------
+# ==============================================================================
+
+import carla
+
+import struct
+from collections import namedtuple
+
+
+MAGIC = b'CARMENLOG1'
+
+RUN_START = 1
+VEHICLE_CONTROL = 2
+WALKER_CONTROL = 3
+WALKER_LOCATION = 4
+SPAWN = 5
+CHECKPOINT = 6
+RUN_END = 7
+
+# kind -> (struct of the numeric fields, number of strings)
+RECORD_FORMATS = {
+    RUN_START: (struct.Struct('<IBB'), 1),          # seed, is_demo, pool_idx / player start
+    VEHICLE_CONTROL: (struct.Struct('<fffBBBb'), 0),  # throttle, steer, brake, hand_brake, reverse, manual, gear
+    WALKER_CONTROL: (struct.Struct('<ffffB'), 0),     # speed, direction x, y, z, jump
+    WALKER_LOCATION: (struct.Struct('<fff'), 0),      # x, y, z
+    SPAWN: (struct.Struct('<f'), 6),                # offset / checkpoint, start slot, end slot, model, color, direction
+    CHECKPOINT: (struct.Struct(''), 1),             # / checkpoint
+    RUN_END: (struct.Struct(''), 0),
+}
+
+CONTROLS = (VEHICLE_CONTROL, WALKER_CONTROL)
+
+# Replayed checkpoints may be reached this much later or earlier than logged, in seconds
+CHECKPOINT_TOLERANCE = 1e-3
+
+HEADER = struct.Struct('<BId')
+STRING_LENGTH = struct.Struct('<H')
+
+ControlRecord = namedtuple('ControlRecord', ['kind', 'frame', 'timestamp', 'values'])
+
+
+# ==============================================================================
+# -- Classes -------------------------------------------------------------------
+# ==============================================================================
+
+
+class ControlLogWriter(object):
+    """Appends the records of a run to a binary control log"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.records = 0
+
+    def write(self, kind, frame, timestamp, numbers=(), strings=()):
+        fmt, n_strings = RECORD_FORMATS[kind]
+        if len(strings) != n_strings:
+            raise ValueError('record %d takes %d strings' % (kind, n_strings))
+        chunks = [HEADER.pack(kind, frame, timestamp), fmt.pack(*numbers)]
+        for string in strings:
+            data = str(string).encode('utf-8')
+            chunks.append(STRING_LENGTH.pack(len(data)))
+            chunks.append(data)
+        self.file.write(b''.join(chunks))
+        self.records += 1
+
+    def log_run_start(self, frame, timestamp, seed, is_demo, pool_idx, player_start):
+        self.write(RUN_START, frame, timestamp, (seed, is_demo, pool_idx), (player_start,))
+
+    def log_control(self, frame, timestamp, control):
+        if isinstance(control, carla.VehicleControl):
+            self.write(VEHICLE_CONTROL, frame, timestamp,
+                       (control.throttle, control.steer, control.brake,
+                        control.hand_brake, control.reverse, control.manual_gear_shift, control.gear))
+        elif isinstance(control, carla.WalkerControl):
+            d = control.direction
+            self.write(WALKER_CONTROL, frame, timestamp, (control.speed, d.x, d.y, d.z, control.jump))
+
+    def log_walker_location(self, frame, timestamp, location):
+        self.write(WALKER_LOCATION, frame, timestamp, (location.x, location.y, location.z))
+
+    def log_spawn(self, frame, timestamp, checkpoint, start_slot, end_slot, offset, model, color, direction):
+        self.write(SPAWN, frame, timestamp, (offset,),
+                   (checkpoint, start_slot, end_slot, model, color, direction))
+
+    def log_checkpoint(self, frame, timestamp, checkpoint):
+        self.write(CHECKPOINT, frame, timestamp, (), (checkpoint,))
+
+    def log_run_end(self, frame, timestamp):
+        self.write(RUN_END, frame, timestamp)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            print('Logged %d control records to %s' % (self.records, self.path))
+
+
+
+class ControlLogReplay(object):
+    """Re-simulates a logged run in synchronous mode, as fast as the server steps.
+
+    Every logged control is applied for one step as long as the logged one:
+    up to the simulation time of the next logged control, so runs recorded
+    asynchronously, with variable steps, integrate the same trajectory. Controls
+    logged within the same frame replace each other without stepping. The spawn
+    decisions and random seed of the log are forced on the run, and the
+    checkpoints reached are checked against the logged ones (`mismatches`).
+    `on_frame(session, record)` is called after every step, e.g. to compute
+    new metrics from the re-simulated run."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = list(read_control_log(path))
+        self.start = next((r for r in self.records if r.kind == RUN_START), None)
+        if self.start is None:
+            raise ValueError('%s holds no run' % path)
+        self.spawns = dict((r.values[1], r) for r in self.records if r.kind == SPAWN)
+        self.frames = 0
+        self.checkpoints = []
+        self.mismatches = []
+
+    def fixed_delta(self):
+        """Median logged step, used for the last control and before the first one"""
+        times = [r.timestamp for r in self.records if r.kind in CONTROLS]
+        deltas = sorted(b - a for a, b in zip(times, times[1:]) if b > a)
+        return deltas[len(deltas) // 2] if deltas else 0.05
+
+    def step_deltas(self):
+        """Step of every logged control, in the order of the controls: the simulation time to the next one"""
+        times = [r.timestamp for r in self.records if r.kind in CONTROLS]
+        return [b - a for a, b in zip(times, times[1:])] + [self.fixed_delta()]
+
+    def logged_checkpoints(self):
+        """(name, seconds since the first control) of the logged checkpoints"""
+        first = next((r.timestamp for r in self.records if r.kind in CONTROLS), None)
+        if first is None:
+            return []
+        return [(r.values[0], r.timestamp - first) for r in self.records if r.kind == CHECKPOINT]
+
+    def check_checkpoints(self):
+        """Differences between the logged and the replayed checkpoints, as messages"""
+        logged = self.logged_checkpoints()
+        mismatches = []
+        for n in range(max(len(logged), len(self.checkpoints))):
+            if n >= len(self.checkpoints):
+                mismatches.append('checkpoint %s at %.3fs was not reached' % logged[n])
+            elif n >= len(logged):
+                mismatches.append('checkpoint %s at %.3fs was not logged' % self.checkpoints[n])
+            elif logged[n][0] != self.checkpoints[n][0] \
+                    or abs(logged[n][1] - self.checkpoints[n][1]) > CHECKPOINT_TOLERANCE:
+                mismatches.append('checkpoint %s at %.3fs replayed as %s at %.3fs'
+                                  % (logged[n] + self.checkpoints[n]))
+        return mismatches
+
+    def run(self, session, on_frame=None, record=False):
+        """Re-simulates the logged run, with record the HUD writes the state of
+        every replayed step to a CSV file as in a recorded live run"""
+        world = session.world
+        original_settings = world.get_settings()
+        settings = world.get_settings()
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = self.fixed_delta()
+        # Nothing is looked at in headless replays, spare the server rendering too
+        settings.no_rendering_mode = session.headless
+        world.apply_settings(settings)
+        seed, is_demo, pool_idx = self.start.values[:3]
+        deltas = iter(self.step_deltas())
+        self.frames = 0
+        self.checkpoints = []
+        try:
+            if not session.set_new_run(bool(is_demo), pool_idx, seed=seed, forced_spawns=self.spawns):
+                return 0
+            if record:
+                session.hud.create_write_file(session.subject, session.experiment, session.directory)
+            world.tick()
+            first_time = None
+            for record in self.records:
+                if record.kind == WALKER_LOCATION:
+                    session.player.set_location(carla.Location(*record.values))
+                elif record.kind in CONTROLS:
+                    session.player.apply_control(control_from_record(record))
+                    delta = next(deltas)
+                    if delta <= 0:
+                        # Replaced by a later control of the same frame
+                        continue
+                    if first_time is None:
+                        first_time = world.get_snapshot().timestamp.elapsed_seconds
+                    if delta != settings.fixed_delta_seconds:
+                        settings.fixed_delta_seconds = delta
+                        world.apply_settings(settings)
+                    world.tick()
+                    session.tick_run()
+                    if record:
+                        session.hud.record_step(session)
+                    self.frames += 1
+                    self.record_checkpoints(session, world.get_snapshot().timestamp.elapsed_seconds - first_time)
+                    if on_frame is not None:
+                        on_frame(session, record)
+                    if session.run.stop:
+                        break
+                elif record.kind == RUN_END:
+                    break
+        finally:
+            if record and session.hud.file is not None:
+                session.hud.file.close()
+            session.end_new_run()
+            world.apply_settings(original_settings)
+        print('Replayed %d frames of %s' % (self.frames, self.path))
+        self.mismatches = self.check_checkpoints()
+        for mismatch in self.mismatches:
+            print('Replay diverged: %s' % mismatch)
+        return self.frames
+
+    def record_checkpoints(self, session, elapsed):
+        """Adds the checkpoints passed in the last step to `checkpoints`"""
+        passed = set(name for name, _ in self.checkpoints)
+        for checkpoint in session.checkpoint_list or ():
+            if checkpoint.check and checkpoint.name not in passed:
+                self.checkpoints.append((checkpoint.name, elapsed))
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+
+def read_control_log(path):
+    """Yields the ControlRecords of a binary control log"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a CARMEn control log' % path)
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        kind, frame, timestamp = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        fmt, n_strings = RECORD_FORMATS[kind]
+        values = list(fmt.unpack_from(data, offset))
+        offset += fmt.size
+        for _ in range(n_strings):
+            length, = STRING_LENGTH.unpack_from(data, offset)
+            offset += STRING_LENGTH.size
+            values.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        yield ControlRecord(kind, frame, timestamp, tuple(values))
+
+
+def control_from_record(record):
+    """Rebuilds the carla control of a control record"""
+    v = record.values
+    if record.kind == VEHICLE_CONTROL:
+        return carla.VehicleControl(throttle=v[0], steer=v[1], brake=v[2], hand_brake=bool(v[3]),
+                                    reverse=bool(v[4]), manual_gear_shift=bool(v[5]), gear=v[6])
+    if record.kind == WALKER_CONTROL:
+        return carla.WalkerControl(carla.Vector3D(v[1], v[2], v[3]), v[0], bool(v[4]))
+    raise ValueError('record %d is not a control' % record.kind)
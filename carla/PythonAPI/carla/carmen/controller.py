@@ -13,8 +13,13 @@
 
 import carla
 
+import os
 import sys
 import math
+import time
+
+from collections import namedtuple
+from functools import lru_cache
 
 if sys.version_info >= (3, 0):
     from configparser import ConfigParser
@@ -58,14 +63,71 @@ except ImportError:
     raise RuntimeError('cannot import pygame, make sure pygame package is installed')
 
 
+# Device profiles: config file, default section and the entries every profile must map
+WHEEL_CONFIG = ('wheel_config.ini', 'GT DD Pro 8Nm Racing Wheel',
+                ('steering_wheel', 'throttle', 'brake', 'handbrake_down', 'handbrake_up',
+                 'manual_gear_shift', 'gear_down', 'gear_up', 'ad'))
+JOYSTICK_CONFIG = ('joystick_config.ini', 'Saitek Pro Flight X-56 Rhino Stick',
+                   ('long_speed', 'lateral_speed', 'turn_yaw'))
+
+# Looked up in order: $CARMEN_CONFIG_DIR, the carla root of this checkout, C:\carla
+CONFIG_DIRS = [os.environ.get('CARMEN_CONFIG_DIR', ''),
+               os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..')),
+               'C:\\carla']
+
+# Events routed to the HUD
+UI_EVENTS = (pygame.QUIT, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)
+# Events routed to the player control, axes are read once per frame instead
+DRIVING_EVENTS = (pygame.KEYUP, pygame.JOYBUTTONDOWN)
+# Everything else (axis, hat and mouse motion) is dropped by SDL before reaching the queue
+ALLOWED_EVENTS = UI_EVENTS + DRIVING_EVENTS + (
+    pygame.KEYDOWN, pygame.ACTIVEEVENT, pygame.VIDEORESIZE, pygame.VIDEOEXPOSE,
+    pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED)
+
+
 # ==============================================================================
 # -- Classes -------------------------------------------------------------------
 # ==============================================================================
 
 
+InputSample = namedtuple('InputSample', ['timestamp', 'axes'])
+
+
+class InputFilter(object):
+    """Deadzone and low-pass filter of the joystick axes.
+
+    SDL refreshes the axis state only when the main loop pumps the events, so
+    the axes are filtered when the control is applied, once per new pump: a
+    sample is stamped with the time of the pump it was read after, and
+    without a new pump the previous sample is returned unchanged instead of
+    a filler one. Axes inside `deadzone` are zeroed and the rest low-passed
+    with a first order filter at `cutoff` Hz (None disables it), using the
+    real time between pumps."""
+
+    def __init__(self, deadzone=0.0, cutoff=50.0):
+        self.deadzone = deadzone
+        self.cutoff = cutoff
+        self.latest = None
+        self.samples = 0
+
+    def update(self, axes, timestamp):
+        """Filters the axes read after the pump at timestamp, returns the InputSample"""
+        previous = self.latest
+        if previous is not None and timestamp <= previous.timestamp:
+            return previous
+        axes = [0.0 if abs(value) < self.deadzone else value for value in axes]
+        if previous is not None and self.cutoff is not None:
+            alpha = 1.0 - math.exp(-2.0 * math.pi * self.cutoff * (timestamp - previous.timestamp))
+            axes = [old + alpha * (value - old) for old, value in zip(previous.axes, axes)]
+        self.latest = InputSample(timestamp, tuple(axes))
+        self.samples += 1
+        return self.latest
+
+
+
 class CARMEnControler(object):
     
-    def __init__(self, start_in_autopilot, keyboard_control, joystick_control, walker_speed, walker_lateral_speed, walker_turn_speed):
+    def __init__(self, start_in_autopilot, keyboard_control, joystick_control, walker_speed, walker_lateral_speed, walker_turn_speed, input_cutoff=None, device=None):
 
         self._autopilot_enabled = start_in_autopilot
         self.keyboard_control = keyboard_control
@@ -105,27 +167,17 @@ class CARMEnControler(object):
                 self._joystickButtons = pygame.joystick.Joystick(0)
                 self._joystickButtons.init()
 
-                self._parser = ConfigParser()
-                self._parser.read(r'C:\carla\wheel_config.ini')
-
-                self._steer_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'steering_wheel'))
-                self._throttle_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'throttle'))
-                self._brake_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'brake'))
-                self._handbrake_down_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'handbrake_down'))
-                self._handbrake_up_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'handbrake_up'))
-                self._manual_gear_shift_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'manual_gear_shift'))
-                self._gear_down_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'gear_down'))
-                self._gear_up_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'gear_up'))
-                self._ad_idx = int(
-                    self._parser.get('GT DD Pro 8Nm Racing Wheel', 'ad'))
+                profile = get_device_profile(WHEEL_CONFIG, device, self._joystickAxes.get_name())
+                self._steer_idx = profile['steering_wheel']
+                self._throttle_idx = profile['throttle']
+                self._brake_idx = profile['brake']
+                self._handbrake_down_idx = profile['handbrake_down']
+                self._handbrake_up_idx = profile['handbrake_up']
+                self._manual_gear_shift_idx = profile['manual_gear_shift']
+                self._gear_down_idx = profile['gear_down']
+                self._gear_up_idx = profile['gear_up']
+                self._ad_idx = profile['ad']
+                self._axes = (self._steer_idx, self._throttle_idx, self._brake_idx)
             
             else:
                 if joystick_count > 1:
@@ -136,22 +188,27 @@ class CARMEnControler(object):
                 self._joystickButtons = pygame.joystick.Joystick(0)
                 self._joystickButtons.init()
 
-                self._parser = ConfigParser()
-                self._parser.read(r'C:\carla\joystick_config.ini')
-
-                JOYSTICK_MODEL = 'Saitek Pro Flight X-56 Rhino Stick'
-                #JOYSTICK_MODEL = 'Xbox One For Windows'
-
-                self._speed_idx = int(
-                    self._parser.get(JOYSTICK_MODEL, 'long_speed'))
-                self._lat_speed_idx = int(
-                    self._parser.get(JOYSTICK_MODEL, 'lateral_speed'))
-                self._turn_yaw_idx = int(
-                    self._parser.get(JOYSTICK_MODEL, 'turn_yaw'))
+                profile = get_device_profile(JOYSTICK_CONFIG, device, self._joystickAxes.get_name())
+                self._speed_idx = profile['long_speed']
+                self._lat_speed_idx = profile['lateral_speed']
+                self._turn_yaw_idx = profile['turn_yaw']
+                self._axes = (self._speed_idx, self._lat_speed_idx, self._turn_yaw_idx)
             
         else:
             print("Keyboard control selected!")
 
+        # Optional low-pass of the axes, stepped by the real time between event pumps
+        self._input_filter = None
+        self._pump_time = time.time()
+        self.input_time = None
+        if input_cutoff and not self.keyboard_control:
+            self._input_filter = InputFilter(cutoff=input_cutoff)
+            print("Filtering inputs at %d Hz" % input_cutoff)
+
+        # Filter the queue once devices are registered, axis state is still updated on every pump
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(list(ALLOWED_EVENTS))
+
     def set_new_player_controller(self, session):
         
         if isinstance(session.player, carla.Vehicle):
@@ -168,115 +225,136 @@ class CARMEnControler(object):
         session.hud.notification("Press 'H' or '?' for help.", seconds=4.0)
 
 
-    def parse_events(self, session, clock, left_threshold=None, right_threshold=None, checkpoints=None):
-        for event in pygame.event.get():
-            for b in session.hud.buttons:
-                if session.run is None or b.text.value == "        Stop Run":
-                    b.on_click(event, lambda: session.hud.button_pressed(b))
-                    b.on_release(event, lambda: session.hud.button_released(b, session, self))
-            for opt in session.hud.opts:
-                if session.run is None:
-                    opt.activate(event)
-                    opt.on_change(event, lambda: session.hud.option_changed(opt))
-            if event.type == pygame.QUIT or self.end_session:
-                return True
-            #if event.type == pygame.JOYBUTTONDOWN and session.run is not None:
-            #    if abs(event.dict['value']) > 0.1:
-            #        print(f"Axis: {event.dict['axis']} = {event.dict['value']}")
-            if event.type == pygame.JOYBUTTONDOWN and session.run is not None:
-                if session.run.stop:
-                    break
-                #elif event.button == 0:
-                #    session.restart()
-                #elif event.button == 1:
-                #    session.hud.toggle_info()
-                #elif event.button == 2:
-                #    session.camera_manager.toggle_camera()
-                #elif event.button == 3:
-                #    session.next_weather()
-                if isinstance(self._control, carla.VehicleControl):
-                    if event.button == self._manual_gear_shift_idx:
-                        self._control.manual_gear_shift = not self._control.manual_gear_shift
-                        self._control.gear = session.player.get_control().gear
-                        session.hud.notification('%s Transmission' %
-                                                ('Manual' if self._control.manual_gear_shift else 'Automatic'))
-                    elif self._control.manual_gear_shift and event.button == self._gear_down_idx:
-                        self._control.gear = max(-1, self._control.gear - 1)
-                    elif self._control.manual_gear_shift and event.button == self._gear_up_idx:
-                        self._control.gear = self._control.gear + 1
-                    elif not self._control.manual_gear_shift and event.button == self._gear_up_idx and self._control.reverse:
-                        self._control.gear = 1
-                    elif not self._control.manual_gear_shift and event.button == self._gear_down_idx and not self._control.reverse:
-                        self._control.gear = -1
-                    elif event.button == 23:
-                        session.camera_manager.next_sensor()        
-                    elif event.button == self._handbrake_down_idx:
-                        self._control.hand_brake = False
-                    elif event.button == self._handbrake_up_idx:
-                        self._control.hand_brake = True
-                    elif event.button == self._ad_idx:
-                        self._autopilot_enabled = not self._autopilot_enabled
-                        session.player.set_autopilot(self._autopilot_enabled)
-                        session.hud.notification('Autopilot %s' % ('On' if self._autopilot_enabled else 'Off'))
-
-            elif event.type == pygame.KEYUP and session.run is not None:
-                #print("keyboard")
-                if session.run.stop:
-                    break
-                elif self._is_quit_shortcut(event.key):
+    def parse_events(self, session, clock, left_threshold=None, right_threshold=None, checkpoints=None, apply=True):
+        for event in self._get_events():
+            if event.type in UI_EVENTS:
+                if event.type == pygame.QUIT:
                     return True
-                #elif event.key == K_BACKSPACE:
-                #    session.restart()
-                #elif event.key == K_F1:
-                #    session.hud.toggle_info()
-                #elif event.key == K_h or (event.key == K_SLASH and pygame.key.get_mods() & KMOD_SHIFT):
-                #    session.hud.help.toggle()
-                #elif event.key == K_TAB:
-                #    session.camera_manager.toggle_camera()
-                #elif event.key == K_c and pygame.key.get_mods() & KMOD_SHIFT:
-                #    session.next_weather(reverse=True)
-                #elif event.key == K_c:
-                #    session.next_weather()
-                #elif event.key == K_BACKQUOTE:
-                #    session.camera_manager.next_sensor()
-                #elif event.key > K_0 and event.key <= K_9:
-                #    session.camera_manager.set_sensor(event.key - 1 - K_0)
-                #elif event.key == K_r:
-                #    session.camera_manager.toggle_recording()
-                if isinstance(self._control, carla.VehicleControl):
-                    if event.key == K_q:
-                        self._control.gear = 1 if self._control.reverse else -1
-                    elif event.key == K_m:
-                        self._control.manual_gear_shift = not self._control.manual_gear_shift
-                        self._control.gear = session.player.get_control().gear
-                        session.hud.notification('%s Transmission' %
-                                            ('Manual' if self._control.manual_gear_shift else 'Automatic'))
-                    elif self._control.manual_gear_shift and event.key == K_COMMA:
-                        self._control.gear = max(-1, self._control.gear - 1)
-                    elif self._control.manual_gear_shift and event.key == K_PERIOD:
-                        self._control.gear = self._control.gear + 1
-                    elif event.key == K_p:
-                        self._autopilot_enabled = not self._autopilot_enabled
-                        session.player.set_autopilot(self._autopilot_enabled)
-                        session.hud.notification('Autopilot %s' % ('On' if self._autopilot_enabled else 'Off'))
-                    elif event.key == K_PAGEDOWN:
-                        self._control.hand_brake = False
-                    elif event.key == K_PAGEUP:
-                        self._control.hand_brake = True
+                session.hud.dispatch(event, session, self)
+            if self.end_session:
+                return True
+            if event.type not in DRIVING_EVENTS or session.run is None:
+                continue
+            if session.run.stop:
+                break
+            if event.type == pygame.JOYBUTTONDOWN:
+                self._parse_joy_button(event, session)
+            elif self._is_quit_shortcut(event.key):
+                return True
+            else:
+                self._parse_key(event, session)
 
+        if apply:
+            self.apply_control(session, clock, left_threshold, right_threshold)
+
+    def apply_control(self, session, clock, left_threshold=None, right_threshold=None):
+        """Reads the driving inputs and applies the control to the player"""
         if not self._autopilot_enabled and session.run is not None:
             if isinstance(self._control, carla.VehicleControl):
                 if self.keyboard_control:
                     self._parse_vehicle_keys(pygame.key.get_pressed(), clock.get_time())
                 else:
-                    self._parse_vehicle_wheel()
+                    self._parse_vehicle_wheel(self._read_axes())
                 self._control.reverse = self._control.gear < 0
             elif isinstance(self._control, carla.WalkerControl):
                 if self.keyboard_control:
                     self._parse_walker_keys(pygame.key.get_pressed(), clock.get_time(), session, self.walker_speed, self.walker_lateral_speed, self.walker_turn_speed, left_threshold, right_threshold)
                 else:
-                    self._parse_walker_joy(clock.get_time(), session, self.walker_speed, self.walker_lateral_speed, self.walker_turn_speed, left_threshold, right_threshold)
+                    self._parse_walker_joy(self._read_axes(), clock.get_time(), session, self.walker_speed, self.walker_lateral_speed, self.walker_turn_speed, left_threshold, right_threshold)
             session.player.apply_control(self._control)
+            if session.control_log is not None:
+                session.control_log.log_control(session.hud.frame, session.hud.simulation_time, self._control)
+
+    def _get_events(self):
+        # Pumping also refreshes the axis state, the inputs are as recent as this
+        events = pygame.event.get()
+        self._pump_time = time.time()
+        return events
+
+    def _read_axes(self):
+        """Value of the mapped axes by axis index, as of the last event pump"""
+        axes = [float(self._joystickAxes.get_axis(i)) for i in self._axes]
+        if self._input_filter is not None:
+            sample = self._input_filter.update(axes, self._pump_time)
+            self.input_time = sample.timestamp
+            return dict(zip(self._axes, sample.axes))
+        self.input_time = self._pump_time
+        return dict(zip(self._axes, axes))
+
+    def _parse_joy_button(self, event, session):
+        #if event.button == 0:
+        #    session.restart()
+        #elif event.button == 1:
+        #    session.hud.toggle_info()
+        #elif event.button == 2:
+        #    session.camera_manager.toggle_camera()
+        #elif event.button == 3:
+        #    session.next_weather()
+        if isinstance(self._control, carla.VehicleControl):
+            if event.button == self._manual_gear_shift_idx:
+                self._control.manual_gear_shift = not self._control.manual_gear_shift
+                self._control.gear = session.player.get_control().gear
+                session.hud.notification('%s Transmission' %
+                                        ('Manual' if self._control.manual_gear_shift else 'Automatic'))
+            elif self._control.manual_gear_shift and event.button == self._gear_down_idx:
+                self._control.gear = max(-1, self._control.gear - 1)
+            elif self._control.manual_gear_shift and event.button == self._gear_up_idx:
+                self._control.gear = self._control.gear + 1
+            elif not self._control.manual_gear_shift and event.button == self._gear_up_idx and self._control.reverse:
+                self._control.gear = 1
+            elif not self._control.manual_gear_shift and event.button == self._gear_down_idx and not self._control.reverse:
+                self._control.gear = -1
+            elif event.button == 23:
+                if session.camera_manager is not None:
+                    session.camera_manager.next_sensor()        
+            elif event.button == self._handbrake_down_idx:
+                self._control.hand_brake = False
+            elif event.button == self._handbrake_up_idx:
+                self._control.hand_brake = True
+            elif event.button == self._ad_idx:
+                self._autopilot_enabled = not self._autopilot_enabled
+                session.player.set_autopilot(self._autopilot_enabled)
+                session.hud.notification('Autopilot %s' % ('On' if self._autopilot_enabled else 'Off'))
+
+    def _parse_key(self, event, session):
+        #if event.key == K_BACKSPACE:
+        #    session.restart()
+        #elif event.key == K_F1:
+        #    session.hud.toggle_info()
+        #elif event.key == K_h or (event.key == K_SLASH and pygame.key.get_mods() & KMOD_SHIFT):
+        #    session.hud.help.toggle()
+        #elif event.key == K_TAB:
+        #    session.camera_manager.toggle_camera()
+        #elif event.key == K_c and pygame.key.get_mods() & KMOD_SHIFT:
+        #    session.next_weather(reverse=True)
+        #elif event.key == K_c:
+        #    session.next_weather()
+        #elif event.key == K_BACKQUOTE:
+        #    session.camera_manager.next_sensor()
+        #elif event.key > K_0 and event.key <= K_9:
+        #    session.camera_manager.set_sensor(event.key - 1 - K_0)
+        #elif event.key == K_r:
+        #    session.camera_manager.toggle_recording()
+        if isinstance(self._control, carla.VehicleControl):
+            if event.key == K_q:
+                self._control.gear = 1 if self._control.reverse else -1
+            elif event.key == K_m:
+                self._control.manual_gear_shift = not self._control.manual_gear_shift
+                self._control.gear = session.player.get_control().gear
+                session.hud.notification('%s Transmission' %
+                                    ('Manual' if self._control.manual_gear_shift else 'Automatic'))
+            elif self._control.manual_gear_shift and event.key == K_COMMA:
+                self._control.gear = max(-1, self._control.gear - 1)
+            elif self._control.manual_gear_shift and event.key == K_PERIOD:
+                self._control.gear = self._control.gear + 1
+            elif event.key == K_p:
+                self._autopilot_enabled = not self._autopilot_enabled
+                session.player.set_autopilot(self._autopilot_enabled)
+                session.hud.notification('Autopilot %s' % ('On' if self._autopilot_enabled else 'Off'))
+            elif event.key == K_PAGEDOWN:
+                self._control.hand_brake = False
+            elif event.key == K_PAGEUP:
+                self._control.hand_brake = True
 
     def _parse_vehicle_keys(self, keys, milliseconds):
         self._control.throttle = 1.0 if keys[K_UP] or keys[K_w] else 0.0
@@ -293,13 +371,8 @@ class CARMEnControler(object):
         self._control.hand_brake = keys[K_SPACE]
 
 
-    def _parse_vehicle_wheel(self):
-        numAxes = self._joystickAxes.get_numaxes()
-        jsInputs = [float(self._joystickAxes.get_axis(i)) for i in range(numAxes)]
+    def _parse_vehicle_wheel(self, jsInputs):
         #print (jsInputs)
-        jsButtons = [float(self._joystickButtons.get_button(i)) for i in
-                     range(self._joystickButtons.get_numbuttons())]
-        #print (jsButtons)
 
         # Custom function to map range of inputs [1, -1] to outputs [0, 1] i.e 1 from inputs means nothing is pressed
         # For the steering, it seems fine as it is
@@ -368,6 +441,8 @@ class CARMEnControler(object):
             pos_new = carla.Location(pos.x + v_right.x, pos.y + v_right.y, pos.z + v_right.z)
             # Apply new position
             session.player.set_location(pos_new)
+            if session.control_log is not None:
+                session.control_log.log_walker_location(session.hud.frame, session.hud.simulation_time, pos_new)
         
         # Get Front Speed Button
         if keys[K_w]:
@@ -377,7 +452,7 @@ class CARMEnControler(object):
         self._rotation.yaw = round(self._rotation.yaw, 1)
         self._control.direction = self._rotation.get_forward_vector()
 
-    def _parse_walker_joy(self, milliseconds, session, walking_speed=1.6, lateral_speed=0.8, turn_speed=0.08, left_threshold=None, right_threshold=None):
+    def _parse_walker_joy(self, jsInputs, milliseconds, session, walking_speed=1.6, lateral_speed=0.8, turn_speed=0.08, left_threshold=None, right_threshold=None):
 
         # Pedestrian is stopped by default
         self._control.speed = 0.0
@@ -386,10 +461,6 @@ class CARMEnControler(object):
         if session.run.stop:
             return
         
-        # Get Joystick Axis
-        numAxes = self._joystickAxes.get_numaxes()
-        jsInputs = [float(self._joystickAxes.get_axis(i)) for i in range(numAxes)]
-
         # Remove Analog Stick Noise
         noise_threshold = 0.1
         
@@ -445,6 +516,8 @@ class CARMEnControler(object):
             pos_new = carla.Location(pos.x + v_right.x, pos.y + v_right.y, pos.z + v_right.z)
             # Apply new position
             session.player.set_location(pos_new)
+            if session.control_log is not None:
+                session.control_log.log_walker_location(session.hud.frame, session.hud.simulation_time, pos_new)
         
         # Get Front Speed Axis
         if jsInputs[self._speed_idx] > 0:
@@ -458,3 +531,69 @@ class CARMEnControler(object):
     @staticmethod
     def _is_quit_shortcut(key):
         return (key == K_ESCAPE) or (key == K_q and pygame.key.get_mods() & KMOD_CTRL)
+
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+
+def find_device_config(filename):
+    for directory in CONFIG_DIRS:
+        path = os.path.join(directory, filename)
+        if directory and os.path.isfile(path):
+            return path
+    raise IOError('cannot find %s, set CARMEN_CONFIG_DIR to its directory' % filename)
+
+
+@lru_cache(maxsize=None)
+def load_device_profiles(path, mtime):
+    """Parses every section of a device config once per file version into
+    {section: {entry: index}}. Sections are not validated here, an incomplete
+    one only matters if it is selected (see check_device_profile)"""
+    parser = ConfigParser()
+    parser.read(path)
+    profiles = {}
+    for section in parser.sections():
+        profile = {}
+        for key, value in parser.items(section):
+            try:
+                profile[key] = int(value)
+            except ValueError:
+                # Kept as text, reported if the profile is used
+                profile[key] = value
+        profiles[section] = profile
+    return profiles
+
+
+def check_device_profile(path, section, profile, required):
+    """Raises if the selected profile has an entry which is not an index or misses a required one"""
+    for key, value in profile.items():
+        if not isinstance(value, int):
+            raise ValueError('%s [%s] %s: %r is not an index' % (path, section, key, value))
+    missing = [key for key in required if key not in profile]
+    if missing:
+        raise ValueError('%s [%s] does not map %s' % (path, section, ', '.join(missing)))
+    return profile
+
+
+def get_device_profile(config, device=None, joystick_name=None):
+    """Returns the profile of `device`, else of the section matching the name of
+    the connected joystick, else of the default section of the config. Only
+    the returned profile has to be complete"""
+    filename, default, required = config
+    path = find_device_config(filename)
+    profiles = load_device_profiles(path, os.path.getmtime(path))
+    if device is not None:
+        if device not in profiles:
+            raise ValueError('%s has no profile for %s (%s)' % (path, device, ', '.join(profiles)))
+        return check_device_profile(path, device, profiles[device], required)
+    if joystick_name:
+        name = joystick_name.lower()
+        for section, profile in profiles.items():
+            if section.lower() in name or name in section.lower():
+                return check_device_profile(path, section, profile, required)
+    if default not in profiles:
+        raise ValueError('%s has no profile for %s (%s)' % (path, default, ', '.join(profiles)))
+    return check_device_profile(path, default, profiles[default], required)
@@ -23,6 +23,9 @@ import os
 import math
 import datetime
 import csv
+import re
+
+from collections import OrderedDict, namedtuple
 
 try:
     import pygame          
@@ -30,50 +33,72 @@ except ImportError:
     raise RuntimeError('cannot import pygame, make sure pygame package is installed')
 
 
+# Button backgrounds, resolved from the PyGameWidgets package instead of the working directory
+BUTTON_IMAGE = os.path.join(core.GFX_DIR, 'bg1.bmp')
+BUTTON_PRESSED_IMAGE = os.path.join(core.GFX_DIR, 'bg0.bmp')
+
+# Biosignal features appended to the recorded data when the pipeline is enabled
+BIOSIGNAL_FEATURE_COLUMNS = ['heart_rate', 'eda_tonic', 'eda_phasic']
+
+# What the HUD renders of a simulation step: the info lines, the notification
+# surface and its remaining seconds. Published whole by CARMEnHUD.tick, so the
+# renderer never needs the simulation lock
+HUDFrame = namedtuple('HUDFrame', ['info', 'notification', 'notification_seconds'])
+
+
 # ==============================================================================
 # -- Classes -------------------------------------------------------------------
 # ==============================================================================
 
 
 class CARMEnHUD(object):
-    def __init__(self, width, height, doc, panel):
+    def __init__(self, width, height, doc, panel, biosignals=None, biosignal_features=None):
         self.dim = (width, height)
         font = pygame.font.Font(pygame.font.get_default_font(), 20)
         font_name = 'courier' if os.name == 'nt' else 'mono'
         fonts = [x for x in pygame.font.get_fonts() if font_name in x]
         default_font = 'ubuntumono'
-        mono = default_font if default_font in fonts else fonts[0]
-        mono = pygame.font.match_font(mono)
+        mono = default_font if default_font in fonts else (fonts[0] if fonts else None)
+        # Falls back to the pygame default font on hosts without a monospaced system font
+        mono = pygame.font.match_font(mono) if mono is not None else None
         self._font_mono = pygame.font.Font(mono, 12 if os.name == 'nt' else 14)
+        self._info_glyphs = GlyphAtlas(self._font_mono, (255, 255, 255))
+        self._info_background = pygame.Surface((220, height))
+        self._info_background.set_alpha(100)
         self._notifications = FadingText(font, (width, 40), (0, height - 40))
         self.help = HelpText(pygame.font.Font(mono, 24), width, height, doc)
         self.server_fps = 0
         self.frame = 0
         self.simulation_time = 0
         self._show_info = True
-        self._info_text = []
+        self._info_text = ()
+        self._frame = HUDFrame(self._info_text, self._notifications.surface, 0.0)
         self._server_clock = pygame.time.Clock()
+        # Dirty rect rendering: cached static layer and what is currently on screen
+        self._static_layer = None
+        self._static_info = self._show_info
+        self._drawn_lines = []
+        self._notification_shown = False
+        self._help_shown = False
         self.panel = panel
+        # Widgets are dispatched by command id, hit-tested through the panel grid
+        self.commands = CommandRegistry(panel)
         self.buttons = []
-        self.buttons.append( widgets.TextButton(panel, (0, 0), core.Text("   Connect Biosignals", 14)) )
-        self.buttons.append( widgets.TextButton(panel, (0, 7), core.Text("        Start Run", 14)) )
-        self.buttons.append( widgets.TextButton(panel, (0, 9), core.Text("       End Session", 14)) )
-        if self.buttons is not None:
-            for b in self.buttons:
-                b.set_image("../carla/PyGameWidgets/gfx/bg1.bmp")
+        self.add_button('connect_biosignals', (0, 0), "   Connect Biosignals", self.toggle_biosignals)
+        self.add_button('run', (0, 7), "        Start Run", self.toggle_run, active_in_run=True)
+        self.add_button('end_session', (0, 9), "       End Session", self.end_session)
         self.opts = []
-        self.opts.append( widgets.OptionChooser(panel, (0, 1), ["       Recording OFF", "       Recording ON"], 14) )
-        self.opts.append( widgets.OptionChooser(panel, (0, 2), ["        Real Trial", "          Demo"], 14) )
-        self.opts.append( widgets.OptionChooser(panel, (0, 3), ["        70% Front", "        70% Back"], 14) )
-        if self.opts is not None:
-            for opt in self.opts:
-                opt.set_span((0, 0))
-                opt.set_border(core.BLACK, 16)
-                #opt.text_color = core.RED
-                opt.bold = True
-                #opt.italic = True
-                opt.update_text()
-        self.biosignals_client = opensignals.OpenSignalsTCPClient()
+        self.add_option('recording', (0, 1), ["       Recording OFF", "       Recording ON"], self.set_recording)
+        self.add_option('trial_mode', (0, 2), ["        Real Trial", "          Demo"], self.set_trial_mode)
+        self.add_option('direction_pool', (0, 3), ["        70% Front", "        70% Back"], self.set_direction_pool)
+        # Single OpenSignals client by default, or a BiosignalHub fanning in several sources
+        self.biosignals_client = biosignals if biosignals is not None else opensignals.OpenSignalsTCPClient()
+        # Live features are computed on the hub merger thread
+        self.biosignal_features = biosignal_features
+        if self.biosignal_features is not None:
+            if not isinstance(self.biosignals_client, opensignals.BiosignalHub):
+                self.biosignals_client = opensignals.BiosignalHub([self.biosignals_client])
+            self.biosignals_client.subscribe(self.biosignal_features.feed)
         self.rec_biosignals = False
         self.file = None
         self.writer = None
@@ -89,15 +114,27 @@ class CARMEnHUD(object):
 
     def tick(self, session, clock, args):
         self._notifications.tick(session, clock)
-        if not self._show_info:
-            return
-        self._info_text = [
+        if self._show_info:
+            self._update_info(session, clock)
+        # Swapped in as a whole, the main thread renders it without the simulation lock
+        self._frame = HUDFrame(self._info_text, self._notifications.surface, self._notifications.seconds_left)
+
+    def _update_info(self, session, clock):
+        info = [
             'Server:  % 16.0f FPS' % self.server_fps,
             'Client:  % 16.0f FPS' % clock.get_fps(),
             '',
             'Map:     % 20s' % session.world.get_map().name.split('/')[-1],
             'Simulation time: % 12s' % datetime.timedelta(seconds=int(self.simulation_time)),
             '']
+        if self.biosignal_features is not None and self.rec_biosignals:
+            features = self.biosignal_features.get_features()
+            heart_rate = features.get('heart_rate')
+            info += [
+                'Heart rate: % 13s bpm' % ('--' if heart_rate is None else '%.0f' % heart_rate),
+                'EDA tonic:  % 17s' % ('--' if features.get('eda_tonic') is None else '%.2f' % features['eda_tonic']),
+                'EDA phasic: % 17s' % ('--' if features.get('eda_phasic') is None else '%.2f' % features['eda_phasic']),
+                '']
         if session.run is not None:
             t = session.player.get_transform()
             v = session.player.get_velocity()
@@ -115,7 +152,7 @@ class CARMEnHUD(object):
             ang_dev = session.ang_dev
             checkpoint = session.run.current_checkpoint
             spawn_direction = session.run.spawn_direction
-            self._info_text += [
+            info += [
                 'Vehicle: % 20s' % get_actor_display_name(session.player, truncate=20),
                 'Speed:   % 15.0f km/h' % (3.6 * math.sqrt(v.x**2 + v.y**2 + v.z**2)),
                 u'Heading:% 16.0f\N{DEGREE SIGN} % 2s' % (t.rotation.yaw, heading),
@@ -124,12 +161,12 @@ class CARMEnHUD(object):
                 'Height:  % 18.0f m' % t.location.z,
                 '']
             if session.lat_dev is not None and session.ang_dev is not None:
-                self._info_text += [
+                info += [
                 'Lat Deviation:   % 10.2f m' % lat_dev,
                 'Ang Deviation:   % 11.2f\N{DEGREE SIGN}' % ang_dev,
                 '']
             if isinstance(c, carla.VehicleControl):
-                self._info_text += [
+                info += [
                     ('Throttle:', c.throttle, 0.0, 1.0),
                     ('Steer:', c.steer, -1.0, 1.0),
                     ('Brake:', c.brake, 0.0, 1.0),
@@ -139,26 +176,25 @@ class CARMEnHUD(object):
                     'Gear:        %s' % {-1: 'R', 0: 'N'}.get(c.gear, c.gear)]
 
             elif isinstance(c, carla.WalkerControl):
-                self._info_text += [
+                info += [
                     ('Speed:', c.speed, 0.0, 5.556)]
 
-            self._info_text += [
+            info += [
                 '',
                 'Collision:',
                 collision,
                 '',
                 'Number of vehicles: % 8d' % len(vehicles)]
             if len(vehicles) > 0:
-                self._info_text += ['Nearby vehicles:']
-                distance = lambda l: math.sqrt((l.x - t.location.x)**2 + (l.y - t.location.y)**2 + (l.z - t.location.z)**2)
-                vehicles = [(distance(x.get_location()), x) for x in vehicles if x.id != session.player.id]
+                info += ['Nearby vehicles:']
+                vehicles = self.nearby_vehicles(session, t, vehicles)
                 for d, vehicle in sorted(vehicles):
                     if d > 200.0:
                         break
                     vehicle_type = get_actor_display_name(vehicle, truncate=22)
-                    self._info_text.append('% 4dm %s' % (d, vehicle_type))
+                    info.append('% 4dm %s' % (d, vehicle_type))
                 
-                self._info_text += [
+                info += [
                     'Current Checkpoint:',
                     checkpoint,
                     ('Spawn Direction: %s' % spawn_direction)]
@@ -166,6 +202,21 @@ class CARMEnHUD(object):
             if self.rec:
                 # write data
                 self.record_data(t, lat_dev, ang_dev, checkpoint, spawn_direction, vehicles)
+        self._info_text = tuple(info)
+
+    def record_step(self, session):
+        """Writes the state of the run, for replays which do not tick the HUD"""
+        t = session.player.get_transform()
+        vehicles = self.nearby_vehicles(session, t)
+        self.record_data(t, session.lat_dev, session.ang_dev, session.run.current_checkpoint,
+                         session.run.spawn_direction, vehicles)
+
+    def nearby_vehicles(self, session, t, vehicles=None):
+        """Returns [(distance, vehicle)] of the vehicles other than the player"""
+        if vehicles is None:
+            vehicles = session.world.get_actors().filter('vehicle.*')
+        distance = lambda l: math.sqrt((l.x - t.location.x)**2 + (l.y - t.location.y)**2 + (l.z - t.location.z)**2)
+        return [(distance(x.get_location()), x) for x in vehicles if x.id != session.player.id]
 
     def record_data(self, t, lat_dev, ang_dev, checkpoint='', spawn_direction='', vehicles=[]):
             # Getting the current date and time
@@ -208,6 +259,9 @@ class CARMEnHUD(object):
                 checkpoint, spawn_direction, 
                 _vehicle_name,
                 _v_distance, _v_locationX, _v_locationY, _v_locationZ]
+            if self.biosignal_features is not None:
+                features = self.biosignal_features.get_features()
+                data += [features.get(name) for name in BIOSIGNAL_FEATURE_COLUMNS]
             
             self.writer.writerow(data)
 
@@ -220,13 +274,57 @@ class CARMEnHUD(object):
     def error(self, text):
         self._notifications.set_text('Error: %s' % text, (255, 0, 0))
 
+    def add_button(self, command_id, position_in_grid, label, handler, active_in_run=False):
+        button = widgets.TextButton(self.panel, position_in_grid, core.Text(label, 14))
+        button.set_image(BUTTON_IMAGE)
+        self.buttons.append(button)
+        self.commands.register(command_id, button, handler, [(button.rect.R, None)], active_in_run)
+        return button
+
+    def add_option(self, command_id, position_in_grid, values, handler):
+        opt = widgets.OptionChooser(self.panel, position_in_grid, values)
+        opt.set_span((0, 0))
+        opt.set_border(core.BLACK, 16)
+        #opt.text_color = core.RED
+        opt.text_size = 14
+        opt.bold = True
+        #opt.italic = True
+        opt.update_text()
+        self.opts.append(opt)
+        targets = [(opt.previous_button.rect.R, opt.previous), (opt.forward_button.rect.R, opt.forward)]
+        self.commands.register(command_id, opt, handler, targets)
+        return opt
+
+    def dispatch(self, event, session, dualcontrol):
+        """Runs the command under a left click, once per mouse event"""
+        if event.type not in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP) or event.button != 1:
+            return False
+        hit = self.commands.hit_test(event.pos)
+        if hit is None:
+            return False
+        command, action = hit
+        # During a run only the commands that control the run are enabled
+        if session.run is not None and not command.active_in_run:
+            return False
+        if isinstance(command.widget, widgets.OptionChooser):
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                action()
+                command.handler(command.widget.index)
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            self.button_pressed(command.widget)
+        else:
+            self.button_released(command.widget)
+            command.handler(command.widget, session, dualcontrol)
+        return True
+
     def button_pressed(self, button):
-        if button.text.value != "           Armed!":
-            button.set_image("../carla/PyGameWidgets/gfx/bg0.bmp")
+        button.set_image(BUTTON_PRESSED_IMAGE)
 
-    def button_released(self, button, session, dualcontrol):
-        button.set_image("../carla/PyGameWidgets/gfx/bg1.bmp")
-        if button.text.value == "   Connect Biosignals":
+    def button_released(self, button):
+        button.set_image(BUTTON_IMAGE)
+
+    def toggle_biosignals(self, button, session, dualcontrol):
+        if not self.rec_biosignals:
             try:
                 self.biosignals_client.connect()
                 self.biosignals_client.start()
@@ -235,23 +333,25 @@ class CARMEnHUD(object):
                 print("SUCESS: Connected to Biosignals!")
             except:
                 print("ERROR: Could not connect to Biosignals! Check if socket is open!")
-        elif button.text.value == "   Disconnect Biosignals":
+        else:
             self.biosignals_client.stop()
             self.rec_biosignals = False
             button.set_text(core.Text("   Connect Biosignals", 14))
-        elif button.text.value == "        Start Run":
+
+    def toggle_run(self, button, session, dualcontrol):
+        if session.run is None:
             if self.rec:
                 print("Started Recording") 
                 self.create_write_file(session.subject, session.experiment, session.directory)
                 if self.rec_biosignals and not self.biosignals_client.isAcquiring:
                     self.biosignals_client.setIsAcquiring(True)
                     self.biosignals_client.addMsgToSend('start')
-                    while not self.biosignals_client.deviceStarted:
-                        pass
+                    if not self.biosignals_client.waitForDevice():
+                        print("WARNING: Biosignals did not start streaming!")
             if session.set_new_run(self.is_demo, self.pool_idx):
                 dualcontrol.set_new_player_controller(session)
                 button.set_text(core.Text("        Stop Run", 14))
-        elif button.text.value == "        Stop Run":
+        else:
             if self.rec:
                 print("Stopped Recording") 
                 self.file.close()
@@ -262,38 +362,31 @@ class CARMEnHUD(object):
             if session.end_new_run():
                 dualcontrol._control = None
                 button.set_text(core.Text("        Start Run", 14))
-        elif button.text.value == "       End Session":
-            if session.run is not None:
-                if session.end_new_run():
-                    dualcontrol._control = None
-            if self.rec_biosignals:
-                self.biosignals_client.setIsAcquiring(False)
-                self.biosignals_client.addMsgToSend('stop')
-                self.biosignals_client.deviceStarted = False
-            if self.rec and self.file is not None:
-                print("Stopped Recording") 
-                self.file.close()
-                #self.rec = False
-            session.destroy()
-            dualcontrol.end_session = True
-
-
-    def option_changed(self, option_choser):
-        if option_choser.current_value == "        70% Front":
-            self.pool_idx = 0
-        elif option_choser.current_value == "        70% Back":
-            self.pool_idx = 1
-        elif option_choser.current_value == "        Real Trial":
-            self.is_demo = False
-        elif option_choser.current_value == "          Demo":
-            self.is_demo = True
-        elif option_choser.current_value == "       Recording OFF":
-            self.rec = False
-            print("OFF!")
-        elif option_choser.current_value == "       Recording ON":
-            self.rec = True
-            print("ON!")
-            
+
+    def end_session(self, button, session, dualcontrol):
+        if session.run is not None:
+            if session.end_new_run():
+                dualcontrol._control = None
+        if self.rec_biosignals:
+            self.biosignals_client.setIsAcquiring(False)
+            self.biosignals_client.addMsgToSend('stop')
+            self.biosignals_client.deviceStarted = False
+        if self.rec and self.file is not None:
+            print("Stopped Recording") 
+            self.file.close()
+            #self.rec = False
+        session.destroy()
+        dualcontrol.end_session = True
+
+    def set_recording(self, index):
+        self.rec = index == 1
+        print("ON!" if self.rec else "OFF!")
+
+    def set_trial_mode(self, index):
+        self.is_demo = index == 1
+
+    def set_direction_pool(self, index):
+        self.pool_idx = index
 
     def create_write_file(self, subject, experiment, directory):
         date = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
@@ -310,6 +403,8 @@ class CARMEnHUD(object):
             'checkpoint', 'spawn_direction',  
             'vehicle_model',
             'vehicle_distance', 'vehicleX', 'vehicleY', 'vehicleZ']
+        if self.biosignal_features is not None:
+            header += BIOSIGNAL_FEATURE_COLUMNS
 
         # create the csv writer
         self.writer = csv.writer(self.file)
@@ -326,50 +421,203 @@ class CARMEnHUD(object):
 
 
     def render(self, display):
-        self.panel.draw(display)
-        if self.buttons is not None:
-            for b in self.buttons:
-                b.draw(display)
-        if self.opts is not None:
-            for opt in self.opts:
-                opt.draw(display)
+        """Redraws what changed since the last frame, returns the rects to update.
+        Only reads the last published HUDFrame and the widgets, which are
+        changed by the event handlers on the rendering thread"""
+        frame = self._frame
+        dirty = []
+        layer_dirty = self._static_layer is None or self._static_info != self._show_info
+        widgets_dirty = [w for w in self.buttons + self.opts if w.is_dirty()]
+        if layer_dirty or widgets_dirty or self.panel.is_dirty():
+            self._draw_static_layer()
+            if layer_dirty:
+                dirty.append(display.get_rect())
+            else:
+                dirty += [w.get_dirty_rect() for w in widgets_dirty]
+        # Info lines are compared with the ones on screen, the changed ones and the cleared ones are dirty
+        lines = self._layout_info(frame.info) if self._show_info else []
+        drawn = self._drawn_lines
+        for n in range(max(len(lines), len(drawn))):
+            if n >= len(lines) or n >= len(drawn) or lines[n] != drawn[n]:
+                if n < len(drawn):
+                    dirty.append(drawn[n][0])
+                if n < len(lines) and (n >= len(drawn) or lines[n][0] != drawn[n][0]):
+                    dirty.append(lines[n][0])
+        self._drawn_lines = lines
+        notification_rect = pygame.Rect(self._notifications.pos, self._notifications.dim)
+        notification_shown = frame.notification_seconds > 0
+        if notification_shown or self._notification_shown:
+            dirty.append(notification_rect)
+        self._notification_shown = notification_shown
+        help_rect = pygame.Rect(self.help.pos, self.help.dim)
+        if self.help._render != self._help_shown:
+            dirty.append(help_rect)
+            self._help_shown = self.help._render
+        if not dirty:
+            return []
+        for rect in dirty:
+            display.blit(self._static_layer, rect, rect)
+        for rect, item in lines:
+            if rect.collidelist(dirty) != -1:
+                self._draw_info_item(display, rect, item)
+        if notification_shown and notification_rect.collidelist(dirty) != -1:
+            self._notifications.render(display, frame.notification, frame.notification_seconds)
+        if self._help_shown and help_rect.collidelist(dirty) != -1:
+            self.help.render(display)
+        return dirty
+
+    def _draw_static_layer(self):
+        """Panel, widgets and info background, redrawn only when one of them changes"""
+        if self._static_layer is None:
+            self._static_layer = pygame.Surface(self.dim)
+        self.panel.draw(self._static_layer)
+        for b in self.buttons:
+            b.draw(self._static_layer)
+        for opt in self.opts:
+            opt.draw(self._static_layer)
         if self._show_info:
-            info_surface = pygame.Surface((220, self.dim[1]))
-            info_surface.set_alpha(100)
-            display.blit(info_surface, (0, 0))
-            h_offset = 220
-            v_offset = 4
-            bar_h_offset = 100
-            bar_width = 106
-            for item in self._info_text:
-                if v_offset + 18 > self.dim[1]:
-                    break
-                if isinstance(item, list):
-                    if len(item) > 1:
-                        points = [(h_offset + x + 8, v_offset + 8 + (1.0 - y) * 30) for x, y in enumerate(item)]
-                        pygame.draw.lines(display, (255, 136, 0), False, points, 2)
-                    item = None
-                    v_offset += 18
-                elif isinstance(item, tuple):
-                    if isinstance(item[1], bool):
-                        rect = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (6, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect, 0 if item[1] else 1)
-                    else:
-                        rect_border = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect_border, 1)
-                        f = (item[1] - item[2]) / (item[3] - item[2])
-                        if item[2] < 0.0:
-                            rect = pygame.Rect((h_offset + bar_h_offset + f * (bar_width - 6), v_offset + 8), (6, 6))
-                        else:
-                            rect = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (f * bar_width, 6))
-                        pygame.draw.rect(display, (255, 255, 255), rect)
-                    item = item[0]
-                if item:  # At this point has to be a str.
-                    surface = self._font_mono.render(item, True, (255, 255, 255))
-                    display.blit(surface, (h_offset + 8, v_offset))
+            self._static_layer.blit(self._info_background, (0, 0))
+        self._static_info = self._show_info
+        self._drawn_lines = []
+
+    def _layout_info(self, info):
+        """Returns the [(rect, item)] of the info lines that fit in the window"""
+        lines = []
+        h_offset = 220
+        v_offset = 4
+        width = self.dim[0] - h_offset
+        for item in info:
+            if v_offset + 18 > self.dim[1]:
+                break
+            if isinstance(item, list):
+                # The collision graph spills over the next line
+                lines.append((pygame.Rect(h_offset, v_offset, width, 40), item))
                 v_offset += 18
-        self._notifications.render(display)
-        self.help.render(display)
+            elif item:
+                lines.append((pygame.Rect(h_offset, v_offset, width, 18), item))
+            v_offset += 18
+        return lines
+
+    def _draw_info_item(self, display, rect, item):
+        h_offset, v_offset = rect.topleft
+        bar_h_offset = 100
+        bar_width = 106
+        if isinstance(item, list):
+            if len(item) > 1:
+                points = [(h_offset + x + 8, v_offset + 8 + (1.0 - y) * 30) for x, y in enumerate(item)]
+                pygame.draw.lines(display, (255, 136, 0), False, points, 2)
+            return
+        if isinstance(item, tuple):
+            if isinstance(item[1], bool):
+                bar = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (6, 6))
+                pygame.draw.rect(display, (255, 255, 255), bar, 0 if item[1] else 1)
+            else:
+                rect_border = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (bar_width, 6))
+                pygame.draw.rect(display, (255, 255, 255), rect_border, 1)
+                f = (item[1] - item[2]) / (item[3] - item[2])
+                if item[2] < 0.0:
+                    bar = pygame.Rect((h_offset + bar_h_offset + f * (bar_width - 6), v_offset + 8), (6, 6))
+                else:
+                    bar = pygame.Rect((h_offset + bar_h_offset, v_offset + 8), (f * bar_width, 6))
+                pygame.draw.rect(display, (255, 255, 255), bar)
+            item = item[0]
+        if item:  # At this point has to be a str.
+            self._info_glyphs.render(display, item, (h_offset + 8, v_offset))
+
+
+
+class CommandRegistry(object):
+    """Maps command ids to widgets and handlers, hit-tested through the panel grid"""
+
+    Command = namedtuple('Command', ['id', 'widget', 'handler', 'active_in_run'])
+
+    def __init__(self, panel):
+        self.cell_size = (panel.get_cell_width(), panel.get_cell_height())
+        self.commands = {}
+        # (column, row) -> [(rect, command, action)] of the targets overlapping the cell
+        self.cells = {}
+
+    def register(self, command_id, widget, handler, targets, active_in_run=False):
+        if command_id in self.commands:
+            raise ValueError('command %s is already registered' % command_id)
+        command = self.Command(command_id, widget, handler, active_in_run)
+        self.commands[command_id] = command
+        for rect, action in targets:
+            for cell in self.cells_of(rect):
+                self.cells.setdefault(cell, []).append((rect, command, action))
+        return command
+
+    def cells_of(self, rect):
+        w, h = self.cell_size
+        for column in range(int(rect.left // w), int((rect.right - 1) // w) + 1):
+            for row in range(int(rect.top // h), int((rect.bottom - 1) // h) + 1):
+                yield (column, row)
+
+    def hit_test(self, pos):
+        """Returns (command, action) of the target under pos, or None"""
+        cell = (int(pos[0] // self.cell_size[0]), int(pos[1] // self.cell_size[1]))
+        for rect, command, action in self.cells.get(cell, ()):
+            if rect.collidepoint(pos):
+                return command, action
+        return None
+
+    def get(self, command_id):
+        return self.commands.get(command_id)
+
+
+
+class GlyphAtlas(object):
+    """Draws info lines of a monospaced font from pre-rendered pieces.
+
+    Lines are split in numeric runs and text runs (labels, units), each drawn
+    with a single blit at its fixed character cell. Numeric runs are composed
+    from one rasterised surface per glyph, text runs are rendered once; both
+    are kept in an LRU cache, so a changing value costs no font rendering."""
+
+    NUMERIC = '0123456789.,:+-'
+    RUNS = re.compile(r'[0-9.,:+\-]+|[^0-9.,:+\-]+')
+
+    def __init__(self, font, color, max_pieces=512):
+        self.font = font
+        self.color = color
+        self.advance = font.size('0')[0]
+        self.height = font.get_linesize()
+        self.glyphs = {}
+        self.pieces = OrderedDict()
+        self.max_pieces = max_pieces
+
+    def glyph(self, char):
+        surface = self.glyphs.get(char)
+        if surface is None:
+            surface = self.font.render(char, True, self.color)
+            self.glyphs[char] = surface
+        return surface
+
+    def piece(self, text):
+        surface = self.pieces.get(text)
+        if surface is not None:
+            self.pieces.move_to_end(text)
+            return surface
+        if text[0] in self.NUMERIC:
+            surface = pygame.Surface((len(text) * self.advance, self.height), pygame.SRCALPHA)
+            for n, char in enumerate(text):
+                # Cells do not overlap, copy the glyph instead of blending it
+                surface.blit(self.glyph(char), (n * self.advance, 0), special_flags=pygame.BLEND_RGBA_MAX)
+        else:
+            surface = self.font.render(text, True, self.color)
+        self.pieces[text] = surface
+        if len(self.pieces) > self.max_pieces:
+            self.pieces.popitem(last=False)
+        return surface
+
+    def render(self, display, text, pos):
+        x, y = pos
+        for run in self.RUNS.finditer(text):
+            value = run.group()
+            stripped = value.lstrip(' ')
+            if stripped:
+                start = run.start() + len(value) - len(stripped)
+                display.blit(self.piece(stripped.rstrip(' ')), (x + start * self.advance, y))
 
 
 
@@ -383,18 +631,23 @@ class FadingText(object):
 
     def set_text(self, text, color=(255, 255, 255), seconds=2.0):
         text_texture = self.font.render(text, True, color)
-        self.surface = pygame.Surface(self.dim)
+        # A new surface on every text, a published one is never drawn on again
+        surface = pygame.Surface(self.dim)
+        surface.fill((0, 0, 0, 0))
+        surface.blit(text_texture, (10, 11))
+        self.surface = surface
         self.seconds_left = seconds
-        self.surface.fill((0, 0, 0, 0))
-        self.surface.blit(text_texture, (10, 11))
 
     def tick(self, _, clock):
         delta_seconds = 1e-3 * clock.get_time()
         self.seconds_left = max(0.0, self.seconds_left - delta_seconds)
-        self.surface.set_alpha(500.0 * self.seconds_left)
 
-    def render(self, display):
-        display.blit(self.surface, self.pos)
+    def render(self, display, surface=None, seconds_left=None):
+        """Draws the given surface faded by its remaining seconds, by default the current one"""
+        if surface is None:
+            surface, seconds_left = self.surface, self.seconds_left
+        surface.set_alpha(500.0 * seconds_left)
+        display.blit(surface, self.pos)
 
 
 
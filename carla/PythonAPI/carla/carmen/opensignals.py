@@ -15,38 +15,83 @@ import json
 import threading
 import select
 import queue
+import collections
+import time
+import os
+import math
+import random
 import pandas as pd
 
 
 
+# Packet produced by every acquisition source: source name, arrival time
+# (time.time()) and the OpenSignals "returnData" dictionary (device -> samples)
+BiosignalPacket = collections.namedtuple('BiosignalPacket', ['source', 'timestamp', 'data'])
+
+
 # ==============================================================================
 # -- Classes -------------------------------------------------------------------
 # ==============================================================================
 
-class OpenSignalsTCPClient(object):
-    def __init__(self):
-        self.tcpIp = '127.0.0.1'
-        self.tcpPort = 5555
+class BiosignalSource(object):
+    """Acquisition source publishing BiosignalPackets, base of
+    OpenSignalsTCPClient and ReplaySource"""
+
+    def __init__(self, name, maxPackets=4096):
+        self.name = name
+        self.isChecking = False
+        self.isAcquiring = False
+        self.deviceStarted = False
+
+        # Data packets are handed to consumers (e.g. BiosignalHub) through a
+        # bounded deque: append/popleft are atomic, so the reader thread never
+        # waits on the consumer and a slow consumer only drops the oldest packets
+        self.packets = collections.deque(maxlen=maxPackets)
+        self.packetEvent = None
+
+    def waitForDevice(self, timeout=5.0):
+        """Waits until the device starts streaming, returns False on timeout"""
+        t_end = time.time() + timeout
+        while not self.deviceStarted:
+            if time.time() > t_end:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def pushPacket(self, data):
+        self.packets.append(BiosignalPacket(self.name, time.time(), data))
+        if self.packetEvent is not None:
+            self.packetEvent.set()
+
+
+class OpenSignalsTCPClient(BiosignalSource):
+    def __init__(self, tcpIp='127.0.0.1', tcpPort=5555, name=None, maxPackets=4096):
+        super().__init__(name if name is not None else '%s:%d' % (tcpIp, tcpPort), maxPackets)
+        self.tcpIp = tcpIp
+        self.tcpPort = tcpPort
         self.buffer_size = 99999
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.inputCheck = []
         self.outputCheck = []
-        self.isChecking = False
-        self.isAcquiring = False
         self.msgQueue = queue.Queue()
+        self.decoder = json.JSONDecoder()
+        self.recvBuffer = ''
 
         self.txtFile = SaveAcquisition()
 
-        self.deviceStarted = False
-
     def connect(self):
+        # A closed socket cannot be reused, create a new one on every connection
+        if self.socket.fileno() == -1:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.tcpIp, self.tcpPort))
-        self.outputCheck.append(self.socket)
+        self.inputCheck = []
+        self.outputCheck = []
+        self.recvBuffer = ''
         self.isChecking = True
 
     def start(self):
-        thread = threading.Thread(target=self.msgChecker)
+        thread = threading.Thread(target=self.msgChecker, name='opensignals-%s' % self.name)
         thread.daemon = True
         thread.start()
 
@@ -56,38 +101,48 @@ class OpenSignalsTCPClient(object):
 
     def msgChecker(self):
         while self.isChecking:
-            readable, writable, exceptional = select.select(self.inputCheck, self.outputCheck, self.inputCheck)
+            # The socket is only polled for writing while there are messages to
+            # send, otherwise select would return immediately and spin the CPU
+            try:
+                readable, writable, exceptional = select.select(self.inputCheck, self.outputCheck, self.inputCheck, 0.1)
+            except (OSError, ValueError):
+                # The socket was closed by stop()
+                break
             for s in readable:
-                message = s.recv(self.buffer_size)
+                try:
+                    message = s.recv(self.buffer_size)
+                except OSError:
+                    message = b''
+                if not message:
+                    print("Biosignal source %s closed the connection" % self.name)
+                    self.isChecking = False
+                    break
                 if not self.isAcquiring:
                     #print(message)
                     self.inputCheck = []
+                    self.recvBuffer = ''
                 else:
                     #print(message)
-                    message = json.loads(message)
-                    message = message["returnData"]
-                    if not self.txtFile.getHasHeader():
-                        newLine = json.dumps(message) + "\n"
-                        self.txtFile.addData(newLine)
-                    else:
-                        if not self.deviceStarted:
-                            self.deviceStarted = True
-                        dataframe = []
-                        for device in message.keys():
-                            try:
-                                dataframe.append(pd.DataFrame(message[device]))
-                            except:
-                                dataframe.append(pd.Series(message[device]))
-                        dataframe = pd.concat(dataframe, axis=1, ignore_index=True)
-                        for line in dataframe.values:
-                            self.txtFile.addData('\n')
-                            self.txtFile.addData(",".join([str(x) for x in line]))
+                    for message in self.decodeMessages(message):
+                        message = message["returnData"]
+                        if not self.txtFile.getHasHeader():
+                            newLine = json.dumps(message) + "\n"
+                            self.txtFile.addData(newLine)
+                        else:
+                            if not self.deviceStarted:
+                                self.deviceStarted = True
+                            self.pushPacket(message)
+                            if self.txtFile.isWriting():
+                                self.saveData(message)
 
             for s in writable:
                 try:
                     next_msg = self.msgQueue.get_nowait()
                 except queue.Empty:
-                    pass
+                    self.outputCheck = []
+                    # A message may have been queued while clearing the list
+                    if not self.msgQueue.empty():
+                        self.outputCheck = [self.socket]
                 else:
                     # print("send ")
                     self.socket.send(str(next_msg).encode())
@@ -95,6 +150,38 @@ class OpenSignalsTCPClient(object):
             for s in exceptional:
                 print("exceptional ", s)
 
+    def decodeMessages(self, data):
+        """Splits the received bytes in JSON messages, several messages may
+        arrive in one read and a message may be split across reads"""
+        self.recvBuffer += data.decode('utf-8')
+        messages = []
+        index = 0
+        length = len(self.recvBuffer)
+        while index < length:
+            while index < length and self.recvBuffer[index].isspace():
+                index += 1
+            if index == length:
+                break
+            try:
+                message, index = self.decoder.raw_decode(self.recvBuffer, index)
+            except ValueError:
+                break
+            messages.append(message)
+        self.recvBuffer = self.recvBuffer[index:]
+        return messages
+
+    def saveData(self, message):
+        dataframe = []
+        for device in message.keys():
+            try:
+                dataframe.append(pd.DataFrame(message[device]))
+            except:
+                dataframe.append(pd.Series(message[device]))
+        dataframe = pd.concat(dataframe, axis=1, ignore_index=True)
+        for line in dataframe.values:
+            self.txtFile.addData('\n')
+            self.txtFile.addData(",".join([str(x) for x in line]))
+
     def addMsgToSend(self, data):
         self.msgQueue.put(data)
         if self.socket not in self.outputCheck:
@@ -105,12 +192,214 @@ class OpenSignalsTCPClient(object):
     def setIsAcquiring(self, isAcquiring):
         self.isAcquiring = isAcquiring
         if self.isAcquiring:
+            self.recvBuffer = ''
             self.txtFile = SaveAcquisition()
             self.txtFile.start()
         else:
             self.txtFile.stop()
 
 
+class ReplaySource(BiosignalSource):
+    """Stands in for an OpenSignals device by replaying a recorded acquisition.
+
+    The file holds one JSON object per line, either a full OpenSignals message
+    ({"returnData": {...}}) or its "returnData" dictionary. An optional "t" key
+    (seconds since the start of the recording) sets the replay timing, otherwise
+    lines are emitted every `interval` seconds. Streaming starts and stops with
+    the same 'start'/'stop' commands sent to OpenSignals."""
+
+    def __init__(self, path, name=None, interval=0.1, speed=1.0, loop=False, maxPackets=4096):
+        super().__init__(name if name is not None else os.path.basename(path), maxPackets)
+        self.path = path
+        self.interval = interval
+        self.speed = speed
+        self.loop = loop
+        self.lines = []
+        self.isStreaming = False
+
+    def connect(self):
+        self.lines = []
+        with open(self.path, 'r') as replay_file:
+            for n, line in enumerate(replay_file):
+                line = line.strip()
+                if not line:
+                    continue
+                message = json.loads(line)
+                t = message.pop('t', n * self.interval)
+                if 'returnData' in message:
+                    message = message['returnData']
+                self.lines.append((t, message))
+        if not self.lines:
+            raise ValueError('Replay file %s has no data' % self.path)
+        self.isChecking = True
+
+    def start(self):
+        thread = threading.Thread(target=self.replay, name='replay-%s' % self.name)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.isChecking = False
+        self.isStreaming = False
+
+    def replay(self):
+        while self.isChecking:
+            if not self.isStreaming:
+                time.sleep(0.01)
+                continue
+            t_start = time.time()
+            t_first = self.lines[0][0]
+            for t, message in self.lines:
+                if not (self.isChecking and self.isStreaming):
+                    break
+                delay = t_start + (t - t_first) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.deviceStarted = True
+                self.pushPacket(message)
+            else:
+                if not self.loop:
+                    self.isStreaming = False
+
+    def addMsgToSend(self, data):
+        if data == 'start':
+            self.isStreaming = True
+        elif data == 'stop':
+            self.isStreaming = False
+
+    def setIsAcquiring(self, isAcquiring):
+        self.isAcquiring = isAcquiring
+
+
+class BiosignalHub(object):
+    """Fans in several acquisition sources (OpenSignalsTCPClient, ReplaySource).
+
+    Every source runs its own reader thread and publishes packets into its own
+    bounded deque, a single merger thread drains them in round-robin and hands
+    the packets to the subscribers. A stalled or disconnected source never
+    blocks the others. The hub exposes the same control interface as
+    OpenSignalsTCPClient so CARMEnHUD can drive either of them."""
+
+    def __init__(self, sources, maxPackets=16384):
+        self.sources = list(sources)
+        # Source names key the per-source statistics, keep them unique
+        names = set()
+        for n, source in enumerate(self.sources):
+            if source.name in names:
+                source.name = '%s#%d' % (source.name, n)
+            names.add(source.name)
+        self.connected = []
+        self.packets = collections.deque(maxlen=maxPackets)
+        self.packetEvent = threading.Event()
+        self.subscribers = []
+        self.packetCount = dict((source.name, 0) for source in self.sources)
+        self.lastPacketTime = dict((source.name, None) for source in self.sources)
+        self.isChecking = False
+        self.isAcquiring = False
+        self.mergeThread = None
+        # Exceptions raised by the subscribers, by subscriber name
+        self.subscriberErrors = {}
+        for source in self.sources:
+            source.packetEvent = self.packetEvent
+
+    def subscribe(self, callback):
+        """Calls callback(packet) from the merger thread for every packet"""
+        self.subscribers.append(callback)
+
+    def connect(self):
+        self.connected = []
+        for source in self.sources:
+            try:
+                source.connect()
+                self.connected.append(source)
+            except Exception as e:
+                print("ERROR: Could not connect to biosignal source %s (%s)" % (source.name, e))
+        if not self.connected:
+            raise ConnectionError('No biosignal source could be connected')
+        self.isChecking = True
+
+    def start(self):
+        for source in self.connected:
+            source.start()
+        self.mergeThread = threading.Thread(target=self.merge, name='biosignal-hub')
+        self.mergeThread.daemon = True
+        self.mergeThread.start()
+
+    def stop(self):
+        self.isChecking = False
+        for source in self.connected:
+            source.stop()
+        self.packetEvent.set()
+
+    def merge(self):
+        while self.isChecking:
+            self.packetEvent.wait(0.1)
+            self.packetEvent.clear()
+            for source in self.connected:
+                source_packets = source.packets
+                while source_packets:
+                    packet = source_packets.popleft()
+                    self.packetCount[packet.source] += 1
+                    self.lastPacketTime[packet.source] = packet.timestamp
+                    self.packets.append(packet)
+                    for callback in self.subscribers:
+                        # A failing subscriber must not stop the delivery to the others
+                        try:
+                            callback(packet)
+                        except Exception as e:
+                            self.subscriberError(callback, packet, e)
+
+    def subscriberError(self, callback, packet, error):
+        name = getattr(callback, '__qualname__', repr(callback))
+        count = self.subscriberErrors.get(name, 0)
+        self.subscriberErrors[name] = count + 1
+        # Only the first error of a subscriber is printed, a bad channel fails on every packet
+        if count == 0:
+            print("ERROR: Biosignal subscriber %s failed on a packet of %s (%r)" % (name, packet.source, error))
+
+    def stalledSources(self, timeout=1.0):
+        """Returns the names of the connected sources silent for more than timeout seconds,
+        all of them if the merger thread died while the hub is running"""
+        if self.isChecking and self.mergeThread is not None and not self.mergeThread.is_alive():
+            print("ERROR: Biosignal hub merger thread is not running")
+            return [source.name for source in self.connected]
+        now = time.time()
+        return [source.name for source in self.connected
+                if self.lastPacketTime[source.name] is not None
+                and now - self.lastPacketTime[source.name] > timeout]
+
+    def addMsgToSend(self, data):
+        for source in self.connected:
+            source.addMsgToSend(data)
+
+    def setIsAcquiring(self, isAcquiring):
+        self.isAcquiring = isAcquiring
+        for source in self.connected:
+            source.setIsAcquiring(isAcquiring)
+
+    @property
+    def deviceStarted(self):
+        return bool(self.connected) and all(source.deviceStarted for source in self.connected)
+
+    @deviceStarted.setter
+    def deviceStarted(self, value):
+        for source in self.connected:
+            source.deviceStarted = value
+
+    def waitForDevice(self, timeout=5.0):
+        """Waits for every source against a single deadline, returns False and
+        names the sources that did not start if the timeout expires"""
+        t_end = time.time() + timeout
+        while not self.deviceStarted:
+            if time.time() > t_end:
+                for source in self.connected:
+                    if not source.deviceStarted:
+                        print("WARNING: Biosignal source %s did not start" % source.name)
+                return False
+            time.sleep(0.001)
+        return True
+
+
 class SaveAcquisition(object):
     def __init__(self):
         self.fileTxt = None
@@ -130,3 +419,148 @@ class SaveAcquisition(object):
 
     def getHasHeader(self):
         return self.hasHeader
+
+    def isWriting(self):
+        return self.fileTxt is not None
+
+
+
+
+class OpenSignalsStandIn(object):
+    """Local TCP server standing in for the OpenSignals application.
+
+    Answers the 'start'/'stop' commands like OpenSignals: on 'start' a header
+    message with the device configuration is sent, followed by data messages
+    of `packetSize` samples every packetSize / samplingRate seconds. Samples are
+    [nSeq, ch1, ..., chN] with a running nSeq, synthesised as sines plus noise
+    or replayed from a file in the ReplaySource format. The send time of the
+    last `maxSentTimes` messages is kept by the nSeq of their first sample to
+    measure client latency."""
+
+    def __init__(self, tcpIp='127.0.0.1', tcpPort=5555, samplingRate=1000, channels=4,
+                 packetSize=100, replayPath=None, device='00:07:80:00:00:00', maxSentTimes=65536):
+        self.tcpIp = tcpIp
+        self.tcpPort = tcpPort
+        self.samplingRate = samplingRate
+        self.channels = channels
+        self.packetSize = packetSize
+        self.device = device
+        self.replayLines = None
+        if replayPath is not None:
+            replay = ReplaySource(replayPath)
+            replay.connect()
+            self.replayLines = [message for _, message in replay.lines]
+        self.serverSocket = None
+        self.isServing = False
+        self.sentSamples = 0
+        self.sentTimes = {}
+        # (nSeq, send time) in send order, the oldest are dropped from sentTimes
+        self.sentOrder = collections.deque()
+        self.maxSentTimes = maxSentTimes
+        self.sentLock = threading.Lock()
+
+    def start(self):
+        self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.serverSocket.bind((self.tcpIp, self.tcpPort))
+        # Port 0 lets the system choose a free port
+        self.tcpPort = self.serverSocket.getsockname()[1]
+        self.serverSocket.listen(5)
+        self.isServing = True
+        thread = threading.Thread(target=self.accept, name='opensignals-standin')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.isServing = False
+        if self.serverSocket is not None:
+            self.serverSocket.close()
+
+    def accept(self):
+        while self.isServing:
+            try:
+                connection, _ = self.serverSocket.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self.serve, args=(connection,), name='opensignals-standin-client')
+            thread.daemon = True
+            thread.start()
+
+    def header(self):
+        return {'returnCode': 0, 'returnData': {self.device: {
+            'channels': list(range(1, self.channels + 1)),
+            'sampling rate': self.samplingRate}}}
+
+    def samples(self, index):
+        if self.replayLines is not None:
+            data = self.replayLines[index % len(self.replayLines)]
+            return next(iter(data.values()))
+        nSeq = index * self.packetSize
+        return [[nSeq + n] + [math.sin(2 * math.pi * (c + 1) * (nSeq + n) / self.samplingRate) + 0.01 * random.random()
+                              for c in range(self.channels)]
+                for n in range(self.packetSize)]
+
+    def recordSent(self, nSeq, t_sent):
+        with self.sentLock:
+            self.sentTimes[nSeq] = t_sent
+            self.sentOrder.append((nSeq, t_sent))
+            while len(self.sentOrder) > self.maxSentTimes:
+                nSeq, t_sent = self.sentOrder.popleft()
+                # A replay loop may have sent the same nSeq again since
+                if self.sentTimes.get(nSeq) == t_sent:
+                    del self.sentTimes[nSeq]
+
+    def serve(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        streaming = False
+        index = 0
+        period = float(self.packetSize) / self.samplingRate
+        t_next = time.time()
+        try:
+            while self.isServing:
+                timeout = max(0.0, t_next - time.time()) if streaming else 0.1
+                readable, _, _ = select.select([connection], [], [], timeout)
+                if readable:
+                    command = connection.recv(1024)
+                    if not command:
+                        break
+                    command = command.decode('utf-8').strip()
+                    if command == 'start':
+                        connection.sendall(json.dumps(self.header()).encode())
+                        streaming = True
+                        t_next = time.time()
+                    elif command == 'stop':
+                        streaming = False
+                    else:
+                        connection.sendall(json.dumps({'returnCode': 0, 'returnData': command}).encode())
+                    continue
+                if streaming and time.time() >= t_next:
+                    samples = self.samples(index)
+                    self.recordSent(samples[0][0], time.time())
+                    connection.sendall(json.dumps({'returnCode': 0, 'returnData': {self.device: samples}}).encode())
+                    self.sentSamples += len(samples)
+                    index += 1
+                    t_next += period
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+def create_biosignal_source(spec):
+    """Creates a source from 'host:port' or from the path of a replay file"""
+    if os.path.isfile(spec):
+        return ReplaySource(spec)
+    host, _, port = spec.rpartition(':')
+    return OpenSignalsTCPClient(host if host else '127.0.0.1', int(port))
+
+
+def create_biosignal_client(specs=None):
+    """Returns the default OpenSignals client, or a BiosignalHub for a list of source specs"""
+    if not specs:
+        return OpenSignalsTCPClient()
+    return BiosignalHub([create_biosignal_source(spec) for spec in specs])
@@ -18,6 +18,11 @@ from carmen.utils import CARMEnRoute
 import random
 
 
+# Attributes of CARMEnCheckpoint holding the vehicle spawn points
+SPAWN_SLOTS = ('desired_spawn_front_left', 'desired_spawn_front_right',
+               'desired_spawn_back_left', 'desired_spawn_back_right')
+
+
 # ==============================================================================
 # -- Classes -------------------------------------------------------------------
 # ==============================================================================
@@ -25,11 +30,16 @@ import random
 
 class CARMEnRun(object):
 
-    def __init__(self, road_width=3.4, directions_pool=None, is_demo=False):
+    def __init__(self, road_width=3.4, directions_pool=None, is_demo=False, seed=None, forced_spawns=None):
+        # Every random decision of the run comes from its own seeded generator
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        # Logged spawn decisions by checkpoint name, replayed instead of drawn
+        self.forced_spawns = forced_spawns if forced_spawns is not None else {}
         self.directions_pool = None
         if directions_pool is not None:
             self.directions_pool = directions_pool
-            random.shuffle(self.directions_pool)
+            self.random.shuffle(self.directions_pool)
         self.spawn_direction = ''
         self.current_checkpoint = ''
         self.vehicles_list = []
@@ -58,22 +68,24 @@ class CARMEnRun(object):
         return route
 
     def spawn_new_agent_vehicle(self, session, model, color, route, current_speed=None, offset=None, draw_route=False):
-        vehicle = CARMEnVehicle(session.world, model, color, route, current_speed, offset, draw_route)
+        vehicle = CARMEnVehicle(session.world, model, color, route, current_speed, offset, draw_route,
+                                route_planner=session.get_route_planner(),
+                                world_state=session.get_world_state())
         self.vehicles_list.append(vehicle)
 
     def decide_checkpoint_start_and_end(self, checkpoint):
         if self.directions_pool is None:
-            direction_dice_roll = random.randrange(1,10)
+            direction_dice_roll = self.random.randrange(1,10)
             # 80% front
             if direction_dice_roll <= 8: 
                 # 50% front-left (without offest) or front-right (with offset)
-                offset = random.choice([0, self.offset])
+                offset = self.random.choice([0, self.offset])
                 desired_start_point = checkpoint.desired_spawn_front_left
                 desired_end_point = checkpoint.desired_spawn_back_left
             # 20% back
             else: 
                 # 50% back-left (with offest) or back-right (without offset)
-                offset = random.choice([0, self.offset])
+                offset = self.random.choice([0, self.offset])
                 desired_start_point = checkpoint.desired_spawn_back_right
                 desired_end_point = checkpoint.desired_spawn_front_right
         else:
@@ -138,9 +150,24 @@ class CARMEnRun(object):
                         self.stop = True
                     else:
                         if checkpoint.spawns_vehicle_when_reached and not self.is_demo:
-                            r_start, r_stop, offset = self.decide_checkpoint_start_and_end(checkpoint)
-                            chosen_model = random.choice(session.model_list)
-                            chosen_color = random.choice(session.color_scheme)
+                            forced = self.forced_spawns.get(checkpoint.name)
+                            if forced is None:
+                                r_start, r_stop, offset = self.decide_checkpoint_start_and_end(checkpoint)
+                                chosen_model = self.random.choice(session.model_list)
+                                chosen_color = self.random.choice(session.color_scheme)
+                            else:
+                                offset = forced.values[0]
+                                r_start = getattr(checkpoint, forced.values[2])
+                                r_stop = getattr(checkpoint, forced.values[3])
+                                chosen_model, chosen_color, self.spawn_direction = forced.values[4:7]
+                                self.current_checkpoint = checkpoint.name
+                            if session.control_log is not None:
+                                session.control_log.log_spawn(session.hud.frame, session.hud.simulation_time,
+                                                              checkpoint.name,
+                                                              spawn_slot(checkpoint, r_start),
+                                                              spawn_slot(checkpoint, r_stop),
+                                                              offset, chosen_model, chosen_color,
+                                                              self.spawn_direction)
                             r = self.create_new_route(session
                                             , r_start
                                             , r_stop
@@ -154,6 +181,8 @@ class CARMEnRun(object):
                                                 , draw_route=False)
                             print(f"Spawned {chosen_model}, {chosen_color}\n")
                         checkpoint.check = True
+                        if session.control_log is not None:
+                            session.control_log.log_checkpoint(session.hud.frame, session.hud.simulation_time, checkpoint.name)
                         print(f"Checkpoint {self.current_checkpoint} passed!\n")
 
         for v in self.vehicles_list:
@@ -172,4 +201,18 @@ class CARMEnRun(object):
         print('\ndestroying %d vehicles' % len(self.vehicles_list))
         for v in self.vehicles_list:
             v.id.destroy()
-        print('\n--- Stop Run ---\n')
\ No newline at end of file
+        print('\n--- Stop Run ---\n')
+
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+
+def spawn_slot(checkpoint, point):
+    """Name of the checkpoint attribute holding the spawn point"""
+    for slot in SPAWN_SLOTS:
+        if getattr(checkpoint, slot) is point:
+            return slot
+    raise ValueError('point is not a spawn point of %s' % checkpoint.name)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+# Scenario module for CARMEn
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Declarative CARMEn scenarios.
+
+A scenario file (JSON, or YAML when PyYAML is installed) holds the player
+starts, the checkpoints with their vehicle spawn points and the spawn
+direction pools of an experiment:
+
+    {
+        "player_starts": [{"name": "player_start", "x": 52.40, "y": -50.65}],
+        "direction_pools": [["FL", "FR", "BL", "BR"]],
+        "checkpoints": [
+            {"name": "checkpoint1", "x": 32.8, "y": -50.6, "spawns_vehicle": true,
+             "spawns": {"FL": {"x": -5.77, "y": -23.61, "lane_id": -1}, ...}},
+            {"name": "end_checkpoint", "x": -45.54, "y": 48.19}
+        ],
+        "road_ids": [10, 32],
+        "lane_id": -1
+    }
+
+The points are resolved against the spawn points of the map once, the
+resolved spawn point indices are kept in a compiled cache next to the
+scenario file, keyed by map and file hash. The routes of the vehicles a
+checkpoint spawns, front left to back left and back right to front right,
+are traced at the same time and kept in the cache as encoded waypoints;
+they seed the route cache of the session planner when the scenario is
+compiled, so spawning a vehicle does not search the road graph.
+"""
+
+
+# ==============================================================================
+# -- imports -------------------------------------------------------------------
+# ==============================================================================
+
+from carmen.utils import CARMEnPoint, CARMEnCheckpoint
+
+import hashlib
+import json
+import math
+import os
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+DIRECTIONS = ('FL', 'FR', 'BL', 'BR')
+
+# Scenario spawn direction -> CARMEnCheckpoint attribute
+SPAWN_ATTRIBUTES = {
+    'FL': 'desired_spawn_front_left',
+    'FR': 'desired_spawn_front_right',
+    'BL': 'desired_spawn_back_left',
+    'BR': 'desired_spawn_back_right',
+}
+
+# Same tolerance as CARMEnPoint.get_valid_transform
+SPAWN_TOLERANCE = 0.5
+
+# Vehicle routes of a spawning checkpoint, start -> end direction
+ROUTE_DIRECTIONS = (('FL', 'BL'), ('BR', 'FR'))
+
+CACHE_VERSION = 2
+
+
+# ==============================================================================
+# -- Classes -------------------------------------------------------------------
+# ==============================================================================
+
+
+class SpawnPointIndex(object):
+    """Grid index of the spawn points of a map, to resolve points without scanning them all"""
+
+    def __init__(self, spawn_points, tolerance=SPAWN_TOLERANCE):
+        self.tolerance = tolerance
+        self.cells = {}
+        for n, transform in enumerate(spawn_points):
+            location = transform.location
+            self.cells.setdefault(self.cell(location.x, location.y), []).append((n, location.x, location.y))
+
+    def cell(self, x, y):
+        return (int(math.floor(x / self.tolerance)), int(math.floor(y / self.tolerance)))
+
+    def find(self, x, y):
+        """Index of the first spawn point within tolerance of (x, y), None if there is none"""
+        cx, cy = self.cell(x, y)
+        found = None
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for n, px, py in self.cells.get((i, j), ()):
+                    if abs(x - px) < self.tolerance and abs(y - py) < self.tolerance:
+                        if found is None or n < found:
+                            found = n
+        return found
+
+
+
+class CARMEnScenario(object):
+    """Scenario file loaded and validated into player starts, checkpoints and direction pools"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.hash = hashlib.sha1(data).hexdigest()
+        if os.path.splitext(path)[1].lower() in ('.yml', '.yaml'):
+            if yaml is None:
+                raise RuntimeError('cannot import yaml, make sure PyYAML package is installed')
+            spec = yaml.safe_load(data)
+        else:
+            spec = json.loads(data.decode('utf-8'))
+        self.player_starts, self.checkpoints, self.direction_pools = validate_scenario(spec, path)
+        self.name = spec.get('name', os.path.splitext(os.path.basename(path))[0])
+        self.road_ids = spec.get('road_ids', [])
+        self.lane_id = spec.get('lane_id', [])
+
+    def points(self):
+        """Every point of the scenario, in file order"""
+        points = list(self.player_starts)
+        for point, spawns_vehicle, spawns in self.checkpoints:
+            points.append(point)
+            points.extend(spawns[d] for d in DIRECTIONS if d in spawns)
+        return points
+
+    def compile(self, session, cache_path=None):
+        """Resolves every point to a spawn point of the session map and returns the CARMEnCheckpoints.
+
+        The player starts are resolved in place, so the session can be created
+        with `player_starts` before the scenario is compiled."""
+        cache_path = scenario_cache_path(self.path) if cache_path is None else cache_path
+        map_name = session.world.get_map().name
+        points = self.points()
+        compiled = load_compiled(cache_path, self.hash, map_name, len(session.spawn_points))
+        if compiled is None or len(compiled.get('indices', ())) != len(points):
+            index = SpawnPointIndex(session.spawn_points)
+            compiled = {'indices': [index.find(p.x, p.y) for p in points]}
+        for point, n in zip(points, compiled['indices']):
+            if n is None:
+                print("Desired point %s not found among Spawn Points!" % point.name)
+            else:
+                point.transform = session.spawn_points[n]
+        route_planner = session.get_route_planner()
+        pairs = self.route_locations(session.world.get_map())
+        routes = compiled.get('routes')
+        if routes is None or len(routes) != len(pairs):
+            routes = [route_planner.encode_route(route_planner.trace_routes_from(start, [end])[0])
+                      if start is not None and end is not None else None
+                      for start, end in pairs]
+            compiled['routes'] = routes
+            save_compiled(cache_path, self.hash, map_name, len(session.spawn_points), compiled)
+        for (start, end), route in zip(pairs, routes):
+            if route is not None:
+                route_planner.seed_route(start, end, route_planner.decode_route(route))
+        checkpoint_list = []
+        for point, spawns_vehicle, spawns in self.checkpoints:
+            kwargs = dict((SPAWN_ATTRIBUTES[d], p) for d, p in spawns.items())
+            checkpoint_list.append(CARMEnCheckpoint(session=session
+                                     , desired_point = point
+                                     , spawns_vehicle_when_reached = spawns_vehicle
+                                     , **kwargs))
+        return checkpoint_list
+
+    def route_locations(self, wmap):
+        """(start, end) locations of the vehicle routes of the spawning checkpoints, as
+        CARMEnVehicle plans them: from the lane waypoints of the spawn points. None if unresolved"""
+        pairs = []
+        for point, spawns_vehicle, spawns in self.checkpoints:
+            if not spawns_vehicle:
+                continue
+            for start, end in ROUTE_DIRECTIONS:
+                pairs.append(tuple(None if spawns[d].transform is None
+                                   else wmap.get_waypoint(spawns[d].transform.location).transform.location
+                                   for d in (start, end)))
+        return pairs
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+
+def validate_scenario(spec, path):
+    """Checks a parsed scenario and builds its CARMEnPoints.
+
+    Returns (player_starts, [(point, spawns_vehicle, {direction: point})], direction_pools)"""
+    if not isinstance(spec, dict):
+        raise ValueError('%s: a scenario is a mapping' % path)
+    player_starts = [parse_point(p, '%s: player_starts[%d]' % (path, n))
+                     for n, p in enumerate(spec.get('player_starts', []))]
+    if not player_starts:
+        raise ValueError('%s: no player_starts' % path)
+    checkpoints = []
+    for n, c in enumerate(spec.get('checkpoints', [])):
+        where = '%s: checkpoints[%d]' % (path, n)
+        point = parse_point(c, where)
+        spawns_vehicle = bool(c.get('spawns_vehicle', False))
+        spawns = {}
+        for direction, p in c.get('spawns', {}).items():
+            if direction not in DIRECTIONS:
+                raise ValueError('%s: unknown spawn direction %r' % (where, direction))
+            p = dict(p)
+            p.setdefault('name', '%s_%s' % (point.name, direction))
+            spawns[direction] = parse_point(p, '%s.spawns.%s' % (where, direction))
+        if spawns_vehicle and len(spawns) != len(DIRECTIONS):
+            raise ValueError('%s: spawns a vehicle but does not define the %s spawns' % (where, '/'.join(DIRECTIONS)))
+        checkpoints.append((point, spawns_vehicle, spawns))
+    direction_pools = spec.get('direction_pools')
+    if direction_pools is not None:
+        for n, pool in enumerate(direction_pools):
+            unknown = [d for d in pool if d not in DIRECTIONS]
+            if unknown:
+                raise ValueError('%s: direction_pools[%d] has unknown directions %s' % (path, n, ', '.join(map(str, unknown))))
+        # A pool is drawn once per vehicle spawning checkpoint
+        spawning = sum(1 for c in checkpoints if c[1])
+        short = [n for n, pool in enumerate(direction_pools) if len(pool) < spawning]
+        if short:
+            raise ValueError('%s: direction_pools %s have fewer directions than the %d spawning checkpoints'
+                             % (path, short, spawning))
+        direction_pools = [list(pool) for pool in direction_pools]
+    return player_starts, checkpoints, direction_pools
+
+
+def parse_point(spec, where):
+    try:
+        point = CARMEnPoint(float(spec['x']), float(spec['y']), str(spec['name']), int(spec.get('lane_id', 0)))
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError('%s: a point needs a name and numeric x, y (%s)' % (where, error))
+    if point.lane_id not in (-1, 0, 1):
+        raise ValueError('%s: lane_id must be -1, 0 or 1' % where)
+    return point
+
+
+def scenario_cache_path(path):
+    return os.path.splitext(path)[0] + '.compiled.json'
+
+
+def load_compiled(cache_path, scenario_hash, map_name, n_spawn_points):
+    """Spawn point indices and routes of the compiled scenario, None if the cache does not match"""
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if cache.get('version') != CACHE_VERSION or cache.get('hash') != scenario_hash:
+        return None
+    compiled = cache.get('maps', {}).get(map_name)
+    if compiled is None or compiled.get('spawn_points') != n_spawn_points:
+        return None
+    return compiled
+
+
+def save_compiled(cache_path, scenario_hash, map_name, n_spawn_points, compiled):
+    cache = {'version': CACHE_VERSION, 'hash': scenario_hash, 'maps': {}}
+    try:
+        with open(cache_path) as f:
+            previous = json.load(f)
+        if previous.get('version') == CACHE_VERSION and previous.get('hash') == scenario_hash:
+            cache['maps'] = previous.get('maps', {})
+    except (IOError, OSError, ValueError):
+        pass
+    cache['maps'][map_name] = dict(compiled, spawn_points=n_spawn_points)
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f)
+    except (IOError, OSError) as error:
+        # The cache only saves time, a read-only scenario directory is fine
+        print('Could not write compiled scenario %s: %s' % (cache_path, error))
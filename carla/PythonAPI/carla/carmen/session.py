@@ -13,11 +13,23 @@
 import carla
 
 from carmen.run import CARMEnRun
+from carmen.control_log import ControlLogWriter
 from carmen.global_functions import get_actor_display_name, clamp_to_range, clamp_to_direction
 from carmen.sensors import GnssSensor, CameraManager, LaneInvasionSensor, CollisionSensor
+from agents.navigation.global_route_planner import GlobalRoutePlanner  # pylint: disable=import-error
+from agents.navigation.world_state import WorldStateCache  # pylint: disable=import-error
 
+import datetime
+import os
 import random
 import re
+import threading
+import time
+
+try:
+    import pygame
+except ImportError:
+    raise RuntimeError('cannot import pygame, make sure pygame package is installed')
 
 
 # ==============================================================================
@@ -29,7 +41,7 @@ class CARMEnSession(object):
     def __init__(self, carla_world, hud, actor_filter, player_start_list,
                  subject="S00", experiment="carmen", directory='C:\\carla\\Unreal\\CarlaUE4\\Data\\',
                  model_list=None, color_scheme=None, waypoints=False, waypoint_distance=0.3, draw=False, 
-                 road_width=3.4, road_id_list=[], lane_id=[]):
+                 road_width=3.4, road_id_list=[], lane_id=[], log_controls=False, headless=False):
         self.world = carla_world
         self.run = None
         self.hud = hud
@@ -54,6 +66,13 @@ class CARMEnSession(object):
         self.checkpoint_list = None
         self.directions_pools = None
         self.road_width = road_width
+        self.log_controls = log_controls
+        # No camera is spawned nor rendered in headless sessions, which are
+        # only used for control log replays as they have no input either
+        self.headless = headless
+        self.control_log = None
+        self.route_planner = None
+        self.world_state = None
         self.world.on_tick(hud.on_world_tick)
 
     def restart(self, player_start):
@@ -84,9 +103,10 @@ class CARMEnSession(object):
         if isinstance(self.player, carla.Vehicle): 
             self.lane_invasion_sensor = LaneInvasionSensor(self.player, self.hud)
         self.gnss_sensor = GnssSensor(self.player)
-        self.camera_manager = CameraManager(self.player, self.hud)
-        self.camera_manager.transform_index = cam_pos_index
-        self.camera_manager.set_sensor(cam_index, notify=False)
+        if not self.headless:
+            self.camera_manager = CameraManager(self.player, self.hud)
+            self.camera_manager.transform_index = cam_pos_index
+            self.camera_manager.set_sensor(cam_index, notify=False)
         actor_type = get_actor_display_name(self.player)
         if self.unique_waypoints is not None:
             self.lat_dev, self.ang_dev = self.distance_from_my_waypoint(self.player.get_transform())
@@ -120,13 +140,13 @@ class CARMEnSession(object):
         print("Player Start not Found!")
         return None
 
-    def set_new_run(self, is_demo, pool_idx):
+    def set_new_run(self, is_demo, pool_idx, seed=None, forced_spawns=None):
         if self.run is None:
             if self.directions_pools is not None:
                 new_direction_pool = self.directions_pools[pool_idx].copy()
             else:
                 new_direction_pool = None
-            self.run = CARMEnRun(self.road_width, new_direction_pool, is_demo)
+            self.run = CARMEnRun(self.road_width, new_direction_pool, is_demo, seed, forced_spawns)
             if is_demo:
                 player_start_name = 'player_start_check1'
             else:
@@ -134,6 +154,10 @@ class CARMEnSession(object):
             player_start = self.get_player_start(player_start_name)
             if player_start is not None:
                 self.restart(player_start)
+                if self.log_controls:
+                    self.create_control_log()
+                    self.control_log.log_run_start(self.hud.frame, self.hud.simulation_time,
+                                                   self.run.seed, is_demo, pool_idx, player_start_name)
                 #print("Set New Run!")
                 return True
             else:
@@ -145,6 +169,10 @@ class CARMEnSession(object):
 
     def end_new_run(self):
         if self.run is not None:
+            if self.control_log is not None:
+                self.control_log.log_run_end(self.hud.frame, self.hud.simulation_time)
+                self.control_log.close()
+                self.control_log = None
             self.destroy()
             self.run = None
             return True
@@ -153,17 +181,42 @@ class CARMEnSession(object):
             return False
 
     def tick(self, clock, args):
+        self.tick_run()
+        self.hud.tick(self, clock, args)
+
+    def tick_run(self):
         if self.run is not None:
             self.run.tick(self) 
             if self.unique_waypoints is not None:
                 self.lat_dev, self.ang_dev = self.distance_from_my_waypoint(self.player.get_transform())   
                 self.lat_dev -= ( self.road_width / 2 ) 
-        self.hud.tick(self, clock, args)
+
+    def get_route_planner(self, sampling_resolution=2.0):
+        """GlobalRoutePlanner of the map shared by every agent vehicle, its graph cached on disk
+        next to the logs of the session, not in the working directory"""
+        if self.route_planner is None:
+            cache_dir = os.environ.get('CARLA_ROUTE_CACHE_DIR', os.path.join(self.directory, 'cache', 'global_route_planner'))
+            self.route_planner = GlobalRoutePlanner(self.world.get_map(), sampling_resolution, cache_dir=cache_dir)
+        return self.route_planner
+
+    def get_world_state(self):
+        """WorldStateCache shared by every agent vehicle, so the actors are fetched once per frame"""
+        if self.world_state is None:
+            self.world_state = WorldStateCache(self.world)
+        return self.world_state
+
+    def create_control_log(self):
+        date = datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
+        filename = self.subject + '_' + self.experiment + '_' + date + '.ctl'
+        self.control_log = ControlLogWriter(self.directory + filename)
+        print('Created control log ', self.control_log.path)
 
 
     def render(self, display):
+        if self.headless:
+            return []
         #self.camera_manager.render(display)
-        self.hud.render(display)
+        return self.hud.render(display)
 
     def extract_spawn_points(self):
         print("Extracting spawn points...")
@@ -231,15 +284,16 @@ class CARMEnSession(object):
             if self.checkpoint_list is not None:
                 for checkpoint in self.checkpoint_list:
                     checkpoint.check = False
+            camera = self.camera_manager.sensor if self.camera_manager is not None else None
             if isinstance(self.player, carla.Vehicle):
                 sensors = [
-                    self.camera_manager.sensor,
+                    camera,
                     self.collision_sensor.sensor,
                     self.lane_invasion_sensor.sensor,
                     self.gnss_sensor.sensor]
             elif isinstance(self.player, carla.Walker):
                 sensors = [
-                    self.camera_manager.sensor,
+                    camera,
                     self.collision_sensor.sensor,
                     self.gnss_sensor.sensor]
             for sensor in sensors:
@@ -248,4 +302,65 @@ class CARMEnSession(object):
                     sensor.destroy()
             if self.player is not None:
                 self.player.destroy()
-                self.player = None
\ No newline at end of file
+                self.player = None
+
+
+
+class CARMEnSimulation(object):
+    """Runs the simulation side of a session on its own thread at a fixed rate.
+
+    Every step applies the player control, ticks the run and samples the
+    telemetry and recording of the HUD, which publishes what it shows as an
+    immutable HUDFrame. Event handling and rendering stay on the main thread,
+    which must hold `lock` while it handles events, as the handlers change the
+    session, and renders the last published frame without it."""
+
+    def __init__(self, session, controller, args, rate=60, left_threshold=None, right_threshold=None):
+        self.session = session
+        self.controller = controller
+        self.args = args
+        self.period = 1.0 / rate
+        self.left_threshold = left_threshold
+        self.right_threshold = right_threshold
+        self.lock = threading.RLock()
+        self.clock = pygame.time.Clock()
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='CARMEnSimulation', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        next_time = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                with self.lock:
+                    self.clock.tick()
+                    if not self.controller.end_session:
+                        self.controller.apply_control(self.session, self.clock, self.left_threshold, self.right_threshold)
+                        self.session.tick(self.clock, self.args)
+                next_time += self.period
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, keep the cadence from now on
+                    next_time = time.perf_counter()
+        except Exception as error:
+            self.error = error
+            raise
+
+    def check(self):
+        """Raises on the main thread the error that stopped the simulation"""
+        if self.error is not None:
+            raise RuntimeError('simulation thread stopped: %s' % self.error)
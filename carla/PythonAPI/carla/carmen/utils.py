@@ -61,8 +61,12 @@ class CARMEnPoint:
         self.y = y
         self.name = name
         self.lane_id = lane_id
+        # Spawn point resolved ahead of time, e.g. by a compiled scenario
+        self.transform = None
 
     def get_valid_transform(self, session_spawn_points):
+        if self.transform is not None:
+            return self.transform
 
         # Check trough all spawn points for the desired point
         for n, transform in enumerate(session_spawn_points):
@@ -26,7 +26,7 @@ class CARMEnVehicle:
         and agent for control. Colors can be grey, red, dark_blue, cyan, black and white. Models can be audi_a2, citroen_c3, \
         lincoln_mkz, mercedes_coupe, mini_cooper, nissan_patrol"""
 
-    def __init__(self, world, model, color, route, speed_at_spawn=None, offset_at_spawn=None, draw_route=False):
+    def __init__(self, world, model, color, route, speed_at_spawn=None, offset_at_spawn=None, draw_route=False, route_planner=None, world_state=None):
 
         color_scheme = {'grey' : '76,76,76'
                     , 'red' : '190,0,0'
@@ -49,6 +49,10 @@ class CARMEnVehicle:
         self.route = route
         self.speed = route.target_speed if speed_at_spawn is None else speed_at_spawn
         self.offset = route.offset if offset_at_spawn is None else offset_at_spawn
+        # GlobalRoutePlanner shared by the vehicles of a session, instead of one per agent
+        self.route_planner = route_planner
+        # WorldStateCache shared by the vehicles of a session, the actors are fetched once per frame
+        self.world_state = world_state
         self.blueprint = self.get_blueprint(world)
         self.id = self.spawn_vehicle(world)
         self.agent = self.set_agent(self.id, draw_route)
@@ -79,7 +83,7 @@ class CARMEnVehicle:
             opt_dict = {'offset': -self.offset}
         else:
             opt_dict = {}
-        agent = BasicAgent(vehicle, self.speed, opt_dict)
+        agent = BasicAgent(vehicle, self.speed, opt_dict, grp_inst=self.route_planner, world_state=self.world_state)
         agent.set_target_speed(self.speed)
         agent.follow_speed_limits(False)
         agent.ignore_traffic_lights(True)
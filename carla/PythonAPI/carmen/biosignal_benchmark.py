@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+# Biosignal benchmark for CARMEn
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Benchmarks of the CARMEn biosignal path.
+
+features: feeds synthetic ECG and EDA packets, as OpenSignals would deliver
+          them, into BiosignalFeatures and reports the time spent per feature
+          window against the latency budget.
+ingest:   streams from local OpenSignals stand-in servers through
+          OpenSignalsTCPClient and BiosignalHub and reports the ingest
+          throughput, sample loss and end-to-end latency.
+
+Exits with an error code if the latency budget is exceeded or samples are lost.
+"""
+
+from __future__ import print_function
+
+
+# ==============================================================================
+# -- imports -------------------------------------------------------------------
+# ==============================================================================
+
+
+from carmen.opensignals import BiosignalPacket, BiosignalHub, OpenSignalsTCPClient, OpenSignalsStandIn
+from carmen.biosignals import BiosignalFeatures
+
+import argparse
+import math
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    raise RuntimeError('cannot import numpy, make sure numpy package is installed')
+
+
+# ==============================================================================
+# -- Global functions ----------------------------------------------------------
+# ==============================================================================
+
+
+def synthetic_samples(n_samples, sampling_rate, heart_rate=72.0, start=0):
+    """Returns (n_samples, 3) samples: sequence number, ECG and EDA"""
+    t = (start + np.arange(n_samples)) / float(sampling_rate)
+    beat_period = 60.0 / heart_rate
+    phase = np.mod(t, beat_period)
+    # Narrow gaussian pulses as R-peaks over some baseline noise
+    ecg = np.exp(-(phase - 0.5 * beat_period) ** 2 / (2 * 0.01 ** 2)) + 0.02 * np.random.randn(n_samples)
+    eda = 5.0 + 0.5 * np.sin(2 * math.pi * 0.05 * t) + 0.01 * np.random.randn(n_samples)
+    return np.column_stack((start + np.arange(n_samples), ecg, eda))
+
+
+def benchmark_features(args):
+    features = BiosignalFeatures(sampling_rate=args.rate,
+                                 ecg=(None, 1),
+                                 eda=(None, 2),
+                                 window=args.window,
+                                 hop=args.hop,
+                                 latency_budget=args.budget / 1000.0)
+    packet_size = max(1, int(args.rate * args.packet))
+    n_packets = int(args.duration / args.packet)
+    latencies = []
+    windows = 0
+    t_start = time.perf_counter()
+    for n in range(n_packets):
+        samples = synthetic_samples(packet_size, args.rate, args.heart_rate, n * packet_size)
+        features.feed(BiosignalPacket('synthetic', time.time(), {'device': samples.tolist()}))
+        if features.windows != windows:
+            windows = features.windows
+            latencies.append(features.latency)
+    t_total = time.perf_counter() - t_start
+
+    latencies = np.array(latencies) * 1000.0
+    print('Signal duration:     % 10.1f s' % args.duration)
+    print('Processing time:     % 10.3f s' % t_total)
+    print('Feature windows:     % 10d' % len(latencies))
+    if len(latencies):
+        print('Latency mean:        % 10.3f ms' % latencies.mean())
+        print('Latency p99:         % 10.3f ms' % np.percentile(latencies, 99))
+        print('Latency max:         % 10.3f ms' % latencies.max())
+    print('Over budget (%.1f ms): % 8d' % (args.budget, features.over_budget))
+    heart_rate = features.get_features().get('heart_rate')
+    print('Heart rate:          % 10s bpm (expected %.0f)' % (
+        '--' if heart_rate is None else '%.1f' % heart_rate, args.heart_rate))
+    return features.over_budget == 0
+
+
+def benchmark_ingest(args):
+    servers = []
+    for _ in range(args.sources):
+        server = OpenSignalsStandIn('127.0.0.1', 0, args.rate, args.channels, args.packet_size)
+        server.start()
+        servers.append(server)
+    hub = BiosignalHub([OpenSignalsTCPClient('127.0.0.1', server.tcpPort) for server in servers])
+    arrivals = []
+    hub.subscribe(lambda packet: arrivals.append((packet, time.time())))
+    hub.connect()
+    hub.start()
+    hub.setIsAcquiring(True)
+    hub.addMsgToSend('start')
+    if not hub.waitForDevice():
+        print('Stand-in servers did not start streaming')
+        return False
+    time.sleep(args.duration)
+    # Keep acquiring until the messages in flight are received
+    hub.addMsgToSend('stop')
+    time.sleep(0.5)
+    hub.setIsAcquiring(False)
+    hub.stop()
+    for server in servers:
+        server.stop()
+
+    # Match every received packet with its send time through the nSeq of its first sample
+    source_servers = dict((source.name, server) for source, server in zip(hub.sources, servers))
+    received = 0
+    socket_latencies = []
+    merge_latencies = []
+    for packet, t_merged in arrivals:
+        server = source_servers[packet.source]
+        for samples in packet.data.values():
+            received += len(samples)
+            t_sent = server.sentTimes.get(samples[0][0])
+            if t_sent is not None:
+                socket_latencies.append(packet.timestamp - t_sent)
+                merge_latencies.append(t_merged - t_sent)
+    sent = sum(server.sentSamples for server in servers)
+    lost = sent - received
+
+    socket_latencies = np.array(socket_latencies) * 1000.0
+    merge_latencies = np.array(merge_latencies) * 1000.0
+    print('Sources:             % 10d' % args.sources)
+    print('Channels:            % 10d' % args.channels)
+    print('Sampling rate:       % 10d Hz' % args.rate)
+    print('Samples sent:        % 10d' % sent)
+    print('Samples received:    % 10d' % received)
+    print('Throughput:          % 10.0f samples/s' % (received / args.duration))
+    print('Loss:                % 10.3f %%' % (100.0 * lost / max(1, sent)))
+    if len(socket_latencies):
+        print('Client latency mean: % 10.3f ms' % socket_latencies.mean())
+        print('Client latency p99:  % 10.3f ms' % np.percentile(socket_latencies, 99))
+        print('Hub latency mean:    % 10.3f ms' % merge_latencies.mean())
+        print('Hub latency p99:     % 10.3f ms' % np.percentile(merge_latencies, 99))
+    return lost == 0
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='CARMEn Biosignal Benchmark')
+    argparser.add_argument(
+        'mode',
+        choices=['features', 'ingest'],
+        nargs='?',
+        default='features',
+        help='benchmark to run (default: features)')
+    argparser.add_argument(
+        '--rate',
+        metavar='HZ',
+        default=1000,
+        type=int,
+        help='sampling rate (default: 1000)')
+    argparser.add_argument(
+        '--duration',
+        metavar='S',
+        type=float,
+        help='duration of the signal in seconds (default: 120, ingest: 10)')
+    argparser.add_argument(
+        '--packet',
+        metavar='S',
+        default=0.1,
+        type=float,
+        help='signal duration per packet in seconds (default: 0.1)')
+    argparser.add_argument(
+        '--window',
+        metavar='S',
+        default=5.0,
+        type=float,
+        help='feature window in seconds (default: 5.0)')
+    argparser.add_argument(
+        '--hop',
+        metavar='S',
+        default=0.5,
+        type=float,
+        help='feature update interval in seconds (default: 0.5)')
+    argparser.add_argument(
+        '--budget',
+        metavar='MS',
+        default=5.0,
+        type=float,
+        help='latency budget per feature window in milliseconds (default: 5.0)')
+    argparser.add_argument(
+        '--heart-rate',
+        metavar='BPM',
+        default=72.0,
+        type=float,
+        help='heart rate of the synthetic ECG (default: 72)')
+    argparser.add_argument(
+        '--sources',
+        metavar='N',
+        default=1,
+        type=int,
+        help='ingest: number of stand-in servers (default: 1)')
+    argparser.add_argument(
+        '--channels',
+        metavar='N',
+        default=4,
+        type=int,
+        help='ingest: channels per source (default: 4)')
+    argparser.add_argument(
+        '--packet-size',
+        metavar='N',
+        default=100,
+        type=int,
+        help='ingest: samples per message (default: 100)')
+    args = argparser.parse_args()
+
+    if args.mode == 'features':
+        if args.duration is None:
+            args.duration = 120.0
+        success = benchmark_features(args)
+    else:
+        if args.duration is None:
+            args.duration = 10.0
+        success = benchmark_ingest(args)
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# OpenSignals stand-in server for CARMEn
+#
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Local stand-in for the OpenSignals (r)evolution TCP/IP integration.
+
+Serves synthetic or replayed biosignal streams on the OpenSignals port so the
+CARMEn biosignal path can be run without the vendor application and hardware.
+Point CARMEn to it with --biosignals HOST:PORT.
+"""
+
+from __future__ import print_function
+
+
+# ==============================================================================
+# -- imports -------------------------------------------------------------------
+# ==============================================================================
+
+
+from carmen.opensignals import OpenSignalsStandIn
+
+import argparse
+import time
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='CARMEn OpenSignals Stand-In Server')
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP to listen on (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=5555,
+        type=int,
+        help='TCP port to listen to (default: 5555)')
+    argparser.add_argument(
+        '--rate',
+        metavar='HZ',
+        default=1000,
+        type=int,
+        help='sampling rate (default: 1000)')
+    argparser.add_argument(
+        '--channels',
+        metavar='N',
+        default=4,
+        type=int,
+        help='number of synthetic channels (default: 4)')
+    argparser.add_argument(
+        '--packet-size',
+        metavar='N',
+        default=100,
+        type=int,
+        help='samples per message (default: 100)')
+    argparser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help='replay the messages of a recorded acquisition instead of synthetic data')
+    args = argparser.parse_args()
+
+    server = OpenSignalsStandIn(args.host, args.port, args.rate, args.channels, args.packet_size, args.replay)
+    server.start()
+    print('OpenSignals stand-in listening on %s:%d' % (server.tcpIp, server.tcpPort))
+
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        print('\nCancelled by user. Bye!')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+
+    main()
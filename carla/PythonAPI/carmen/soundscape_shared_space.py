@@ -48,10 +48,13 @@ import carla
 
 from carla import ColorConverter as cc
 
-from carmen.session import CARMEnSession
+from carmen.session import CARMEnSession, CARMEnSimulation
 from carmen.interface import CARMEnHUD
 from carmen.controller import CARMEnControler
-from carmen.utils import CARMEnPoint, CARMEnCheckpoint
+from carmen.control_log import ControlLogReplay
+from carmen.opensignals import create_biosignal_client
+from carmen.biosignals import BiosignalFeatures, parse_channel
+from carmen.scenario import CARMEnScenario
 
 import argparse
 import datetime
@@ -75,9 +78,13 @@ import PyGameWidgets.core as core
 
 def game_loop(args):
     os.environ["SDL_JOYSTICK_ALLOW_BACKGROUND_EVENTS"] = "1"
+    if args.headless:
+        # No window, pygame still runs the clock, the events and the devices
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
     pygame.init()
     pygame.font.init()
     new_session = None
+    simulation = None
     road_id_list_for_ref = []
     lane_id_for_ref = []
 
@@ -100,7 +107,16 @@ def game_loop(args):
         
         panel = widgets.Panel(core.Grid((2, 10), (args.width, args.height)), None, None, (0, 0))
 
-        new_hud = CARMEnHUD(args.width, args.height, __doc__, panel)
+        biosignal_features = None
+        if args.ecg is not None or args.eda is not None:
+            biosignal_features = BiosignalFeatures(sampling_rate = args.biosignal_rate
+                                , ecg = parse_channel(args.ecg) if args.ecg is not None else None
+                                , eda = parse_channel(args.eda) if args.eda is not None else None
+                                )
+
+        new_hud = CARMEnHUD(args.width, args.height, __doc__, panel,
+                            biosignals = create_biosignal_client(args.biosignals),
+                            biosignal_features = biosignal_features)
 
         '''use_keyboard = input("Use Keyboard? (Y/N): ")
         if use_keyboard == 'Y' or use_keyboard == 'y':
@@ -114,20 +130,11 @@ def game_loop(args):
             elif use_joystick == 'N' or use_joystick == 'n':
                 joycontrol = False'''
 
-        subject_id = input("Insert subject ID (SXX): ")
-
-        start_point_list = []
-        start_point_list.append( CARMEnPoint(52.40, -50.65, 'player_start') )
-        start_point_list.append( CARMEnPoint(34.46, -50.65, 'player_start_check1') )
-        start_point_list.append( CARMEnPoint(12.41, -44.22, 'player_start_check2') )
-        start_point_list.append( CARMEnPoint(-5.23, -26.58, 'player_start_check3') )
-        start_point_list.append( CARMEnPoint(-23.25, -11.10, 'player_start_check4') )
-        start_point_list.append( CARMEnPoint(-39.08, 6.70, 'player_start_check5') )
-        start_point_list.append( CARMEnPoint(-54.08, 24.33, 'player_start_check6') )
-        start_point_list.append( CARMEnPoint(38.45, -50.65, 'player_start_check7') )
-        
-        road_id_list_for_ref = [10, 32, 24, 23, 33, 59, 37, 35, 25, 15, 3, 43, 13, 2, 26]
-        lane_id_for_ref = -1
+        subject_id = input("Insert subject ID (SXX): ") if args.replay is None else 'replay'
+
+        scenario = CARMEnScenario(args.scenario)
+        road_id_list_for_ref = scenario.road_ids
+        lane_id_for_ref = scenario.lane_id
 
         #save_directory = 'C:\\carla\\Unreal\\CarlaUE4\\Data\\'
         save_directory = 'C:\\Users\\Sistemas\\Documents\\OpenSignals (r)evolution\\files\\'
@@ -135,7 +142,7 @@ def game_loop(args):
         new_session = CARMEnSession(carla_world = client.get_world()
                           , hud = new_hud
                           , actor_filter = args.filter
-                          , player_start_list = start_point_list
+                          , player_start_list = scenario.player_starts
                           , subject = subject_id
                           , directory = save_directory
                           , waypoints = True
@@ -143,6 +150,8 @@ def game_loop(args):
                           , road_width = 3.4
                           , road_id_list = road_id_list_for_ref
                           , lane_id = lane_id_for_ref
+                          , log_controls = args.log_controls
+                          , headless = args.headless
                           )
 
         new_controller = CARMEnControler(start_in_autopilot = args.autopilot
@@ -151,105 +160,53 @@ def game_loop(args):
                                  , walker_speed = 1.277
                                  , walker_lateral_speed = 1.277
                                  , walker_turn_speed = 0.01
+                                 , input_cutoff = args.input_cutoff
+                                 , device = args.device
                                  )
 
         new_clock = pygame.time.Clock()
 
-        # Possible spanw directions: 80% front, 20% back, 50/50 left-right
-        direction_pools = []
-        #cond_70F_30B = ["FR"]
-        cond_70F_30B = ["FL", "FL", "FR", "FR", "BL", "BR"]
-        direction_pools.append(cond_70F_30B)
-        cond_70B_30F = ["BL", "BL", "BR", "BR", "FL", "FR"]
-        direction_pools.append(cond_70B_30F)
-
-        # Set checkpoints in the road for the pedestrian
-        checkpoint_list = []
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(32.8, -50.6, 'checkpoint1')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(55.65, -48.94, 'checkpoint1_BL', -1)
-                                 , desired_spawn_back_right = CARMEnPoint(55.65, -52.34, 'checkpoint1_BR', 1)
-                                 , desired_spawn_front_left = CARMEnPoint(-5.77, -23.61, 'checkpoint1_FL', -1)
-                                 , desired_spawn_front_right = CARMEnPoint(-8.18, -26.02, 'checkpoint1_FR', 1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(10.85, -42.65, 'checkpoint2')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(29.73, -48.40, 'checkpoint2_BL', -1)
-                                 , desired_spawn_back_right = CARMEnPoint(28.57, -51.58, 'checkpoint2_BR', 1)
-                                 , desired_spawn_front_left = CARMEnPoint(-24.39, -7.58, 'checkpoint2_FL', -1)
-                                 , desired_spawn_front_right = CARMEnPoint(-26.78, -9.97, 'checkpoint2_FR', 1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(-6.52, -25.25, 'checkpoint3')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(8.83, -38.23, 'checkpoint3_BL', -1)
-                                 , desired_spawn_back_right = CARMEnPoint(6.45, -40.61, 'checkpoint3_BR', 1)
-                                 , desired_spawn_front_left = CARMEnPoint(-41.94, 10.64, 'checkpoint3_FL', -1)
-                                 , desired_spawn_front_right = CARMEnPoint(-43.70, 7.73, 'checkpoint3_FR', 1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(-24.43, -9.94, 'checkpoint4')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(-9.34, -21.14, 'checkpoint3_BL', -1)
-                                 , desired_spawn_back_right = CARMEnPoint(-10.69, -24.26, 'checkpoint4_BR', 1)
-                                 , desired_spawn_front_left = CARMEnPoint(-53.31, 28.52, 'checkpoint4_FL', 1)
-                                 , desired_spawn_front_right = CARMEnPoint(-56.70, 28.43, 'checkpoint4_FR', -1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(-40.28, 7.45, 'checkpoint5')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(-25.50, -6.47, 'checkpoint5_BL', 1)
-                                 , desired_spawn_back_right = CARMEnPoint(-27.89, -8.86, 'checkpoint5_BR', -1)
-                                 , desired_spawn_front_left = CARMEnPoint(-42.22, 51.35, 'checkpoint5_FL', 1)
-                                 , desired_spawn_front_right = CARMEnPoint(-45.31, 52.76, 'checkpoint5_FR', -1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                                 , desired_point = CARMEnPoint(-54.53, 25.43, 'checkpoint6')
-                                 , spawns_vehicle_when_reached = True
-                                 , desired_spawn_back_left = CARMEnPoint(-42.66, 11.08, 'checkpoint6_BL', 1)
-                                 , desired_spawn_back_right = CARMEnPoint(-44.42, 8.16, 'checkpoint6_BR', 1)
-                                 , desired_spawn_front_left = CARMEnPoint(-33.19, 70.21, 'checkpoint6_FL', -1)
-                                 , desired_spawn_front_right = CARMEnPoint(-36.79, 71.82, 'checkpoint6_FR', -1)
-                                 )
-        )
-        
-        checkpoint_list.append(CARMEnCheckpoint(session=new_session
-                            , desired_point = CARMEnPoint(-45.54, 48.19, 'end_checkpoint')
-                            )
-        )
+        # Start points, checkpoints and spawn direction pools come from the scenario file,
+        # resolved once per map and cached next to it
+        checkpoint_list = scenario.compile(new_session)
+        new_session.set_checkpoints(checkpoint_list, scenario.direction_pools)
+
+        if args.replay is not None:
+            ControlLogReplay(args.replay).run(new_session, record = args.rec)
+            return
 
-        new_session.set_checkpoints(checkpoint_list, direction_pools)
+        if args.sim_rate > 0:
+            # The simulation ticks on its own thread, this loop only handles the events and renders
+            simulation = CARMEnSimulation(new_session, new_controller, args, rate = args.sim_rate, left_threshold = 3.45, right_threshold = 0.45)
+            simulation.start()
 
         while True:
             new_clock.tick_busy_loop(120)
-            if new_controller.parse_events(session = new_session
-                                       , clock = new_clock
-                                       , left_threshold = 3.45
-                                       , right_threshold = 0.45
-                                       ):
-                return
-            new_session.tick(new_clock, args)
-            new_session.render(display)
-            pygame.display.flip()
+            if simulation is not None:
+                simulation.check()
+                with simulation.lock:
+                    if new_controller.parse_events(session = new_session
+                                               , clock = new_clock
+                                               , apply = False
+                                               ):
+                        return
+                # Rendered outside the lock from the last frame the simulation thread published
+                dirty_rects = new_session.render(display)
+            else:
+                if new_controller.parse_events(session = new_session
+                                           , clock = new_clock
+                                           , left_threshold = 3.45
+                                           , right_threshold = 0.45
+                                           ):
+                    return
+                new_session.tick(new_clock, args)
+                dirty_rects = new_session.render(display)
+            pygame.display.update(dirty_rects)
 
     finally:
         print('\nClosed by User. Bye!')
-        if args.rec:
-            print('\nRecording Stoppped. Closing file.')
-            # close the file
-            args.f.close()
+        if simulation is not None:
+            simulation.stop()
         if new_session is not None:
             new_session.destroy()
 
@@ -298,6 +255,22 @@ def main():
         '-j', '--joycontrol',
         action='store_true',
         help='joystick control')
+    argparser.add_argument(
+        '--input-cutoff',
+        metavar='HZ',
+        default=0,
+        type=float,
+        help='low-pass the wheel/joystick axes at this cutoff, stepped by the time between event pumps (default: 0, unfiltered)')
+    argparser.add_argument(
+        '--sim-rate',
+        metavar='HZ',
+        default=0,
+        type=int,
+        help='tick the simulation on a separate thread at this rate, decoupled from rendering (default: 0, once per frame)')
+    argparser.add_argument(
+        '--device',
+        metavar='NAME',
+        help='wheel/joystick profile of the device config (default: matched by the device name)')
     argparser.add_argument(
         '--res',
         metavar='WIDTHxHEIGHT',
@@ -308,18 +281,60 @@ def main():
         metavar='PATTERN',
         default='walker.pedestrian.0052',
         help='actor filter (default: "walker.pedestrian.0052")')
+    argparser.add_argument(
+        '--scenario',
+        metavar='FILE',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios', 'shared_space.json'),
+        help='scenario file with the player starts, checkpoints and direction pools (default: scenarios/shared_space.json)')
     argparser.add_argument(
         '--rec',
         action='store_true',
-        help='record vehicle stats')
+        help='record vehicle stats of the replayed run to CSV, with --replay')
+    argparser.add_argument(
+        '--log-controls',
+        action='store_true',
+        help='log the controls and spawn decisions of every run to a binary control log')
+    argparser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help='re-simulate the run of a control log in synchronous mode and exit')
+    argparser.add_argument(
+        '--headless',
+        action='store_true',
+        help='replay without window, HUD or camera, needs --replay (add --rec for a CSV)')
+    argparser.add_argument(
+        '--biosignals',
+        metavar='SOURCE',
+        nargs='+',
+        help='biosignal sources, as OpenSignals HOST:PORT or a replay file (default: 127.0.0.1:5555)')
+    argparser.add_argument(
+        '--ecg',
+        metavar='[DEVICE:]COLUMN',
+        help='biosignal channel holding the ECG, enables live heart rate')
+    argparser.add_argument(
+        '--eda',
+        metavar='[DEVICE:]COLUMN',
+        help='biosignal channel holding the EDA, enables live tonic/phasic EDA')
+    argparser.add_argument(
+        '--biosignal-rate',
+        metavar='HZ',
+        default=1000,
+        type=int,
+        help='biosignal sampling rate (default: 1000)')
     argparser.add_argument(
         '--subject',
         metavar='SUBJECT',
         default='00',
         help='subject number (XX)')
     args = argparser.parse_args()
+    if args.headless and args.replay is None:
+        # Without a window there are no input events to drive the walker
+        argparser.error('--headless needs --replay, live runs take their input from the window')
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
+    if args.replay is not None:
+        # Replays are driven by the log, not by the input devices
+        args.keycontrol = True
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)
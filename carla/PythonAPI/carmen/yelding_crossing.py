@@ -49,10 +49,13 @@ import carla
 
 from carla import ColorConverter as cc
 
-from carmen.session import CARMEnSession
+from carmen.session import CARMEnSession, CARMEnSimulation
 from carmen.utils import CARMEnPoint, CARMEnCheckpoint
 from carmen.interface import CARMEnHUD
 from carmen.controller import CARMEnControler
+from carmen.control_log import ControlLogReplay
+from carmen.opensignals import create_biosignal_client
+from carmen.biosignals import BiosignalFeatures, parse_channel
 
 import argparse
 import datetime
@@ -75,9 +78,13 @@ import PyGameWidgets.core as core
 
 def game_loop(args):
     os.environ["SDL_JOYSTICK_ALLOW_BACKGROUND_EVENTS"] = "1"
+    if args.headless:
+        # No window, pygame still runs the clock, the events and the devices
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
     pygame.init()
     pygame.font.init()
     new_session = None
+    simulation = None
     road_id_list_for_ref = []
     lane_id_for_ref = []
 
@@ -96,7 +103,16 @@ def game_loop(args):
         
         panel = widgets.Panel(core.Grid((2, 10), (args.width, args.height)), None, None, (0, 0))
 
-        new_hud = CARMEnHUD(args.width, args.height, __doc__, panel)
+        biosignal_features = None
+        if args.ecg is not None or args.eda is not None:
+            biosignal_features = BiosignalFeatures(sampling_rate = args.biosignal_rate
+                                , ecg = parse_channel(args.ecg) if args.ecg is not None else None
+                                , eda = parse_channel(args.eda) if args.eda is not None else None
+                                )
+
+        new_hud = CARMEnHUD(args.width, args.height, __doc__, panel,
+                            biosignals = create_biosignal_client(args.biosignals),
+                            biosignal_features = biosignal_features)
         
         start_point_list = []
         if args.filter.find("walker") != -1:
@@ -113,6 +129,8 @@ def game_loop(args):
                           , road_width = 3.4
                           , road_id_list = road_id_list_for_ref
                           , lane_id = lane_id_for_ref
+                          , log_controls = args.log_controls
+                          , headless = args.headless
                           )
 
         new_controller = CARMEnControler(start_in_autopilot = args.autopilot
@@ -121,26 +139,46 @@ def game_loop(args):
                                  , walker_speed = 1.277
                                  , walker_lateral_speed = 1.277
                                  , walker_turn_speed = 0.01
+                                 , input_cutoff = args.input_cutoff
+                                 , device = args.device
                                  )
 
         new_clock = pygame.time.Clock()
 
+        if args.replay is not None:
+            ControlLogReplay(args.replay).run(new_session, record = args.rec)
+            return
+
+        if args.sim_rate > 0:
+            # The simulation ticks on its own thread, this loop only handles the events and renders
+            simulation = CARMEnSimulation(new_session, new_controller, args, rate = args.sim_rate)
+            simulation.start()
+
         while True:
             new_clock.tick_busy_loop(120)
-            if new_controller.parse_events(session = new_session
-                                       , clock = new_clock
-                                       ):
-                return
-            new_session.tick(new_clock, args)
-            new_session.render(display)
-            pygame.display.flip()
+            if simulation is not None:
+                simulation.check()
+                with simulation.lock:
+                    if new_controller.parse_events(session = new_session
+                                               , clock = new_clock
+                                               , apply = False
+                                               ):
+                        return
+                # Rendered outside the lock from the last frame the simulation thread published
+                dirty_rects = new_session.render(display)
+            else:
+                if new_controller.parse_events(session = new_session
+                                           , clock = new_clock
+                                           ):
+                    return
+                new_session.tick(new_clock, args)
+                dirty_rects = new_session.render(display)
+            pygame.display.update(dirty_rects)
 
     finally:
         print('\nClosed by User. Bye!')
-        if args.rec:
-            print('\nRecording Stoppped. Closing file.')
-            # close the file
-            args.f.close()
+        if simulation is not None:
+            simulation.stop()
         if new_session is not None:
             new_session.destroy()
 
@@ -189,6 +227,22 @@ def main():
         '-j', '--joycontrol',
         action='store_true',
         help='joystick control')
+    argparser.add_argument(
+        '--input-cutoff',
+        metavar='HZ',
+        default=0,
+        type=float,
+        help='low-pass the wheel/joystick axes at this cutoff, stepped by the time between event pumps (default: 0, unfiltered)')
+    argparser.add_argument(
+        '--sim-rate',
+        metavar='HZ',
+        default=0,
+        type=int,
+        help='tick the simulation on a separate thread at this rate, decoupled from rendering (default: 0, once per frame)')
+    argparser.add_argument(
+        '--device',
+        metavar='NAME',
+        help='wheel/joystick profile of the device config (default: matched by the device name)')
     argparser.add_argument(
         '--res',
         metavar='WIDTHxHEIGHT',
@@ -202,15 +256,52 @@ def main():
     argparser.add_argument(
         '--rec',
         action='store_true',
-        help='record vehicle stats')
+        help='record vehicle stats of the replayed run to CSV, with --replay')
+    argparser.add_argument(
+        '--log-controls',
+        action='store_true',
+        help='log the controls and spawn decisions of every run to a binary control log')
+    argparser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help='re-simulate the run of a control log in synchronous mode and exit')
+    argparser.add_argument(
+        '--headless',
+        action='store_true',
+        help='replay without window, HUD or camera, needs --replay (add --rec for a CSV)')
+    argparser.add_argument(
+        '--biosignals',
+        metavar='SOURCE',
+        nargs='+',
+        help='biosignal sources, as OpenSignals HOST:PORT or a replay file (default: 127.0.0.1:5555)')
+    argparser.add_argument(
+        '--ecg',
+        metavar='[DEVICE:]COLUMN',
+        help='biosignal channel holding the ECG, enables live heart rate')
+    argparser.add_argument(
+        '--eda',
+        metavar='[DEVICE:]COLUMN',
+        help='biosignal channel holding the EDA, enables live tonic/phasic EDA')
+    argparser.add_argument(
+        '--biosignal-rate',
+        metavar='HZ',
+        default=1000,
+        type=int,
+        help='biosignal sampling rate (default: 1000)')
     argparser.add_argument(
         '--subject',
         metavar='SUBJECT',
         default='00',
         help='subject number (XX)')
     args = argparser.parse_args()
+    if args.headless and args.replay is None:
+        # Without a window there are no input events to drive the walker
+        argparser.error('--headless needs --replay, live runs take their input from the window')
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
+    if args.replay is not None:
+        # Replays are driven by the log, not by the input devices
+        args.keycontrol = True
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(format='%(levelname)s: %(message)s', level=log_level)